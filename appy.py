@@ -1,5 +1,12 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
+import openpyxl
+from xlsxwriter import Workbook
+from xlsxwriter.worksheet import Worksheet
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 import plotly.express as px
 import plotly.graph_objects as go
 import streamlit.components.v1 as components
@@ -11,7 +18,17 @@ import glob
 import time
 import io
 import gc
+import threading
+import subprocess
+import shutil
+import sys
+import uuid
+import tempfile
+from collections import OrderedDict, Counter
+from contextlib import contextmanager
+import unicodedata
 import textwrap
+import html
 
 APP_VERSION = "1.5.0 (Actualizado)"
 
@@ -128,6 +145,12 @@ def formato_edad(x):
 # ===================== PERSISTENCIA =====================
 STATE_FILE = "user_state.json"
 ARCHIVO_FECHA = "fecha_update.txt"
+ARCHIVO_BASE = "base_guardada.parquet"
+ARCHIVO_BASE_LEGACY = "base_guardada.xlsx"
+DIR_INCREMENTOS = "base_guardada.incrementos"  # Partes Parquet que agregan las cargas incrementales
+MAX_INCREMENTOS_BASE = 20  # Con tantas partes acumuladas, la siguiente carga reescribe la base completa
+ORDENAR_POR_FECHA = True  # Ordenar el dataset al cargar para filtrar fechas por búsqueda binaria
+MAX_MB_CACHE_REPORTES = 256  # Tope de memoria para reportes XLSX ya generados
 
 def guardar_meta(nombre_archivo, valor):
     with open(nombre_archivo, "w") as f:
@@ -162,89 +185,271 @@ def cargar_fecha_actualizacion():
             return f.read().strip()
     return "Sin actualizaciones"
 
-def generar_excel_filtros(df, nombre_prof, fecha_inicio, fecha_fin, procedimiento, ciudad):
-    output = io.BytesIO()
-    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-        # HOJA 1: DATOS FILTRADOS (RAW)
-        df.to_excel(writer, sheet_name='Datos Filtrados', index=False)
-        
-        # HOJA 2: RESUMEN PROFESIONAL
-        if not df.empty:
-            col_profesional = next((c for c in df.columns if "profesional" in str(c).lower()), None)
-            col_procedimiento = next((c for c in df.columns if "nombre procedimiento" in str(c).lower()), None)
-            col_valor = next((c for c in df.columns if "valor" in str(c).lower()), None)
-            
-            if col_profesional and col_procedimiento and col_valor:
-                try:
-                    temp = df.copy()
-                    temp["_valor"] = pd.to_numeric(temp[col_valor], errors='coerce').fillna(0)
-                    agrupado = temp.groupby([col_profesional, col_procedimiento]).agg(
-                        Total_Servicios=(col_procedimiento, 'count'),
-                        Valor_Total=('_valor', 'sum')
-                    ).reset_index()
-                    agrupado.to_excel(writer, sheet_name='Resumen Profesional', index=False)
-                except:
-                    pass
-
-        # HOJA 3: RESUMEN PACIENTE
-        if not df.empty:
-            col_paciente = next((c for c in df.columns if "paciente" in str(c).lower()), None)
-            # Reutilizar columnas detectadas o buscar de nuevo si es necesario
-            if 'col_procedimiento' not in locals() or not col_procedimiento:
-                col_procedimiento = next((c for c in df.columns if "nombre procedimiento" in str(c).lower()), None)
-            if 'col_valor' not in locals() or not col_valor:
-                col_valor = next((c for c in df.columns if "valor" in str(c).lower()), None)
-
-            if col_paciente and col_procedimiento and col_valor:
-                try:
-                    temp = df.copy()
-                    temp["_valor"] = pd.to_numeric(temp[col_valor], errors='coerce').fillna(0)
-                    
-                    # Agrupar por Paciente y Procedimiento
-                    agrupado_paciente = temp.groupby([col_paciente, col_procedimiento]).agg(
-                        Cantidad=(col_procedimiento, 'count'),
-                        Valor_Total=('_valor', 'sum')
-                    ).reset_index()
-                    
-                    agrupado_paciente.to_excel(writer, sheet_name='Resumen Paciente', index=False)
-                except:
-                    pass
-        
-        # HOJA 4: TOTALES
-        if not df.empty and col_procedimiento and col_valor:
-             try:
-                temp = df.copy()
-                temp["_val"] = pd.to_numeric(temp[col_valor], errors='coerce').fillna(0)
-                agrupado_total = temp.groupby(col_procedimiento)["_val"].sum().reset_index()
-                agrupado_total.to_excel(writer, sheet_name='Totales', index=False)
-             except:
-                pass
+def generar_excel_filtros(df, agregados=None):
+    """Bytes del reporte XLSX de los datos filtrados con sus resúmenes."""
+    # HOJA 1: DATOS FILTRADOS (RAW)
+    hojas = [('Datos Filtrados', df)]
+    
+    # HOJAS 2-5: resúmenes tomados del motor de agregación
+    if not df.empty:
+        if agregados is None:
+            agregados = calcular_agregados(df)
+        resumenes = [
+            ("prof_proc", "Resumen Profesional"),
+            ("paciente_proc", "Resumen Paciente"),
+            ("procedimiento", "Totales"),
+            ("profesionales", "Dashboard"),
+        ]
+        for parte, hoja in resumenes:
+            if agregados.get(parte) is not None:
+                hojas.append((hoja, agregados[parte]))
+    
+    # Se escribe a un archivo temporal en streaming y solo los bytes finales quedan en memoria
+    with tempfile.TemporaryDirectory() as directorio:
+        ruta = os.path.join(directorio, "reporte_filtrado.xlsx")
+        exportar_xlsx(ruta, hojas)
+        with open(ruta, "rb") as f:
+            return f.read()
+
+@st.cache_resource
+def cache_reportes():
+    """LRU de reportes XLSX compartido por todo el proceso, acotado por tamaño en bytes."""
+    return {"lock": threading.Lock(), "items": OrderedDict(), "bytes": 0, "max_bytes": MAX_MB_CACHE_REPORTES * 1024 * 1024}
+
+def buscar_reporte_filtros(version, filtros):
+    """Devuelve el reporte ya generado para (versión, filtros) o None."""
+    cache = cache_reportes()
+    clave = (version, filtros)
+    with cache["lock"]:
+        if clave in cache["items"]:
+            cache["items"].move_to_end(clave)
+            return cache["items"][clave]
+    return None
 
-        # HOJA 5: DASHBOARD
-        if not df.empty and col_profesional:
-             try:
-                counts = df[col_profesional].value_counts().reset_index()
-                counts.columns = ["Profesional", "Servicios"]
-                counts.to_excel(writer, sheet_name='Dashboard', index=False)
-             except:
-                pass
-                
-    output.seek(0)
-    return output
+def obtener_reporte_filtros(version, filtros, df):
+    """Genera el reporte de filtros solo si no está en cache y lo guarda (expulsando los menos usados).
+
+    Se llama recién cuando alguien pulsa descargar (ver main_app).
+    """
+    datos = buscar_reporte_filtros(version, filtros)
+    if datos is not None:
+        return datos
+
+    # El reporte lleva todos los resúmenes, no solo los de la pestaña abierta
+    datos = generar_excel_filtros(df, agregados_filtrados(version, filtros, PARTES_AGREGADOS, df))
+    cache = cache_reportes()
+    clave = (version, filtros)
+    with cache["lock"]:
+        if clave not in cache["items"]:
+            cache["items"][clave] = datos
+            cache["bytes"] += len(datos)
+        while cache["bytes"] > cache["max_bytes"] and len(cache["items"]) > 1:
+            _, viejo = cache["items"].popitem(last=False)
+            cache["bytes"] -= len(viejo)
+    return datos
+
+def guardar_excel(df, nombre_archivo=ARCHIVO_BASE):
+    """Guarda la base de trabajo en formato columnar (Parquet).
+
+    El XLSX solo se genera cuando alguien lo descarga explícitamente. Devuelve las filas tal como
+    quedaron guardadas.
+    """
+    df = clean_df_for_st(df)
+    # Escritura atómica: los lectores nunca ven un archivo a medio escribir
+    tmp_path = f"{nombre_archivo}.tmp"
+    df.to_parquet(tmp_path, engine="pyarrow", index=False)
+    os.replace(tmp_path, nombre_archivo)
+    if nombre_archivo == ARCHIVO_BASE:
+        # La base completa ya incluye las cargas incrementales anteriores
+        shutil.rmtree(DIR_INCREMENTOS, ignore_errors=True)
+    guardar_opciones(df, nombre_archivo)
+    return df
 
-def guardar_excel(df, nombre_archivo="base_guardada.xlsx"):
-    df.to_excel(nombre_archivo, index=False)
+def rutas_incrementos():
+    return sorted(glob.glob(os.path.join(DIR_INCREMENTOS, "parte_*.parquet")))
 
-def cargar_excel(nombre_archivo="base_guardada.xlsx"):
+def anexar_incremento(df):
+    """Guarda filas nuevas como una parte más de la base, sin leer ni reescribir lo ya guardado.
+
+    El XLSX consolidado queda desactualizado: se borra y se regenera cuando alguien lo descarga.
+    Devuelve las filas tal como quedaron guardadas.
+    """
+    if df is None or df.empty:
+        return df
+    df = clean_df_for_st(df)
+    filas_previas = sum(_filas_parquet(ruta) for ruta in [ARCHIVO_BASE] + rutas_incrementos() if os.path.exists(ruta))
+    os.makedirs(DIR_INCREMENTOS, exist_ok=True)
+    ruta = os.path.join(DIR_INCREMENTOS, f"parte_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}.parquet")
+    df.to_parquet(f"{ruta}.tmp", engine="pyarrow", index=False)
+    os.replace(f"{ruta}.tmp", ruta)
+    anexar_opciones(df, filas_previas)
+    for viejo in glob.glob("archivo_consolidado*.xlsx"):
+        try:
+            os.remove(viejo)
+        except:
+            pass
+    return df
+
+def cargar_excel(nombre_archivo=ARCHIVO_BASE):
     if os.path.exists(nombre_archivo):
         try:
-            df = pd.read_excel(nombre_archivo)
-            return clean_df_for_st(df)
+            # Memory-map: los tipos vienen preservados, no hace falta limpiar de nuevo
+            df = pd.read_parquet(nombre_archivo, engine="pyarrow", memory_map=True)
+            partes = rutas_incrementos() if nombre_archivo == ARCHIVO_BASE else []
+            if partes:
+                df = pd.concat([df] + [pd.read_parquet(ruta, engine="pyarrow") for ruta in partes], ignore_index=True)
+            return df
+        except:
+            return None
+    # Migración de la base antigua en Excel (solo ocurre una vez)
+    if nombre_archivo == ARCHIVO_BASE and os.path.exists(ARCHIVO_BASE_LEGACY):
+        try:
+            df = clean_df_for_st(pd.read_excel(ARCHIVO_BASE_LEGACY))
+            guardar_excel(df)
+            return df
         except:
             return None
     return None
 
+# ===================== MEDICIÓN DE TIEMPOS =====================
+ARCHIVO_TIEMPOS = "tiempos_fases.jsonl"
+MAX_MB_LOG_TIEMPOS = 5  # Al superarlo el log rota a .1, .2, ...
+ARCHIVOS_LOG_TIEMPOS = 3  # Archivos rotados que se conservan
+RERUNS_PANEL_TIEMPOS = 500  # Reruns recientes que resume el panel de admin
+
+_medicion = threading.local()  # Cada sesión de Streamlit corre su script en su propio hilo
+
+@st.cache_resource
+def lock_log_tiempos():
+    return threading.Lock()
+
+def iniciar_medicion(sesion, usuario, origen="app"):
+    """Abre el registro de fases del rerun (o trabajo) actual en este hilo."""
+    _medicion.actual = {"sesion": sesion, "usuario": usuario, "origen": origen, "inicio": time.perf_counter(), "fases": []}
+
+@contextmanager
+def medir_fase(fase, filas=None):
+    """Mide el bloque como una fase del rerun actual. El bloque puede anotar registro["filas"].
+
+    Sin medición abierta (ej: benchmarks o llamadas sueltas) no registra nada.
+    """
+    registro = {"fase": fase, "filas": filas}
+    inicio = time.perf_counter()
+    try:
+        yield registro
+    finally:
+        actual = getattr(_medicion, "actual", None)
+        if actual is not None:
+            registro["ms"] = round((time.perf_counter() - inicio) * 1000, 2)
+            actual["fases"].append(registro)
+
+def _rotar_log_tiempos():
+    if not os.path.exists(ARCHIVO_TIEMPOS) or os.path.getsize(ARCHIVO_TIEMPOS) < MAX_MB_LOG_TIEMPOS * 1024 * 1024:
+        return
+    for i in range(ARCHIVOS_LOG_TIEMPOS - 1, 0, -1):
+        if os.path.exists(f"{ARCHIVO_TIEMPOS}.{i}"):
+            os.replace(f"{ARCHIVO_TIEMPOS}.{i}", f"{ARCHIVO_TIEMPOS}.{i + 1}")
+    os.replace(ARCHIVO_TIEMPOS, f"{ARCHIVO_TIEMPOS}.1")
+
+def cerrar_medicion():
+    """Agrega una línea JSON con las fases del rerun actual al log de tiempos."""
+    actual = getattr(_medicion, "actual", None)
+    _medicion.actual = None
+    if not actual or not actual["fases"]:
+        return
+    linea = {
+        "momento": datetime.now().isoformat(timespec="seconds"),
+        "sesion": actual["sesion"],
+        "usuario": actual["usuario"],
+        "origen": actual["origen"],
+        "total_ms": round((time.perf_counter() - actual["inicio"]) * 1000, 2),
+        "fases": actual["fases"],
+    }
+    try:
+        with lock_log_tiempos():
+            _rotar_log_tiempos()
+            with open(ARCHIVO_TIEMPOS, "a", encoding="utf-8") as f:
+                f.write(json.dumps(linea, ensure_ascii=False, default=str) + "\n")
+    except:
+        pass
+
+def leer_tiempos(ultimos=RERUNS_PANEL_TIEMPOS):
+    """Últimos reruns registrados (del más nuevo hacia atrás, recorriendo los archivos rotados)."""
+    lineas = []
+    for ruta in [ARCHIVO_TIEMPOS] + [f"{ARCHIVO_TIEMPOS}.{i}" for i in range(1, ARCHIVOS_LOG_TIEMPOS + 1)]:
+        if len(lineas) >= ultimos:
+            break
+        if os.path.exists(ruta):
+            with open(ruta, encoding="utf-8") as f:
+                lineas = f.readlines()[-(ultimos - len(lineas)):] + lineas
+    registros = []
+    for linea in lineas:
+        try:
+            registros.append(json.loads(linea))
+        except:
+            pass
+    return registros
+
+def resumen_tiempos(registros):
+    """p50 / p95 / máximo de milisegundos y filas típicas por fase."""
+    filas = [
+        {"Fase": fase["fase"], "ms": fase["ms"], "Filas": fase.get("filas")}
+        for registro in registros for fase in registro.get("fases", [])
+    ]
+    filas += [{"Fase": f"(total {r.get('origen', 'app')})", "ms": r["total_ms"], "Filas": None} for r in registros if "total_ms" in r]
+    if not filas:
+        return pd.DataFrame(columns=["Fase", "Mediciones", "p50 ms", "p95 ms", "Máx ms", "Filas p50"])
+    tabla = pd.DataFrame(filas)
+    tabla["Filas"] = pd.to_numeric(tabla["Filas"], errors="coerce")
+    grupos = tabla.groupby("Fase", sort=False)
+    return pd.DataFrame({
+        "Mediciones": grupos["ms"].size(),
+        "p50 ms": grupos["ms"].quantile(0.5),
+        "p95 ms": grupos["ms"].quantile(0.95),
+        "Máx ms": grupos["ms"].max(),
+        "Filas p50": grupos["Filas"].median(),
+    }).sort_values("p95 ms", ascending=False).reset_index()
+
 # ===================== LÓGICA DE NEGOCIO =====================
+PATRON_CONTROL = re.compile(r'[\x00-\x08\x0B-\x0C\x0E-\x1F]')
+LARGO_MAX_CELDA = 32700
+
+def es_columna_texto(serie):
+    return pd.api.types.is_string_dtype(serie.dtype)
+
+def _como_arrow(serie):
+    """Strings respaldados por Arrow (el formato por defecto de pandas 3) para que las
+    operaciones .str corran vectorizadas y no celda a celda."""
+    return serie.astype(pd.StringDtype("pyarrow")) if serie.dtype == object else serie
+
+def quitar_caracteres_control(serie):
+    """Elimina caracteres nulos o de control que rompen Arrow/Excel (serie de solo strings).
+
+    Devuelve strings Arrow; solo se reemplaza en las filas afectadas.
+    """
+    texto = _como_arrow(serie)
+    afectadas = texto.str.contains(PATRON_CONTROL.pattern, regex=True).to_numpy(dtype=bool)
+    if not afectadas.any():
+        return texto
+    texto = texto.copy()
+    texto[afectadas] = texto[afectadas].str.replace(PATRON_CONTROL.pattern, '', regex=True)
+    return texto
+
+def sanear_texto_excel(serie):
+    """Texto seguro para exportar: sin caracteres de control, sin fórmulas y con largo máximo de celda."""
+    serie = serie.fillna("")
+    if not isinstance(serie.dtype, pd.StringDtype):
+        serie = serie.astype(str)
+    texto = quitar_caracteres_control(serie)
+
+    formulas = texto.str.startswith("=").to_numpy(dtype=bool)
+    if formulas.any():
+        texto = texto.copy()
+        texto[formulas] = "'" + texto[formulas]
+    if texto.str.len().max() > LARGO_MAX_CELDA:
+        texto = texto.str.slice(0, LARGO_MAX_CELDA)
+    return texto
+
 def clean_df_for_st(df):
     """Limpia el DataFrame para evitar errores de PyArrow en Streamlit"""
     if df is None or df.empty:
@@ -253,259 +458,1660 @@ def clean_df_for_st(df):
     df = df.copy()
     
     # 1. Eliminar columnas Unnamed
-    df = df.loc[:, ~df.columns.str.contains('^Unnamed')]
+    df = df.loc[:, ~df.columns.astype(str).str.contains('^Unnamed')]
     
     # 2. Homogeneizar tipos de datos para evitar Mixed Types
     for col in df.columns:
-        # Si es tipo objeto, forzar a string y limpiar caracteres raros
-        if df[col].dtype == 'object':
-            df[col] = df[col].astype(str).replace('nan', '')
-            # Eliminar caracteres nulos o de control que rompen Arrow
-            df[col] = df[col].apply(lambda x: re.sub(r'[\x00-\x08\x0B-\x0C\x0E-\x1F]', '', x) if isinstance(x, str) else x)
+        # Si es texto u objeto, forzar a string y limpiar caracteres raros
+        if es_columna_texto(df[col]):
+            # Los vacíos se enmascaran antes de astype(str): con pandas 2 None pasaría a ser "None"
+            serie = df[col].astype(str).where(df[col].notna(), '').replace('nan', '')
+            df[col] = quitar_caracteres_control(serie)
     
     return df
 
-def find_col(df, candidates):
-    for col in df.columns:
-        if any(cand.lower() in str(col).lower() for cand in candidates):
-            return col
-    return None
+# Rol -> candidatos en orden de preferencia. Los roles se resuelven en este orden y una columna
+# ya asignada no se reutiliza (ej: "nombre" del paciente no toma "Nombre Procedimiento",
+# "valor" no toma "Valor Unitario").
+ROLES_COLUMNAS = {
+    "codigo": ["codigo procedimiento", "cod procedimiento", "codigo", "cups"],
+    "procedimiento": ["nombre procedimiento", "procedimiento", "servicio", "actividad", "descripcion"],
+    "profesional": ["nombre profesional", "profesional"],
+    "valor_unitario": ["valor unitario", "valor_unitario", "precio unitario"],
+    "valor": ["valor total", "total", "valor neto", "neto", "valor"],
+    "cantidad": ["cantidad", "cant"],
+    "fecha": ["fecha"],
+    "ciudad": ["ciudad", "municipio", "sede"],
+    "paciente": ["paciente", "nombre completo", "nombre", "usuario", "afiliado", "cliente"],
+}
+# Archivo 2 (tarifario): el precio puede venir como "Precio" o "Valor" a secas
+ROLES_TARIFARIO = {
+    "codigo": ["codigo procedimiento", "cod procedimiento", "codigo", "cups"],
+    "procedimiento": ["nombre procedimiento", "procedimiento", "descripcion", "nombre"],
+    "valor_unitario": ["valor unitario", "valor_unitario", "precio", "valor"],
+}
+# Claves por defecto de la carga incremental: factura + código + cédula
+ROLES_DEDUP = {
+    "factura": ["factura", "no factura", "numero factura", "nro factura"],
+    "codigo": ["codigo procedimiento", "cod procedimiento", "codigo", "cups"],
+    "cedula": ["cedula", "documento", "identificacion"],
+}
+ROLES_POR_TIPO = {"datos": ROLES_COLUMNAS, "tarifario": ROLES_TARIFARIO, "dedup": ROLES_DEDUP}
+
+@st.cache_resource(max_entries=64, show_spinner=False)
+def _resolver_esquema(columnas, tipo):
+    nombres = [str(c).strip().lower() for c in columnas]
+    usadas = set()
+    esquema = {}
+    for rol, candidatos in ROLES_POR_TIPO[tipo].items():
+        esquema[rol] = None
+        # Primero coincidencia exacta, luego por contenido
+        for exacta in (True, False):
+            for cand in candidatos:
+                pos = next((i for i, n in enumerate(nombres) if i not in usadas and (n == cand if exacta else cand in n)), None)
+                if pos is not None:
+                    esquema[rol] = columnas[pos]
+                    usadas.add(pos)
+                    break
+            if esquema[rol] is not None:
+                break
+    return esquema
 
-def leer_excel(file_obj1, file_obj2=None):
-    if file_obj1 is None and file_obj2 is None:
-        if 'df' in st.session_state and st.session_state.df is not None:
-            return st.session_state.df
-        return cargar_excel()
+def resolver_esquema(df, tipo="datos"):
+    """Devuelve {rol: columna} para el DataFrame. Memoizado en el proceso por la firma de
+    columnas, así se calcula una vez por versión del dataset y lo comparten todas las pestañas.
 
+    tipo elige la tabla de roles (ROLES_POR_TIPO): los datos, el tarifario o las claves de la carga incremental."""
+    if df is None:
+        return dict.fromkeys(ROLES_POR_TIPO[tipo])
+    return dict(_resolver_esquema(tuple(df.columns), tipo))
+
+# ===================== LECTURA XLSX EN STREAMING =====================
+FILAS_POR_BLOQUE = 50000
+
+def _nombres_columnas(encabezado):
+    """Nombres de columnas al estilo de pd.read_excel: vacíos -> "Unnamed: i", duplicados -> "X.1"."""
+    nombres = []
+    vistos = {}
+    for i, valor in enumerate(encabezado):
+        nombre = f"Unnamed: {i}" if valor is None or str(valor).strip() == "" else str(valor)
+        if nombre in vistos:
+            vistos[nombre] += 1
+            nombre = f"{nombre}.{vistos[nombre]}"
+        vistos.setdefault(nombre, 0)
+        nombres.append(nombre)
+    return nombres
+
+def _bloque_tipado(filas, columnas, dtype):
+    if dtype is str:
+        filas = [tuple(None if v is None else str(v) for v in fila) for fila in filas]
+    bloque = pd.DataFrame.from_records(filas, columns=columnas, coerce_float=True)
+    # Columnas vacías en este bloque: NaN numérico para no forzar 'object' al concatenar
+    for col in bloque.columns[(bloque.dtypes == object).to_numpy()]:
+        if bloque[col].isna().all():
+            bloque[col] = np.nan
+    return bloque
+
+def iterar_bloques_xlsx(file_obj, dtype=None, progreso=None, filas_por_bloque=FILAS_POR_BLOQUE):
+    """Genera la primera hoja de un XLSX como DataFrames tipados de filas_por_bloque filas.
+
+    Lee fila a fila con openpyxl read_only, así nunca hay más de un bloque de celdas en memoria.
+    Siempre genera al menos un bloque (vacío si la hoja no tiene datos).
+    progreso(fraccion, texto) se llama al terminar cada bloque.
+    """
+    libro = openpyxl.load_workbook(file_obj, read_only=True, data_only=True, keep_links=False)
     try:
-        df1 = pd.DataFrame()
-        df2 = pd.DataFrame()
+        hoja = libro.worksheets[0]
+        total_filas = max((hoja.max_row or 1) - 1, 1)
+        filas = hoja.iter_rows(values_only=True)
+        encabezado = next(filas, None)
+        if encabezado is None:
+            yield pd.DataFrame()
+            return
+        columnas = _nombres_columnas(encabezado)
+        ancho = len(columnas)
+
+        pendientes = []
+        leidas = 0
+        generados = 0
+        for fila in filas:
+            if all(v is None for v in fila):
+                continue
+            pendientes.append(fila[:ancho])
+            if len(pendientes) >= filas_por_bloque:
+                bloque = _bloque_tipado(pendientes, columnas, dtype)
+                leidas += len(pendientes)
+                pendientes = []
+                if progreso:
+                    progreso(min(leidas / total_filas, 1.0), f"{leidas:,} filas leídas")
+                generados += 1
+                yield bloque
+        if pendientes or not generados:
+            bloque = _bloque_tipado(pendientes, columnas, dtype)
+            leidas += len(pendientes)
+            if progreso:
+                progreso(1.0, f"{leidas:,} filas leídas")
+            yield bloque
+        elif progreso:
+            progreso(1.0, f"{leidas:,} filas leídas")
+    finally:
+        libro.close()
+
+def leer_xlsx_streaming(file_obj, dtype=None, progreso=None, filas_por_bloque=FILAS_POR_BLOQUE):
+    """Lee la primera hoja de un XLSX fila a fila (openpyxl read_only) en bloques tipados.
+
+    A diferencia de pd.read_excel no materializa toda la hoja como listas de celdas, así el
+    pico de memoria es proporcional al DataFrame final. dtype=str equivale a read_excel(dtype=str).
+    """
+    bloques = list(iterar_bloques_xlsx(file_obj, dtype, progreso, filas_por_bloque))
+    if len(bloques) == 1:
+        return bloques[0].infer_objects()
+    return pd.concat(bloques, ignore_index=True).infer_objects()
+
+# ===================== EXPORTACIÓN XLSX =====================
+FILAS_MAX_HOJA = 1048576  # Límite de Excel (incluye el encabezado); lo que sobra sigue en otra hoja
+FORMATO_FECHA_XLSX = "dd/mm/yyyy"
+FORMATO_ENTERO_XLSX = "#,##0"
+
+def _escribir_texto(hoja, fila, col, valor, formato):
+    # write_string: un texto que empieza con "=" nunca se interpreta como fórmula
+    if isinstance(valor, str):
+        hoja.write_string(fila, col, valor, formato)
+    else:
+        hoja.write(fila, col, valor, formato)
+
+def _escritor_columna(serie, formatos, num_format=None):
+    """(método de escritura, formato, valores) según el tipo de la columna; los nulos quedan como None.
+
+    Las fechas llevan FORMATO_FECHA_XLSX; los números quedan en General salvo que la columna traiga
+    su num_format, así un ID o un código CUPS no aparece con separadores de miles.
+    """
+    if pd.api.types.is_datetime64_any_dtype(serie):
+        if getattr(serie.dt, "tz", None) is not None:
+            serie = serie.dt.tz_localize(None)
+        metodo, formato = Worksheet.write_datetime, formatos.get(num_format or FORMATO_FECHA_XLSX)
+    elif pd.api.types.is_bool_dtype(serie):
+        metodo, formato = Worksheet.write_boolean, None
+    elif pd.api.types.is_integer_dtype(serie):
+        metodo, formato = Worksheet.write_number, formatos.get(num_format)
+    elif pd.api.types.is_float_dtype(serie):
+        metodo, formato = Worksheet.write_number, formatos.get(num_format)
+    else:
+        metodo, formato = _escribir_texto, formatos.get(num_format)
+    valores = serie.astype(object).where(serie.notna(), None).tolist()
+    return metodo, formato, valores
+
+def exportar_xlsx(destino, hojas, formatos_columnas=None, progreso=None, total_filas=None):
+    """Escribe hojas de DataFrames en un XLSX con xlsxwriter en modo constant_memory.
+
+    Cada hoja es (nombre, DataFrame o iterable de DataFrames); los bloques se escriben fila a fila
+    y se descartan, así la memoria no crece con el tamaño del archivo. Las fechas llevan formato de
+    fecha y los números quedan en General; formatos_columnas={columna: num_format} fija el formato
+    de una columna en todos los bloques, sin depender del tipo que traiga cada uno.
+    Devuelve {"filas", "segundos", "filas_por_segundo"}.
+    """
+    formatos_columnas = formatos_columnas or {}
+    inicio = time.perf_counter()
+    escritas = 0
+    libro = Workbook(destino, {"constant_memory": True, "nan_inf_to_errors": True, "tmpdir": tempfile.gettempdir()})
+    try:
+        negrita = libro.add_format({"bold": True})
+        formatos = {}
+        for formato in set(formatos_columnas.values()) | {FORMATO_FECHA_XLSX}:
+            if formato:
+                formatos[formato] = libro.add_format({"num_format": formato})
+
+        def nueva_hoja(nombre, parte, columnas):
+            titulo = nombre if parte == 1 else f"{nombre[:25]} ({parte})"
+            hoja = libro.add_worksheet(titulo)
+            hoja.freeze_panes(1, 0)
+            for c, col in enumerate(columnas):
+                hoja.set_column(c, c, min(max(len(str(col)) + 2, 10), 50))
+                hoja.write_string(0, c, str(col), negrita)
+            return hoja
+
+        for nombre, bloques in hojas:
+            if isinstance(bloques, pd.DataFrame):
+                bloques = [bloques]
+            hoja = None
+            parte = 1
+            fila = 1
+            for bloque in bloques:
+                if hoja is None:
+                    hoja = nueva_hoja(nombre, parte, bloque.columns)
+                columnas = [_escritor_columna(bloque[col], formatos, formatos_columnas.get(col)) for col in bloque.columns]
+                for i in range(len(bloque)):
+                    if fila == FILAS_MAX_HOJA:
+                        parte += 1
+                        hoja = nueva_hoja(nombre, parte, bloque.columns)
+                        fila = 1
+                    for c, (metodo, formato, valores) in enumerate(columnas):
+                        valor = valores[i]
+                        if valor is not None:
+                            metodo(hoja, fila, c, valor, formato)
+                    fila += 1
+                escritas += len(bloque)
+                if progreso and total_filas:
+                    progreso(min(escritas / total_filas, 1.0), f"{escritas:,} filas escritas")
+            if hoja is None:
+                nueva_hoja(nombre, 1, [])
+    finally:
+        libro.close()
+
+    segundos = time.perf_counter() - inicio
+    return {"filas": escritas, "segundos": segundos, "filas_por_segundo": escritas / segundos if segundos > 0 else 0.0}
+
+def barra_progreso(etiqueta):
+    """Callback de progreso (fraccion, texto) dibujado sobre un st.progress."""
+    barra = st.progress(0.0, text=etiqueta)
+    def actualizar(fraccion, texto):
+        barra.progress(fraccion, text=f"{etiqueta} — {texto}")
+    return actualizar
+
+def avisar_streamlit(nivel, mensaje):
+    """Muestra un mensaje con st.info / st.success / st.warning / st.error según el nivel."""
+    getattr(st, nivel)(mensaje)
+
+def _tramo_progreso(progreso, etapa, desde, hasta):
+    """Adapta el callback global (etapa, fraccion, texto) al tramo [desde, hasta] de una etapa."""
+    if progreso is None:
+        return None
+    return lambda fraccion, texto: progreso(etapa, desde + (hasta - desde) * fraccion, texto)
+
+def publicar_consolidado(tmp_path, avisar=avisar_streamlit):
+    """Reemplaza archivo_consolidado.xlsx por el recién exportado y borra las copias viejas."""
+    output_path = "archivo_consolidado.xlsx"
+    try:
+        os.replace(tmp_path, output_path)
+    except:
+        output_path = f"archivo_consolidado_{int(datetime.now().timestamp())}.xlsx"
+        os.replace(tmp_path, output_path)
 
-        if file_obj1 is not None:
-            df1 = pd.read_excel(file_obj1, engine="openpyxl")
-        
-        if file_obj2 is not None:
-            df2 = pd.read_excel(file_obj2, engine="openpyxl")
-
-        # Limpieza preliminar
-        col_prof1 = find_col(df1, ["profesional", "nombre profesional"])
-        if col_prof1:
-             df1[col_prof1] = df1[col_prof1].astype(str).str.replace(r'^\d+\s*[-]?\s*', '', regex=True).str.strip()
-
-        # Consolidación
-        if not df1.empty and not df2.empty:
-            col_code1 = find_col(df1, ["codigo procedimiento", "cod procedimiento", "codigo", "cups"])
-            col_code2 = find_col(df2, ["codigo procedimiento", "cod procedimiento", "codigo", "cups"])
-            
-            col_name1 = find_col(df1, ["nombre procedimiento", "procedimiento", "descripcion", "nombre"])
-            col_name2 = find_col(df2, ["nombre procedimiento", "procedimiento", "descripcion", "nombre"])
-            
-            col_val_unit2 = find_col(df2, ["valor unitario", "valor_unitario", "precio", "valor"])
+    for f_old in glob.glob("archivo_consolidado*.xlsx"):
+        if f_old != output_path:
+            try:
+                os.remove(f_old)
+            except:
+                pass
 
-            if col_val_unit2 and (col_code1 and col_code2 or col_name1 and col_name2):
-                st.info(f"Consolidando archivos con búsqueda inteligente...")
-                
-                if col_code1: df1['_temp_code'] = df1[col_code1].astype(str).str.strip()
-                if col_code2: df2['_temp_code'] = df2[col_code2].astype(str).str.strip()
-                
-                if col_name1: df1['_temp_name'] = df1[col_name1].astype(str).str.strip().str.lower()
-                if col_name2: df2['_temp_name'] = df2[col_name2].astype(str).str.strip().str.lower()
-                
-                df1['__Valor_Encontrado__'] = None
-                
-                if col_code1 and col_code2:
-                    df2_clean = df2.dropna(subset=[col_val_unit2])
-                    df2_unique = df2_clean.drop_duplicates(subset=['_temp_code'])
-                    price_map_code = df2_unique.set_index('_temp_code')[col_val_unit2].to_dict()
-                    df1['__Valor_Encontrado__'] = df1['_temp_code'].map(price_map_code)
-                
-                if col_name1 and col_name2:
-                    df2_clean = df2.dropna(subset=[col_val_unit2])
-                    df2_unique = df2_clean.drop_duplicates(subset=['_temp_name'])
-                    price_map_name = df2_unique.set_index('_temp_name')[col_val_unit2].to_dict()
-                    mask_missing = df1['__Valor_Encontrado__'].isna()
-                    df1.loc[mask_missing, '__Valor_Encontrado__'] = df1.loc[mask_missing, '_temp_name'].map(price_map_name)
-                
-                col_val_unit1 = find_col(df1, ["valor unitario", "valor_unitario", "precio unitario"])
-                if not col_val_unit1:
-                     col_val_unit1 = "Valor Unitario"
-                     if col_val_unit1 not in df1.columns:
-                        df1[col_val_unit1] = 0.0
-                
-                vals_nuevos = pd.to_numeric(df1['__Valor_Encontrado__'], errors='coerce')
-                vals_actuales = pd.to_numeric(df1[col_val_unit1], errors='coerce').fillna(0)
-                df1[col_val_unit1] = vals_nuevos.combine_first(vals_actuales)
-                
-                col_qty1 = find_col(df1, ["cantidad", "cant"])
-                if col_qty1:
-                    qtys = pd.to_numeric(df1[col_qty1], errors='coerce').fillna(1)
-                else:
-                    qtys = 1
-                
-                col_total1 = find_col(df1, ["valor total", "total", "valor neto", "neto", "valor"])
-                if not col_total1:
-                    col_total1 = "Valor"
-                
-                val_unit_safe = pd.to_numeric(df1[col_val_unit1], errors='coerce').fillna(0)
-                df1[col_total1] = val_unit_safe * qtys
-                
-                for tmp in ['_temp_code', '_temp_name', '__Valor_Encontrado__']:
-                    if tmp in df1.columns:
-                        df1.drop(columns=[tmp], inplace=True)
-                
-                df = df1
-            
-                # Guardado seguro
-                try:
-                    consolidados_viejos = glob.glob("archivo_consolidado*.xlsx")
-                    for f_old in consolidados_viejos:
-                        try:
-                            os.remove(f_old)
-                        except:
-                            pass
+    avisar("success", "✅ Archivo consolidado generado exitosamente.")
 
-                    if 'Valor_Unitario_Ref' in df.columns:
-                        df = df.drop(columns=['Valor_Unitario_Ref'])
-                    
-                    df_export = df.copy()
-                    df_export = df_export.loc[:, ~df_export.columns.duplicated()]
-                    df_export.columns = df_export.columns.astype(str).str.strip()
+    # Forzar actualización de timestamp para que otros usuarios recarguen
+    if os.path.exists(output_path):
+        # "Touch" el archivo para asegurar cambio de fecha si fue muy rápido
+        os.utime(output_path, None)
 
-                    for col in df_export.columns:
-                        col_lower = col.lower()
-                        if "fecha" in col_lower or "inicio" in col_lower or "fin" in col_lower or pd.api.types.is_datetime64_any_dtype(df_export[col]):
-                            try:
-                                df_export[col] = pd.to_datetime(df_export[col], errors='coerce', dayfirst=True, format='mixed')
-                            except:
-                                pass
-                        elif "profesional" in col_lower:
-                            try:
-                                df_export[col] = df_export[col].astype(str).str.replace(r'^\d+\s*[-]?\s*', '', regex=True).str.strip()
-                            except:
-                                pass
-                        elif col == col_val_unit1 or col == col_total1:
-                             df_export[col] = pd.to_numeric(df_export[col], errors='coerce').fillna(0)
-                        elif df_export[col].dtype == 'object':
-                            df_export[col] = df_export[col].fillna("").astype(str)
-                            df_export[col] = df_export[col].apply(lambda x: re.sub(r'[\x00-\x08\x0B-\x0C\x0E-\x1F]', '', x))
-                            df_export[col] = df_export[col].apply(lambda x: "'" + x if str(x).startswith("=") else x)
-                            df_export[col] = df_export[col].str.slice(0, 32700)
-
-                    output_path = "archivo_consolidado.xlsx"
-                    if os.path.exists(output_path):
-                        try:
-                            os.remove(output_path)
-                        except:
-                            output_path = f"archivo_consolidado_{int(datetime.now().timestamp())}.xlsx"
+def exportar_consolidado(df, col_val_unit, col_total, tmp_path, progreso=None):
+    """Escribe el XLSX consolidado en tmp_path: fechas, profesionales, valores y textos normalizados."""
+    if progreso:
+        progreso("Exportación", 0.6, "Preparando columnas")
 
-                    try:
-                        with pd.ExcelWriter(output_path, engine='xlsxwriter', engine_kwargs={'options': {'nan_inf_to_errors': True}}, date_format='dd/mm/yyyy', datetime_format='dd/mm/yyyy') as writer:
-                             df_export.to_excel(writer, index=False)
-                    except:
-                        df_export.to_excel(output_path, index=False, engine='openpyxl')
-                    
-                    st.success("✅ Archivo consolidado generado exitosamente.")
-                    st.session_state['consolidado_path'] = output_path
-                    
-                    # Forzar actualización de timestamp para que otros usuarios recarguen
-                    if os.path.exists(output_path):
-                        # "Touch" el archivo para asegurar cambio de fecha si fue muy rápido
-                        os.utime(output_path, None)
+    df_export = df.copy()
+    df_export = df_export.loc[:, ~df_export.columns.duplicated()]
+    df_export.columns = df_export.columns.astype(str).str.strip()
 
-                except Exception as e:
-                    st.error(f"Error generando consolidado: {e}")
+    for col in df_export.columns:
+        col_lower = col.lower()
+        if "fecha" in col_lower or "inicio" in col_lower or "fin" in col_lower or pd.api.types.is_datetime64_any_dtype(df_export[col]):
+            try:
+                df_export[col] = pd.to_datetime(df_export[col], errors='coerce', dayfirst=True, format='mixed')
+            except:
+                pass
+        elif "profesional" in col_lower:
+            try:
+                df_export[col] = df_export[col].astype(str).str.replace(r'^\d+\s*[-]?\s*', '', regex=True).str.strip()
+            except:
+                pass
+        elif col == col_val_unit or col == col_total:
+             df_export[col] = pd.to_numeric(df_export[col], errors='coerce').fillna(0)
+        elif es_columna_texto(df_export[col]):
+            df_export[col] = sanear_texto_excel(df_export[col])
+
+    if progreso:
+        progreso("Exportación", 0.7, "Escribiendo Excel consolidado")
+
+    exportar_xlsx(
+        tmp_path, [("Sheet1", df_export)],
+        formatos_columnas={col: FORMATO_ENTERO_XLSX for col in (col_val_unit, col_total) if col},
+        progreso=_tramo_progreso(progreso, "Exportación", 0.7, 0.9), total_filas=len(df_export)
+    )
+
+def preparar_consolidado(df):
+    """Regenera archivo_consolidado.xlsx desde la base (tras una carga incremental no existe)."""
+    esquema = resolver_esquema(df)
+    tmp_path = f".archivo_consolidado.{uuid.uuid4().hex[:6]}.tmp.xlsx"
+    try:
+        exportar_consolidado(df, esquema["valor_unitario"], esquema["valor"], tmp_path)
+        publicar_consolidado(tmp_path, avisar=lambda nivel, mensaje: None)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def procesar_consolidacion(file_obj1, file_obj2=None, avisar=avisar_streamlit, progreso=None, incremental=False, claves_dedup=None,
+                           directorio_tmp="."):
+    """Lectura, búsqueda de precios y exportación del consolidado.
+
+    No depende de la sesión de Streamlit: la corre el trabajo en segundo plano, que pasa su propio
+    directorio_tmp para el XLSX a medio escribir. avisar(nivel, mensaje) recibe los mensajes y
+    progreso(etapa, fraccion, texto) el avance.
+    Con incremental=True las filas leídas que no estaban se agregan a la base guardada como una
+    parte más (ver anexar_a_base); en ese caso se devuelven solo las filas agregadas.
+    """
+    anexar = False
+    xlsx_pendiente = None
+    df1 = pd.DataFrame()
+    df2 = pd.DataFrame()
+
+    if file_obj1 is not None:
+        with medir_fase("consolidacion_lectura_1") as fase:
+            df1 = leer_xlsx_streaming(file_obj1, progreso=_tramo_progreso(progreso, "Lectura Archivo 1", 0.0, 0.4))
+            fase["filas"] = len(df1)
+
+    if file_obj2 is not None:
+        with medir_fase("consolidacion_lectura_2") as fase:
+            df2 = leer_xlsx_streaming(file_obj2, progreso=_tramo_progreso(progreso, "Lectura Archivo 2", 0.4, 0.5))
+            fase["filas"] = len(df2)
+
+    esquema1 = resolver_esquema(df1)
+
+    # Limpieza preliminar
+    col_prof1 = esquema1["profesional"]
+    if col_prof1:
+         df1[col_prof1] = df1[col_prof1].astype(str).str.replace(r'^\d+\s*[-]?\s*', '', regex=True).str.strip()
+
+    # Tarifario: el Archivo 2 se guarda como nueva versión; sin él se usa la última guardada
+    tarifario = tarifario_nuevo = None
+    if not df2.empty:
+        # Se guarda junto con la base: un trabajo cancelado no deja una versión nueva
+        tarifario = tarifario_nuevo = preparar_tarifario(df2)
+    elif not df1.empty:
+        tarifario = cargar_tarifario()
+        if tarifario is not None:
+            avisar("info", f"Usando el tarifario guardado (versión {tarifario['version']}).")
+
+    # Consolidación
+    if not df1.empty and (not df2.empty or tarifario is not None):
+        col_code1 = esquema1["codigo"]
+        col_name1 = esquema1["procedimiento"]
+
+        if tarifario is not None and (col_code1 or col_name1):
+            avisar("info", "Consolidando archivos con búsqueda inteligente...")
+            if progreso:
+                progreso("Búsqueda de precios", 0.5, "Cruzando con el tarifario")
             
+            with medir_fase("consolidacion_precios", len(df1)):
+                precios, conteo = buscar_precios(
+                    tarifario,
+                    df1[col_code1] if col_code1 else None,
+                    df1[col_name1] if col_name1 else None
+                )
+            df1['__Valor_Encontrado__'] = precios
+            sin_precio = len(df1) - sum(conteo.values())
+            avisar("info", f"Precios encontrados: {conteo['codigo']:,} por código, {conteo['nombre']:,} por nombre, "
+                           f"{conteo['aproximado']:,} por nombre aproximado; {sin_precio:,} sin precio.")
+            
+            col_val_unit1 = esquema1["valor_unitario"]
+            if not col_val_unit1:
+                 col_val_unit1 = "Valor Unitario"
+                 if col_val_unit1 not in df1.columns:
+                    df1[col_val_unit1] = 0.0
+            
+            vals_nuevos = pd.to_numeric(df1['__Valor_Encontrado__'], errors='coerce')
+            vals_actuales = pd.to_numeric(df1[col_val_unit1], errors='coerce').fillna(0)
+            df1[col_val_unit1] = vals_nuevos.combine_first(vals_actuales)
+            
+            col_qty1 = esquema1["cantidad"]
+            if col_qty1:
+                qtys = pd.to_numeric(df1[col_qty1], errors='coerce').fillna(1)
             else:
-                st.warning("No se encontraron columnas para consolidar. Concatenando...")
-                df = pd.concat([df1, df2], ignore_index=True)
-
-        elif not df1.empty:
+                qtys = 1
+            
+            col_total1 = esquema1["valor"]
+            if not col_total1:
+                col_total1 = "Valor"
+            
+            val_unit_safe = pd.to_numeric(df1[col_val_unit1], errors='coerce').fillna(0)
+            df1[col_total1] = val_unit_safe * qtys
+            
+            df1.drop(columns=['__Valor_Encontrado__'], inplace=True)
+            
             df = df1
-        elif not df2.empty:
-            df = df2
-        else:
-            return st.session_state.get('df') or cargar_excel()
-
-        df.columns = df.columns.astype(str).str.strip()
-        # Limpiar columnas Unnamed que causan error Arrow
-        df = df.loc[:, ~df.columns.str.contains('^Unnamed')]
+            if incremental:
+                df, anexar = anexar_a_base(df, claves_dedup, avisar)
         
-        st.session_state.df = df
-        guardar_excel(df)
-        guardar_fecha_actualizacion()
+            # Guardado seguro
+            try:
+                if 'Valor_Unitario_Ref' in df.columns:
+                    df = df.drop(columns=['Valor_Unitario_Ref'])
+
+                # Al anexar no se reescribe el XLSX: se regenera cuando alguien lo descarga
+                if not anexar:
+                    # Se escribe aparte y se publica al final: mientras tanto los demás
+                    # usuarios siguen trabajando con la versión anterior
+                    tmp_path = os.path.join(directorio_tmp, ".archivo_consolidado.tmp.xlsx")
+                    with medir_fase("consolidacion_exportacion_xlsx", len(df)):
+                        exportar_consolidado(df, col_val_unit1, col_total1, tmp_path, progreso)
+
+                    # Se publica junto con la base, después del último punto de cancelación
+                    xlsx_pendiente = tmp_path
+
+            except TrabajoCancelado:
+                raise
+            except Exception as e:
+                avisar("error", f"Error generando consolidado: {e}")
         
-        return df
+        else:
+            avisar("warning", "No se encontraron columnas para consolidar. Concatenando...")
+            df = pd.concat([df1, df2], ignore_index=True)
+            if incremental:
+                df, anexar = anexar_a_base(df, claves_dedup, avisar)
+
+    elif not df1.empty:
+        df = df1
+        if incremental:
+            df, anexar = anexar_a_base(df, claves_dedup, avisar)
+    elif not df2.empty:
+        df = df2
+    else:
+        return cargar_excel()
+
+    df.columns = df.columns.astype(str).str.strip()
+    # Limpiar columnas Unnamed que causan error Arrow
+    df = df.loc[:, ~df.columns.str.contains('^Unnamed')]
+    
+    # No se guarda en session_state: todas las sesiones leen el dataset compartido
+    if progreso:
+        progreso("Guardado", 0.95, "Guardando base de trabajo")
+    with medir_fase("consolidacion_guardado", len(df)):
+        df = canonizar_dataset(df)
+        if tarifario_nuevo is not None:
+            guardar_tarifario(tarifario_nuevo)
+        if anexar:
+            version_previa = version_dataset()
+            # El resumen se arma con las mismas filas (ya limpias) que quedaron en la parte
+            df = anexar_incremento(df)
+            # Las filas nuevas se suman al resumen anterior
+            actualizar_resumen_mensual(df, version_previa)
+        else:
+            df = guardar_excel(df)
+            if xlsx_pendiente:
+                publicar_consolidado(xlsx_pendiente, avisar)
+            actualizar_resumen_mensual(df)
+    guardar_fecha_actualizacion()
+    
+    return df
+
+# ===================== TARIFARIO =====================
+DIR_TARIFARIOS = "tarifarios"
+MAX_TARIFARIOS_GUARDADOS = 5
+UMBRAL_SIMILITUD_NOMBRE = 0.8  # Jaccard de trigramas para aceptar un nombre aproximado
+CANDIDATOS_APROXIMADOS = 20
+
+def normalizar_codigo(serie):
+    return serie.fillna("").astype(str).str.strip().str.replace(r'\.0$', '', regex=True)
+
+def _sin_tildes(texto):
+    return unicodedata.normalize("NFKD", texto).encode("ascii", "ignore").decode("ascii")
+
+def normalizar_nombre(serie):
+    """Minúsculas, sin tildes, sin puntuación y con espacios simples (solo sobre los valores únicos)."""
+    codigos, unicos = pd.factorize(serie.fillna("").astype(str), use_na_sentinel=False)
+    normalizados = pd.Index([_sin_tildes(u) for u in unicos]).str.lower()
+    normalizados = normalizados.str.replace(r'[^\w\s]', ' ', regex=True).str.split().str.join(" ")
+    return pd.Series(np.asarray(normalizados, dtype=object)[codigos], index=serie.index)
+
+def _trigramas(texto):
+    texto = f"  {texto} "
+    return {texto[i:i + 3] for i in range(len(texto) - 2)}
+
+def _numeros(texto):
+    return frozenset(re.findall(r'\d+', texto))
+
+def preparar_tarifario(df2):
+    """Índice del Archivo 2 (código y nombre normalizados + valor) como nueva versión, aún sin guardar.
+
+    Devuelve None si el archivo no tiene las columnas necesarias. Se persiste con guardar_tarifario.
+    """
+    esquema2 = resolver_esquema(df2, "tarifario")
+    col_code2, col_name2, col_val_unit2 = esquema2["codigo"], esquema2["procedimiento"], esquema2["valor_unitario"]
+    if not col_val_unit2 or not (col_code2 or col_name2):
+        return None
+
+    tarifario = pd.DataFrame({
+        "codigo": normalizar_codigo(df2[col_code2]) if col_code2 else "",
+        "nombre": normalizar_nombre(df2[col_name2]) if col_name2 else "",
+        "valor": pd.to_numeric(df2[col_val_unit2], errors="coerce"),
+    }).dropna(subset=["valor"])
+    return _construir_indice_tarifario(tarifario, datetime.now().strftime('%Y%m%d_%H%M%S_%f'))
+
+def guardar_tarifario(indice):
+    """Guarda el tarifario de preparar_tarifario como nueva versión y borra las más viejas."""
+    os.makedirs(DIR_TARIFARIOS, exist_ok=True)
+    ruta = os.path.join(DIR_TARIFARIOS, f"tarifario_{indice['version']}.parquet")
+    indice["tabla"].to_parquet(ruta + ".tmp", engine="pyarrow", index=False)
+    os.replace(ruta + ".tmp", ruta)
+    for viejo in sorted(glob.glob(os.path.join(DIR_TARIFARIOS, "tarifario_*.parquet")))[:-MAX_TARIFARIOS_GUARDADOS]:
+        os.remove(viejo)
+
+def ruta_tarifario_actual():
+    versiones = sorted(glob.glob(os.path.join(DIR_TARIFARIOS, "tarifario_*.parquet")))
+    return versiones[-1] if versiones else None
+
+def cargar_tarifario():
+    """Índice de la última versión guardada del tarifario, o None si nunca se cargó uno."""
+    ruta = ruta_tarifario_actual()
+    return indice_tarifario(ruta) if ruta else None
+
+@st.cache_resource(max_entries=2, show_spinner=False)
+def indice_tarifario(ruta):
+    """Índice de una versión guardada del tarifario."""
+    return _construir_indice_tarifario(pd.read_parquet(ruta), os.path.basename(ruta)[len("tarifario_"):-len(".parquet")])
+
+def _construir_indice_tarifario(tarifario, version):
+    """Índices del tarifario: precio por código, precio por nombre y trigramas de nombres.
+
+    Ante códigos o nombres repetidos vale el primero con precio, como antes con drop_duplicates.
+    """
+    por_codigo = tarifario[tarifario["codigo"] != ""].drop_duplicates("codigo")
+    por_nombre = tarifario[tarifario["nombre"] != ""].drop_duplicates("nombre")
+
+    nombres = por_nombre["nombre"].tolist()
+    trigramas = {}
+    for i, nombre in enumerate(nombres):
+        for trigrama in _trigramas(nombre):
+            trigramas.setdefault(trigrama, []).append(i)
+
+    return {
+        "version": version,
+        "tabla": tarifario,
+        "codigos": pd.Index(por_codigo["codigo"]),
+        "valores_codigo": por_codigo["valor"].to_numpy(),
+        "nombres": pd.Index(nombres),
+        "valores_nombre": por_nombre["valor"].to_numpy(),
+        "trigramas": trigramas,
+        "tamanos": [len(_trigramas(n)) for n in nombres],
+        "numeros": [_numeros(n) for n in nombres],
+    }
+
+def _buscar_exacto(indice, valores, claves):
+    posiciones = indice.get_indexer(claves)
+    return np.where(posiciones >= 0, valores[np.maximum(posiciones, 0)], np.nan)
+
+def buscar_nombre_aproximado(tarifario, nombre):
+    """Posición del nombre del tarifario más parecido (Jaccard de trigramas) o -1.
+
+    Solo se aceptan candidatos con los mismos números que la consulta (p. ej. "control 1" no es "control 2").
+    """
+    consulta = _trigramas(nombre)
+    compartidos = Counter()
+    for trigrama in consulta:
+        compartidos.update(tarifario["trigramas"].get(trigrama, ()))
+
+    numeros = _numeros(nombre)
+    mejor, mejor_similitud = -1, UMBRAL_SIMILITUD_NOMBRE
+    for i, comunes in compartidos.most_common(CANDIDATOS_APROXIMADOS):
+        similitud = comunes / (len(consulta) + tarifario["tamanos"][i] - comunes)
+        if similitud >= mejor_similitud and tarifario["numeros"][i] == numeros:
+            mejor, mejor_similitud = i, similitud
+    return mejor
+
+def buscar_precios(tarifario, codigos=None, nombres=None):
+    """Precio por fila: primero por código, luego por nombre exacto y al final por nombre aproximado.
+
+    Las búsquedas exactas son vectorizadas; la aproximada se hace una vez por nombre único.
+    Devuelve (precios, conteo por fuente).
+    """
+    n = len(codigos) if codigos is not None else len(nombres)
+    precios = np.full(n, np.nan)
+    conteo = {"codigo": 0, "nombre": 0, "aproximado": 0}
+
+    if codigos is not None and len(tarifario["codigos"]):
+        precios = _buscar_exacto(tarifario["codigos"], tarifario["valores_codigo"], normalizar_codigo(codigos))
+        conteo["codigo"] = int((~np.isnan(precios)).sum())
+
+    if nombres is not None and len(tarifario["nombres"]):
+        faltan = np.isnan(precios)
+        nombres_norm = normalizar_nombre(nombres[faltan])
+        precios[faltan] = _buscar_exacto(tarifario["nombres"], tarifario["valores_nombre"], nombres_norm)
+        conteo["nombre"] = int(faltan.sum() - np.isnan(precios[faltan]).sum())
+
+        faltan = np.isnan(precios)
+        if faltan.any():
+            nombres_norm = normalizar_nombre(nombres[faltan])
+            unicos = nombres_norm.unique()
+            mejores = np.array([buscar_nombre_aproximado(tarifario, u) if u else -1 for u in unicos], dtype=np.int64)
+            encontrados = pd.Series(np.where(mejores >= 0, tarifario["valores_nombre"][np.maximum(mejores, 0)], np.nan), index=unicos)
+            precios[faltan] = nombres_norm.map(encontrados).to_numpy(dtype=float)
+            conteo["aproximado"] = int(faltan.sum() - np.isnan(precios[faltan]).sum())
+
+    return precios, conteo
+
+# ===================== CONSOLIDACIÓN INCREMENTAL =====================
+CONFIG_CONSOLIDACION = "config_consolidacion.json"
+ARCHIVO_RESUMEN = "resumen_mensual.parquet"
+
+def cargar_claves_dedup(df=None):
+    """Columnas clave para la carga incremental: las guardadas o, si no hay, factura + código + cédula."""
+    try:
+        with open(CONFIG_CONSOLIDACION, "r") as f:
+            claves = json.load(f).get("claves_dedup")
+        if claves:
+            return claves
+    except:
+        pass
+    if df is None:
+        return []
+    return [col for col in resolver_esquema(df, "dedup").values() if col]
+
+def guardar_claves_dedup(claves):
+    with open(CONFIG_CONSOLIDACION, "w") as f:
+        json.dump({"claves_dedup": list(claves)}, f)
+
+def _hash_claves(df, columnas):
+    """Hash por fila de las columnas clave normalizadas (texto, sin espacios, minúsculas, sin ".0").
+
+    Los vacíos valen "" en los dos lados: la base guardada y las filas recién leídas.
+    """
+    normalizado = pd.DataFrame({
+        col: df[col].astype(str).where(df[col].notna(), "").str.strip().str.lower().str.replace(r'\.0$', '', regex=True)
+        for col in columnas
+    })
+    return pd.util.hash_pandas_object(normalizado, index=False)
+
+def _mes_de(df, col_fecha):
+    if not col_fecha:
+        return pd.Series("Sin fecha", index=df.index)
+    fechas = df[col_fecha]
+    if not pd.api.types.is_datetime64_any_dtype(fechas):
+        fechas = pd.to_datetime(fechas, errors="coerce", dayfirst=True, format="mixed")
+    return fechas.dt.strftime("%Y-%m").fillna("Sin fecha")
+
+def anexar_a_base(nuevas, claves_dedup, avisar=avisar_streamlit):
+    """Deja solo las filas cuya clave todavía no existe en la base guardada.
+
+    De la base se leen únicamente las columnas clave. Las repetidas dentro del mismo archivo
+    también se descartan. Devuelve (filas, anexar): con anexar=True son solo las filas nuevas,
+    que se guardan como una parte más (anexar_incremento); con False es la base completa a
+    reescribir (no hay base previa o ya acumula MAX_INCREMENTOS_BASE partes).
+    """
+    nuevas = nuevas.copy()
+    nuevas.columns = nuevas.columns.astype(str).str.strip()
+    if not os.path.exists(ARCHIVO_BASE):
+        cargar_excel()  # Migra la base antigua en Excel, si la hay
+    if not os.path.exists(ARCHIVO_BASE):
+        avisar("info", "No hay base previa: la carga incremental se toma como consolidación completa.")
+        return nuevas, False
+
+    # Las claves se comparan en forma canónica (ej: fechas ya convertidas)
+    nuevas = canonizar_dataset(nuevas)
+    rutas = [ARCHIVO_BASE] + rutas_incrementos()
+    columnas_por_ruta = {ruta: set(pq.read_schema(ruta).names) for ruta in rutas}
+    claves = [col for col in (claves_dedup or []) if col in nuevas.columns and any(col in cols for cols in columnas_por_ruta.values())]
+    if claves:
+        base = pd.concat([pd.read_parquet(ruta, columns=[c for c in claves if c in cols]) for ruta, cols in columnas_por_ruta.items()],
+                         ignore_index=True)
+        col_fecha = resolver_esquema(nuevas)["fecha"]
+        if col_fecha in claves and not pd.api.types.is_datetime64_any_dtype(base[col_fecha]):
+            # Bases guardadas por versiones anteriores tienen la fecha como texto
+            base[col_fecha] = pd.to_datetime(base[col_fecha], errors="coerce", dayfirst=True, format="mixed")
+        hash_nuevas = _hash_claves(nuevas, claves)
+        es_nueva = ~hash_nuevas.isin(_hash_claves(base, claves)) & ~hash_nuevas.duplicated()
+        del base
+        agregadas = nuevas[es_nueva.to_numpy()]
+        avisar("info", f"Carga incremental: {len(agregadas):,} filas nuevas, {len(nuevas) - len(agregadas):,} ya existían o estaban repetidas (clave: {' + '.join(claves)}).")
+    else:
+        agregadas = nuevas
+        avisar("warning", "Las columnas clave no están en la base y en el archivo nuevo: se agregan todas las filas.")
+
+    if len(rutas) > MAX_INCREMENTOS_BASE:
+        avisar("info", f"La base acumula {len(rutas) - 1} cargas incrementales: se reescribe completa.")
+        return pd.concat([cargar_excel(), agregadas], ignore_index=True), False
+    return agregadas, True
+
+def calcular_resumen_mensual(df):
+    """Servicios y valores por (mes, profesional, procedimiento). None si faltan columnas."""
+    esquema = resolver_esquema(df)
+    col_prof, col_proc, col_val = esquema["profesional"], esquema["procedimiento"], esquema["valor"]
+    if not (col_prof and col_proc and col_val):
+        return None
+
+    valores_raw = pd.to_numeric(df[col_val], errors="coerce")
+    vista = pd.DataFrame({
+        "Mes": _mes_de(df, esquema["fecha"]).to_numpy(),
+        "Profesional": df[col_prof].to_numpy(),
+        "Procedimiento": df[col_proc].to_numpy(),
+        "Servicios": 1,
+        "Valor_Total": valores_raw.fillna(0).to_numpy(),
+        "Valor_Positivo": valores_raw.where(valores_raw > 0, 0).fillna(0).to_numpy(),
+    })
+    return vista.groupby(["Mes", "Profesional", "Procedimiento"], dropna=False).sum().reset_index()
+
+def version_resumen():
+    """Versión de la base (version_dataset) con la que se guardó el resumen mensual, o None."""
+    try:
+        metadatos = pq.read_schema(ARCHIVO_RESUMEN).metadata or {}
+        return json.loads(metadatos[b"version_base"])
+    except:
+        return None
+
+def actualizar_resumen_mensual(df, version_previa=None):
+    """Persiste el resumen mensual junto con la versión de la base que resume.
+
+    Con version_previa (carga incremental) df trae solo las filas agregadas y se suman al resumen
+    anterior, siempre que este corresponda a esa versión de la base.
+    """
+    try:
+        resumen = calcular_resumen_mensual(df)
+        if resumen is None:
+            if os.path.exists(ARCHIVO_RESUMEN):
+                os.remove(ARCHIVO_RESUMEN)
+            return
+        if version_previa is not None:
+            if version_resumen() != json.loads(json.dumps(version_previa)):
+                # Sin un resumen al día no hay a qué sumar: las pestañas calculan desde la base
+                if os.path.exists(ARCHIVO_RESUMEN):
+                    os.remove(ARCHIVO_RESUMEN)
+                return
+            previo = pd.read_parquet(ARCHIVO_RESUMEN)
+            resumen = pd.concat([previo, resumen], ignore_index=True).groupby(
+                ["Mes", "Profesional", "Procedimiento"], dropna=False).sum().reset_index()
+        tabla = pa.Table.from_pandas(resumen, preserve_index=False)
+        tabla = tabla.replace_schema_metadata({**(tabla.schema.metadata or {}), b"version_base": json.dumps(version_dataset())})
+        tmp_path = f"{ARCHIVO_RESUMEN}.tmp"
+        pq.write_table(tabla, tmp_path)
+        os.replace(tmp_path, ARCHIVO_RESUMEN)
+    except:
+        # El resumen es un atajo: sin él las pestañas calculan desde la base
+        if os.path.exists(ARCHIVO_RESUMEN):
+            os.remove(ARCHIVO_RESUMEN)
+
+def agregados_desde_resumen(df, partes, version):
+    """Agregados sin filtros a partir del resumen mensual persistido (solo las partes que cubre).
+
+    Devuelve {} si el resumen no existe o se guardó para otra versión de la base.
+    """
+    if df is None or not os.path.exists(ARCHIVO_RESUMEN):
+        return {}
+    if version_resumen() != json.loads(json.dumps(version)):
+        return {}
+    try:
+        resumen = pd.read_parquet(ARCHIVO_RESUMEN)
+    except:
+        return {}
+
+    esquema = resolver_esquema(df)
+    col_prof, col_proc = esquema["profesional"], esquema["procedimiento"]
+    agregados = {}
+    if "total" in partes:
+        agregados["total"] = resumen["Valor_Positivo"].sum()
+    if "prof_proc" in partes:
+        agregados["prof_proc"] = resumen.groupby(["Profesional", "Procedimiento"])[["Servicios", "Valor_Total"]].sum().reset_index().rename(
+            columns={"Profesional": col_prof, "Procedimiento": col_proc, "Servicios": "Total_Servicios"})
+    if "procedimiento" in partes:
+        agregados["procedimiento"] = resumen.groupby("Procedimiento")[["Servicios", "Valor_Total"]].sum().reset_index().rename(
+            columns={"Procedimiento": col_proc, "Servicios": "Cantidad"})
+    if "profesionales" in partes:
+        agregados["profesionales"] = resumen.groupby("Profesional")["Servicios"].sum().sort_values(ascending=False, kind="stable").reset_index()
+    return agregados
+
+# ===================== TRABAJOS EN SEGUNDO PLANO =====================
+DIR_TRABAJOS = "trabajos"
+MAX_TRABAJOS_GUARDADOS = 10
+ESTADOS_ACTIVOS = ("en_cola", "ejecutando")
+
+class TrabajoCancelado(Exception):
+    """El administrador canceló el trabajo de consolidación."""
+
+def _ruta_trabajo(trabajo_id, nombre=""):
+    return os.path.join(DIR_TRABAJOS, trabajo_id, nombre)
+
+def cargar_trabajo(trabajo_id):
+    try:
+        with open(_ruta_trabajo(trabajo_id, "estado.json"), "r") as f:
+            return json.load(f)
+    except:
+        return None
+
+def actualizar_trabajo(trabajo_id, **cambios):
+    """Actualiza el registro del trabajo con escritura atómica (tmp + os.replace)."""
+    registro = cargar_trabajo(trabajo_id) or {"id": trabajo_id}
+    registro.update(cambios)
+    ruta = _ruta_trabajo(trabajo_id, "estado.json")
+    with open(ruta + ".tmp", "w") as f:
+        json.dump(registro, f)
+    os.replace(ruta + ".tmp", ruta)
+    return registro
+
+@st.cache_resource
+def procesos_trabajos():
+    """Procesos de consolidación lanzados por este servidor (pid -> Popen), para esperarlos al terminar."""
+    return {"lock": threading.Lock(), "procesos": {}}
+
+def recoger_procesos_terminados():
+    """Espera a los hijos que ya terminaron (bien o no) para que no queden como zombis."""
+    registro = procesos_trabajos()
+    with registro["lock"]:
+        for pid, proceso in list(registro["procesos"].items()):
+            if proceso.poll() is not None:
+                del registro["procesos"][pid]
+
+def _proceso_vivo(pid):
+    if pid in procesos_trabajos()["procesos"]:
+        return True
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    # Un zombi todavía responde a kill(pid, 0): en Linux se mira su estado en /proc
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            return f.read().rsplit(")", 1)[1].split()[0] != "Z"
+    except:
+        return True
+
+def ultimo_trabajo():
+    """Registro del trabajo más reciente; marca como interrumpido el que murió sin terminar."""
+    recoger_procesos_terminados()
+    if not os.path.isdir(DIR_TRABAJOS):
+        return None
+    ids = sorted(os.listdir(DIR_TRABAJOS))
+    if not ids:
+        return None
+    trabajo = cargar_trabajo(ids[-1])
+    if trabajo and trabajo.get("estado") in ESTADOS_ACTIVOS:
+        pid = trabajo.get("pid")
+        sin_arrancar = pid is None and time.time() - trabajo.get("creado", 0) > 60
+        if sin_arrancar or (pid is not None and not _proceso_vivo(pid)):
+            trabajo = actualizar_trabajo(trabajo["id"], estado="error", etapa="Interrumpido", error="El proceso terminó inesperadamente.")
+    return trabajo
+
+def iniciar_trabajo_consolidacion(file_obj1, file_obj2, usuario, incremental=False, claves_dedup=None):
+    """Guarda los archivos subidos y lanza la consolidación en un proceso aparte.
+
+    El proceso sobrevive a recargas del navegador y no bloquea la sesión del administrador.
+    """
+    trabajo_id = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:6]}"
+    os.makedirs(_ruta_trabajo(trabajo_id), exist_ok=True)
+
+    # Limpiar trabajos viejos
+    for viejo in sorted(os.listdir(DIR_TRABAJOS))[:-MAX_TRABAJOS_GUARDADOS]:
+        shutil.rmtree(os.path.join(DIR_TRABAJOS, viejo), ignore_errors=True)
+
+    for nombre, file_obj in [("archivo1.xlsx", file_obj1), ("archivo2.xlsx", file_obj2)]:
+        if file_obj is not None:
+            file_obj.seek(0)
+            with open(_ruta_trabajo(trabajo_id, nombre), "wb") as f:
+                shutil.copyfileobj(file_obj, f)
+
+    actualizar_trabajo(trabajo_id, estado="en_cola", etapa="En cola", progreso=0.0, detalle="",
+                       mensajes=[], usuario=usuario, creado=time.time(),
+                       incremental=incremental, claves_dedup=list(claves_dedup or []))
+    with open(_ruta_trabajo(trabajo_id, "salida.log"), "w") as log:
+        proceso = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "--trabajo-consolidacion", trabajo_id],
+            cwd=os.getcwd(), stdout=log, stderr=subprocess.STDOUT, start_new_session=True
+        )
+    registro = procesos_trabajos()
+    with registro["lock"]:
+        registro["procesos"][proceso.pid] = proceso
+    return trabajo_id
+
+def cancelar_trabajo(trabajo_id):
+    """Pide la cancelación; el trabajo la atiende en su siguiente aviso de progreso."""
+    open(_ruta_trabajo(trabajo_id, "cancelar"), "w").close()
+
+def ejecutar_trabajo_consolidacion(trabajo_id):
+    """Punto de entrada del proceso de consolidación (ver MAIN EXECUTION)."""
+    mensajes = []
+
+    def avisar(nivel, mensaje):
+        mensajes.append({"nivel": nivel, "mensaje": mensaje})
+        actualizar_trabajo(trabajo_id, mensajes=mensajes)
+
+    def progreso(etapa, fraccion, texto):
+        if os.path.exists(_ruta_trabajo(trabajo_id, "cancelar")):
+            raise TrabajoCancelado()
+        actualizar_trabajo(trabajo_id, etapa=etapa, progreso=round(min(fraccion, 1.0), 3), detalle=texto)
+
+    registro = actualizar_trabajo(trabajo_id, estado="ejecutando", pid=os.getpid(), inicio=time.time())
+    iniciar_medicion(trabajo_id, registro.get("usuario"), origen="consolidacion")
+    try:
+        rutas = [_ruta_trabajo(trabajo_id, nombre) for nombre in ["archivo1.xlsx", "archivo2.xlsx"]]
+        rutas = [ruta if os.path.exists(ruta) else None for ruta in rutas]
+        progreso("Lectura Archivo 1", 0.0, "Iniciando")
+        procesar_consolidacion(rutas[0], rutas[1], avisar=avisar, progreso=progreso,
+                               incremental=registro.get("incremental", False), claves_dedup=registro.get("claves_dedup"),
+                               directorio_tmp=_ruta_trabajo(trabajo_id))
+        actualizar_trabajo(trabajo_id, estado="terminado", etapa="Terminado", progreso=1.0, detalle="", fin=time.time())
+    except TrabajoCancelado:
+        actualizar_trabajo(trabajo_id, estado="cancelado", etapa="Cancelado", detalle="", fin=time.time())
     except Exception as e:
-        st.error(f"Error leyendo archivos: {e}")
-        return st.session_state.get('df')
+        actualizar_trabajo(trabajo_id, estado="error", etapa="Error", error=str(e), fin=time.time())
+    finally:
+        for ruta in ["archivo1.xlsx", "archivo2.xlsx"]:
+            if os.path.exists(_ruta_trabajo(trabajo_id, ruta)):
+                os.remove(_ruta_trabajo(trabajo_id, ruta))
+        if os.path.exists(_ruta_trabajo(trabajo_id, ".archivo_consolidado.tmp.xlsx")):
+            os.remove(_ruta_trabajo(trabajo_id, ".archivo_consolidado.tmp.xlsx"))
+        cerrar_medicion()
+
+@st.fragment(run_every=2)
+def render_trabajo_consolidacion():
+    trabajo = ultimo_trabajo()
+    if not trabajo:
+        return
+
+    estado = trabajo.get("estado")
+    if estado in ESTADOS_ACTIVOS:
+        st.progress(trabajo.get("progreso", 0.0), text=f"⏳ {trabajo.get('etapa', '')} — {trabajo.get('detalle', '')}")
+        st.caption("Los demás usuarios siguen trabajando con la versión anterior hasta que termine.")
+        if st.button("⛔ Cancelar consolidación", key=f"cancelar_{trabajo['id']}"):
+            cancelar_trabajo(trabajo["id"])
+    elif estado == "terminado":
+        st.success(f"✅ Última consolidación terminada ({trabajo['id']}).")
+    elif estado == "cancelado":
+        st.warning("La última consolidación fue cancelada.")
+    else:
+        st.error(f"Error en la consolidación: {trabajo.get('error', '')}")
+
+    for m in trabajo.get("mensajes", []):
+        avisar_streamlit(m["nivel"], m["mensaje"])
+
+    # Al terminar el trabajo lanzado en esta sesión, recargar la app con los datos nuevos
+    if estado not in ESTADOS_ACTIVOS and st.session_state.get("trabajo_pendiente") == trabajo["id"]:
+        st.session_state.trabajo_pendiente = None
+        st.rerun()
+
+# ===================== DATASET COMPARTIDO =====================
+def version_dataset():
+    """Huella (mtime, tamaño) de la base y sus partes incrementales. Solo cambia cuando se consolida."""
+    rutas = [ARCHIVO_BASE, ARCHIVO_BASE_LEGACY] + rutas_incrementos()
+    version = []
+    for ruta in rutas:
+        if os.path.exists(ruta):
+            info = os.stat(ruta)
+            version.append((ruta, info.st_mtime_ns, info.st_size))
+    return tuple(version)
+
+@st.cache_resource(max_entries=1, show_spinner="Cargando datos...")
+def cargar_dataset_compartido(version):
+    """Carga el dataset una vez por proceso y lo comparte entre todas las sesiones.
+
+    La base es el único dataset: filtros y desplegables salen de ella (el XLSX consolidado
+    solo se usa para descargar). El resultado es de solo lectura: quien necesite modificarlo
+    debe trabajar sobre una copia.
+    """
+    df = ordenar_por_fecha(cargar_excel())
+    return {"version": version, "df": df, "claves": preparar_dataset(df), "opciones": cargar_opciones(df)}
+
+def codificar_clave(serie):
+    """Normaliza (strip + lower) y codifica una columna como categórica: códigos int32 + categorías.
+
+    Solo se normalizan los valores únicos, no cada fila.
+    """
+    if isinstance(serie, pd.DataFrame): serie = serie.iloc[:, 0]
+    codigos, unicos = pd.factorize(serie, use_na_sentinel=False)
+    normalizados = pd.Index(unicos).astype(str).str.strip().str.lower()
+    codigos_norm, categorias = pd.factorize(normalizados)
+    return {"codigos": codigos_norm[codigos].astype(np.int32), "categorias": pd.Index(categorias)}
+
+def preparar_dataset(df):
+    """Construye una vez por dataset las claves categóricas usadas por los filtros."""
+    claves = {}
+    if df is None:
+        return claves
+
+    esquema = resolver_esquema(df)
+    for rol in ["profesional", "procedimiento", "ciudad"]:
+        col = esquema[rol]
+        if col:
+            claves[rol] = codificar_clave(df[col])
+            claves[rol]["columna"] = col
+
+    col_fecha = esquema["fecha"]
+    if col_fecha:
+        fechas = df[col_fecha]
+        if not pd.api.types.is_datetime64_any_dtype(fechas):
+            fechas = pd.to_datetime(fechas, errors="coerce", dayfirst=True, format="mixed")
+        valores = fechas.to_numpy(dtype=fechas.dtype)
+        n_validas, ordenado = _orden_fechas(valores)
+        claves["fecha"] = {"columna": col_fecha, "valores": valores, "n_validas": n_validas, "ordenado": ordenado}
+    return claves
+
+def _orden_fechas(valores):
+    """(cantidad de fechas válidas, si están ordenadas con los NaT al final)."""
+    n_validas = int((~np.isnat(valores)).sum())
+    ordenado = bool(np.isnat(valores[n_validas:]).all() and pd.Index(valores[:n_validas]).is_monotonic_increasing)
+    return n_validas, ordenado
+
+def ordenar_por_fecha(df):
+    """Convierte la columna de fecha a datetime64 una sola vez y ordena el dataset por ella.
+
+    Así los filtros de rango de fechas se resuelven con búsqueda binaria (ver filtrar_datos).
+    Una base guardada por la consolidación ya viene así y se devuelve sin copiar.
+    """
+    if df is None:
+        return df
+    col_fecha = resolver_esquema(df)["fecha"]
+    if not col_fecha:
+        return df
+    if not pd.api.types.is_datetime64_any_dtype(df[col_fecha]):
+        df = df.copy()
+        df[col_fecha] = pd.to_datetime(df[col_fecha], errors="coerce", dayfirst=True, format="mixed")
+    if ORDENAR_POR_FECHA and not _orden_fechas(df[col_fecha].to_numpy(dtype=df[col_fecha].dtype))[1]:
+        df = df.sort_values(col_fecha, kind="stable", na_position="last", ignore_index=True)
+    return df
+
+def canonizar_dataset(df):
+    """Forma canónica de la base: columnas con rol resueltas y filas ordenadas por fecha.
+
+    La fecha queda como datetime64 y la ciudad/sede sin espacios sobrantes. Se aplica al
+    consolidar (y a los dos lados de una carga incremental), así la carga no repite trabajo.
+    Es idempotente.
+    """
+    if df is None or df.empty:
+        return df
+    col_ciudad = resolver_esquema(df)["ciudad"]
+    if col_ciudad and es_columna_texto(df[col_ciudad]):
+        df = df.copy()
+        df[col_ciudad] = df[col_ciudad].str.strip()
+    return ordenar_por_fecha(df)
 
 # ===================== HELPERS DROPDOWNS =====================
-def get_dropdown_options(df, keywords):
+ROLES_OPCIONES = ("profesional", "procedimiento", "ciudad")
+
+def get_dropdown_options(df, rol):
     if df is None:
         return []
-    col = next((c for c in df.columns if any(k in str(c).lower() for k in keywords)), None)
+    col = resolver_esquema(df)[rol]
     if col:
         serie = df[col]
         if isinstance(serie, pd.DataFrame): serie = serie.iloc[:, 0]
-        serie = serie.astype(str).str.strip()
-        mapa = {v.lower(): v for v in serie.dropna()}
+        # Únicos en orden inverso: ante variantes de mayúsculas gana la última fila, como antes
+        mapa = {}
+        for v in pd.Series(serie.iloc[::-1].unique()).astype(str).str.strip().dropna():
+            mapa.setdefault(v.lower(), v)
         return sorted(mapa.values())
     return []
 
+def ruta_opciones(nombre_archivo=ARCHIVO_BASE):
+    """Sidecar de metadatos guardado junto a la base: listas de los desplegables."""
+    return f"{os.path.splitext(nombre_archivo)[0]}.opciones.json"
+
+def guardar_opciones(df, nombre_archivo=ARCHIVO_BASE):
+    """Calcula las listas de los desplegables una vez por consolidación y las guarda junto a la base."""
+    opciones = {rol: get_dropdown_options(df, rol) for rol in ROLES_OPCIONES}
+    datos = {"filas": len(df), "bytes": os.path.getsize(nombre_archivo), "opciones": opciones}
+    ruta = ruta_opciones(nombre_archivo)
+    with open(f"{ruta}.tmp", "w", encoding="utf-8") as f:
+        json.dump(datos, f, ensure_ascii=False)
+    os.replace(f"{ruta}.tmp", ruta)
+    return opciones
+
+def anexar_opciones(nuevas, filas_previas, nombre_archivo=ARCHIVO_BASE):
+    """Suma al sidecar los valores de filas agregadas a la base, sin recorrer la base.
+
+    filas_previas son las filas guardadas antes de anexar; si el sidecar no correspondía a esa
+    base se borra y cargar_opciones lo recalcula completo.
+    """
+    ruta = ruta_opciones(nombre_archivo)
+    try:
+        with open(ruta, "r", encoding="utf-8") as f:
+            datos = json.load(f)
+    except:
+        return  # Sin sidecar previo se recalcula al cargar la base
+    if datos["filas"] != filas_previas or datos["bytes"] != os.path.getsize(nombre_archivo):
+        os.remove(ruta)
+        return
+    for rol in ROLES_OPCIONES:
+        # Ante variantes de mayúsculas gana la de las filas nuevas (las últimas de la base)
+        mapa = {v.lower(): v for v in datos["opciones"].get(rol, [])}
+        for v in get_dropdown_options(nuevas, rol):
+            mapa[v.lower()] = v
+        datos["opciones"][rol] = sorted(mapa.values())
+    datos["filas"] += len(nuevas)
+    with open(f"{ruta}.tmp", "w", encoding="utf-8") as f:
+        json.dump(datos, f, ensure_ascii=False)
+    os.replace(f"{ruta}.tmp", ruta)
+
+def cargar_opciones(df, nombre_archivo=ARCHIVO_BASE):
+    """Listas del sidecar si corresponde a la base actual (filas y tamaño); si no, se recalculan."""
+    if df is None:
+        return dict.fromkeys(ROLES_OPCIONES, [])
+    try:
+        with open(ruta_opciones(nombre_archivo), "r", encoding="utf-8") as f:
+            datos = json.load(f)
+        if datos["filas"] == len(df) and datos["bytes"] == os.path.getsize(nombre_archivo):
+            return datos["opciones"]
+    except:
+        pass
+    try:
+        return guardar_opciones(df, nombre_archivo)
+    except:
+        return {rol: get_dropdown_options(df, rol) for rol in ROLES_OPCIONES}
+
 # ===================== FILTROS =====================
-def filtrar_datos(df, nombre_prof, fecha_inicio, fecha_fin, procedimiento, ciudad):
+def filtrar_datos(df, nombre_prof, fecha_inicio, fecha_fin, procedimiento, ciudad, claves=None):
     aviso = ""
     if df is None:
         return pd.DataFrame(), aviso
 
-    df_filtrado = df.copy()
-
-    # Filtro Profesional
-    col_profesional = next((c for c in df.columns if "profesional" in str(c).lower()), None)
-    if nombre_prof and col_profesional:
-        df_filtrado = df_filtrado[df_filtrado[col_profesional].astype(str).str.strip().str.lower() == str(nombre_prof).strip().lower()]
-
-    # Filtro Procedimiento
-    col_procedimiento = next((c for c in df.columns if "nombre procedimiento" in str(c).lower()), None)
-    if procedimiento and col_procedimiento:
-        df_filtrado = df_filtrado[df_filtrado[col_procedimiento].astype(str).str.strip().str.lower() == str(procedimiento).strip().lower()]
-    
-    # Filtro Ciudad
-    col_ciudad = next((c for c in df.columns if "ciudad" in str(c).lower() or "municipio" in str(c).lower()), None)
-    if not col_ciudad:
-        col_ciudad = next((c for c in df.columns if "sede" in str(c).lower()), None)
-        
-    if ciudad and col_ciudad:
-        df_filtrado = df_filtrado[df_filtrado[col_ciudad].astype(str).str.strip().str.lower() == str(ciudad).strip().lower()]
+    # Sin claves precalculadas (ej: llamadas sueltas) se construyen al vuelo
+    if claves is None:
+        claves = preparar_dataset(df)
 
-    # Filtro Fechas
-    col_fecha = next((c for c in df.columns if "fecha" in str(c).lower()), None)
-    if col_fecha:
+    # Filtro Fechas: con la columna ya ordenada es un corte por búsqueda binaria
+    inicio, fin = 0, len(df)
+    mask = None
+    fecha = claves.get("fecha")
+    if fecha is None:
+        aviso += "⚠️ No hay columna de fecha."
+    elif fecha_inicio or fecha_fin:
         try:
-            fechas_series = pd.to_datetime(df_filtrado[col_fecha], errors="coerce", dayfirst=True).dt.date
-            mask = pd.Series(True, index=df_filtrado.index)
-            if fecha_inicio:
-                mask = mask & (fechas_series >= fecha_inicio)
-            if fecha_fin:
-                mask = mask & (fechas_series <= fecha_fin)
-            df_filtrado = df_filtrado[mask]
+            valores = fecha["valores"]
+            desde = np.datetime64(fecha_inicio, "D").astype(valores.dtype) if fecha_inicio else None
+            hasta = (np.datetime64(fecha_fin, "D") + np.timedelta64(1, "D")).astype(valores.dtype) if fecha_fin else None
+            if fecha["ordenado"]:
+                validas = valores[:fecha["n_validas"]]
+                inicio = int(np.searchsorted(validas, desde)) if desde is not None else 0
+                fin = int(np.searchsorted(validas, hasta)) if hasta is not None else len(validas)
+            else:
+                mask = ~np.isnat(valores)
+                if desde is not None:
+                    mask &= valores >= desde
+                if hasta is not None:
+                    mask &= valores < hasta
         except Exception as e:
             aviso += f"⚠️ Error con fechas: {e}"
-    else:
-        aviso += "⚠️ No hay columna de fecha."
-        
+
+    # Filtros Profesional / Procedimiento / Ciudad: comparación de códigos enteros
+    for rol, valor in [("profesional", nombre_prof), ("procedimiento", procedimiento), ("ciudad", ciudad)]:
+        if not valor or rol not in claves:
+            continue
+        clave = claves[rol]
+        codigo = clave["categorias"].get_indexer([str(valor).strip().lower()])[0]
+        mask_rol = clave["codigos"][inicio:fin] == codigo
+        mask = mask_rol if mask is None else mask & mask_rol
+
+    # Sin filtros activos no se copia el DataFrame (se trata como solo lectura)
+    df_filtrado = df if (inicio, fin) == (0, len(df)) else df.iloc[inicio:fin]
+    if mask is not None:
+        df_filtrado = df_filtrado[mask]
+
     return df_filtrado, aviso
 
 def calcular_totales(df):
-    col_valor = next((c for c in df.columns if str(c).strip().lower() == "valor"), None)
-    if not col_valor:
-         col_valor = next((c for c in df.columns if "valor" in str(c).lower()), None)
-    
-    if col_valor:
-        serie = pd.to_numeric(df[col_valor], errors="coerce")
-        total_valor = serie[serie > 0].sum(skipna=True)
-        return total_valor
-    return 0
+    return calcular_agregados(df, ["total"])["total"]
+
+# ===================== AGREGACIONES =====================
+PARTES_AGREGADOS = ("prof_proc", "paciente_proc", "procedimiento", "profesionales", "total")
+PARTES_POR_PESTANA = {  # Lo que consume cada pestaña de análisis; el resto no agrega nada
+    "📊 ANÁLISIS": ("prof_proc", "paciente_proc"),
+    "💰 TOTAL": ("procedimiento", "total"),
+    "🏆 DASHBOARD": ("profesionales",),
+    "✅ CUMPLIMIENTO": ("total",),
+}
+
+def calcular_agregados(df, partes=PARTES_AGREGADOS):
+    """Motor único de agregación para las pestañas y el reporte de filtros.
+
+    El valor (y la cantidad) se convierten a numérico una sola vez y se agrupa sobre esa
+    vista sin copiar el DataFrame. Una parte queda en None si faltan sus columnas.
+    """
+    agregados = dict.fromkeys(partes)
+    if "total" in partes:
+        agregados["total"] = 0
+    if df is None:
+        return agregados
+
+    esquema = resolver_esquema(df)
+    col_prof = esquema["profesional"]
+    col_proc = esquema["procedimiento"]
+    col_val = esquema["valor"]
+    col_pac = esquema["paciente"]
+    col_cant = esquema["cantidad"]
+
+    # Vista numérica compartida por todas las agrupaciones
+    valores_raw = pd.to_numeric(df[col_val], errors="coerce") if col_val else None
+    valores = valores_raw.fillna(0) if col_val else pd.Series(0.0, index=df.index)
+
+    if "total" in partes and col_val:
+        agregados["total"] = valores_raw[valores_raw > 0].sum(skipna=True)
+
+    if "prof_proc" in partes and col_prof and col_proc and col_val:
+        agregados["prof_proc"] = valores.groupby([df[col_prof], df[col_proc]]).agg(
+            Total_Servicios="size",
+            Valor_Total="sum"
+        ).reset_index()
+
+    if "paciente_proc" in partes and col_pac and col_proc:
+        # Con columna cantidad se suma; si no, se cuentan registros
+        if col_cant:
+            cantidades = pd.to_numeric(df[col_cant], errors="coerce").fillna(0)
+        else:
+            cantidades = pd.Series(1, index=df.index)
+        vista = pd.DataFrame({"Cantidad": cantidades, "Valor_Total": valores})
+        agregados["paciente_proc"] = vista.groupby([df[col_pac], df[col_proc]]).sum().reset_index()
+
+    if "procedimiento" in partes and col_proc and col_val:
+        agregados["procedimiento"] = valores.groupby(df[col_proc]).agg(
+            Cantidad="size",
+            Valor_Total="sum"
+        ).reset_index()
+
+    if "profesionales" in partes and col_prof:
+        counts = df[col_prof].value_counts().reset_index()
+        counts.columns = ["Profesional", "Servicios"]
+        agregados["profesionales"] = counts
+
+    return agregados
+
+@st.cache_resource(max_entries=32, show_spinner=False)
+def agregados_filtrados(version, filtros, partes, _df):
+    """Agregados del filtro actual, reutilizados entre reruns mientras no cambien versión ni filtros.
+
+    Sin filtros, lo que cubre el resumen mensual persistido se toma de ahí.
+    Se comparten entre sesiones: quien los modifique debe copiarlos antes.
+    """
+    agregados = agregados_desde_resumen(_df, partes, version) if all(f is None for f in filtros) else {}
+    faltantes = tuple(p for p in partes if p not in agregados)
+    if faltantes:
+        agregados.update(calcular_agregados(_df, faltantes))
+    return agregados
+
+# ===================== TARJETAS POR PROCEDIMIENTO =====================
+TARJETAS_POR_PAGINA = (30, 60, 150)  # Múltiplos de 3: la grilla tiene 3 columnas
+
+ESTILO_GRILLA_TARJETAS = "display: grid; grid-template-columns: repeat(3, minmax(0, 1fr)); gap: 20px; margin-bottom: 20px;"
+ESTILO_TARJETA = "background-color: white; padding: 20px; border-radius: 12px; box-shadow: 0 4px 10px rgba(0,0,0,0.05); border: 1px solid #e0e0e0; border-left: 5px solid #005f73;"
+ESTILO_ETIQUETA_TARJETA = "display: block; color: #888; font-size: 0.8em; text-transform: uppercase; letter-spacing: 0.5px;"
+
+def html_tarjetas(pagina, col_proc):
+    """HTML de una grilla de tarjetas armado por columnas (sin recorrer filas una a una)."""
+    nombres = pagina[col_proc].astype(str).map(html.escape, na_action="ignore")
+    cantidades = pagina["Cantidad"].astype(str)
+    valores = pagina["Valor_Num"].map(formato_pesos)
+    pct = pagina["Participacion"].astype(float)
+    pct_texto = pct.map("{:.1f}".format)
+    ancho = pct.clip(upper=100).astype(str)
+
+    tarjetas = (
+        f'<div style="{ESTILO_TARJETA}">'
+        '<h5 style="color: #005f73; margin-top: 0; font-weight: 700; height: 50px; overflow: hidden; display: -webkit-box; -webkit-line-clamp: 2; -webkit-box-orient: vertical;">'
+        + nombres + '</h5>'
+        '<div style="display: flex; justify-content: space-between; align-items: center; margin-top: 15px; border-top: 1px solid #f0f0f0; padding-top: 10px;">'
+        f'<div><span style="{ESTILO_ETIQUETA_TARJETA}">Frecuencia</span>'
+        '<span style="font-size: 1.2em; font-weight: 600; color: #333;">' + cantidades + '</span></div>'
+        f'<div style="text-align: right;"><span style="{ESTILO_ETIQUETA_TARJETA}">Facturado</span>'
+        '<span style="font-size: 1.2em; font-weight: 600; color: #2ec4b6;">' + valores + '</span></div>'
+        '</div>'
+        '<div style="margin-top: 15px;"><div style="display: flex; justify-content: space-between; margin-bottom: 5px;">'
+        '<span style="font-size: 0.8em; color: #555;">Participación</span>'
+        '<span style="font-size: 0.8em; font-weight: bold; color: #005f73;">' + pct_texto + '%</span></div>'
+        '<div style="background-color: #e0fbfc; height: 6px; border-radius: 3px; width: 100%;">'
+        '<div style="background-color: #005f73; height: 6px; border-radius: 3px; width: ' + ancho + '%;"></div>'
+        '</div></div></div>'
+    )
+    return f'<div style="{ESTILO_GRILLA_TARJETAS}">' + "".join(tarjetas.tolist()) + "</div>"
+
+def render_tarjetas_procedimientos(agrupado, col_proc, clave):
+    """Grilla paginada de tarjetas: un solo elemento por página, ordenado por valor descendente.
+
+    `agrupado` debe venir ordenado y con las columnas Cantidad, Valor_Num y Participacion.
+    """
+    col_t1, col_t2 = st.columns([3, 1])
+    with col_t1:
+        busqueda = st.text_input("Buscar procedimiento", key=f"{clave}_buscar").strip()
+    with col_t2:
+        por_pagina = st.selectbox("Tarjetas", TARJETAS_POR_PAGINA, key=f"{clave}_por_pagina")
+
+    if busqueda:
+        agrupado = agrupado[agrupado[col_proc].astype(str).str.contains(busqueda, case=False, regex=False, na=False)]
+
+    total = len(agrupado)
+    paginas = max(1, -(-total // por_pagina))
+    pagina = st.number_input(f"Página (de {paginas:,})", min_value=1, max_value=paginas, value=1, key=f"{clave}_pagina") - 1
+
+    desde = pagina * por_pagina
+    vista = agrupado.iloc[desde:desde + por_pagina]
+    if vista.empty:
+        st.info("Sin procedimientos para mostrar")
+        return
+    st.markdown(html_tarjetas(vista, col_proc), unsafe_allow_html=True)
+    st.caption(f"Procedimientos {desde + 1:,}–{desde + len(vista):,} de {total:,}")
+
+# ===================== CRUCE DE DATOS =====================
+DIR_CRUCES = "cruces"
+FILAS_POR_PARTICION = 200000  # Tamaño objetivo de cada partición en disco del cruce
+HORAS_VIDA_CRUCE = 12  # Un directorio de cruce sin sesión que lo use se borra pasado este tiempo
+MODOS_CRUCE = {
+    "completa": "Expansión completa (todas las combinaciones)",
+    "tope": "Expansión con tope por fila de A",
+    "primera": "Primera coincidencia en B",
+    "agregada": "Agregado por clave (conteos en A y B)",
+}
+MAX_FILAS_EXPANSION = 2000000  # Por encima de esto no se ofrece la expansión completa
+TOPE_EXPANSION = 10  # Filas de B por fila de A en el modo "tope"
+TOP_CLAVES_REPETIDAS = 10
+FILAS_POR_GRUPO_PARQUET = 10000  # Grupos chicos: el visor lee solo los grupos de la página
+
+def crear_directorio_cruce():
+    os.makedirs(DIR_CRUCES, exist_ok=True)
+    # Los cruces de sesiones registradas los libera su política (inactividad, tope de disco);
+    # aquí solo se borran los huérfanos, con margen para uno recién creado en un rerun en curso
+    registro = registro_sesiones()
+    with registro["lock"]:
+        en_uso = {os.path.abspath(sesion["cruce_dir"]) for sesion in registro["sesiones"].values() if sesion["cruce_dir"]}
+    limite = time.time() - HORAS_VIDA_CRUCE * 3600
+    for viejo in os.listdir(DIR_CRUCES):
+        ruta = os.path.join(DIR_CRUCES, viejo)
+        if os.path.abspath(ruta) in en_uso:
+            continue
+        try:
+            if os.path.getmtime(ruta) < limite:
+                shutil.rmtree(ruta, ignore_errors=True)
+        except OSError:
+            pass
+    ruta = os.path.join(DIR_CRUCES, uuid.uuid4().hex)
+    os.makedirs(ruta)
+    return ruta
+
+def _escribir_bloque(escritores, ruta, df):
+    """Agrega df al Parquet de `ruta` (enteros como int64, el resto como texto), abriendo el escritor la primera vez."""
+    if ruta not in escritores:
+        esquema = pa.schema([(str(c), pa.int64() if pd.api.types.is_integer_dtype(t) else pa.string()) for c, t in df.dtypes.items()])
+        escritores[ruta] = pq.ParquetWriter(ruta, esquema)
+    tabla = pa.Table.from_pandas(df, schema=escritores[ruta].schema, preserve_index=False)
+    escritores[ruta].write_table(tabla, row_group_size=FILAS_POR_GRUPO_PARQUET)
+
+def _cerrar_escritores(escritores):
+    for escritor in escritores.values():
+        escritor.close()
+
+def volcar_xlsx_a_parquet(file_obj, ruta, progreso=None):
+    """Copia la primera hoja de un XLSX a un Parquet de texto, bloque a bloque.
+
+    Así los archivos del cruce quedan en disco y no en st.session_state.
+    """
+    escritores = {}
+    filas = 0
+    try:
+        for bloque in iterar_bloques_xlsx(file_obj, dtype=str, progreso=progreso):
+            bloque = clean_df_for_st(bloque)
+            _escribir_bloque(escritores, ruta, bloque)
+            filas += len(bloque)
+        columnas = list(escritores[ruta].schema.names)
+    finally:
+        _cerrar_escritores(escritores)
+    return {"ruta": ruta, "columnas": columnas, "filas": filas}
+
+def particionar_por_clave(archivo, columnas_clave, directorio, prefijo, particiones):
+    """Reparte un Parquet del cruce en `particiones` archivos según el hash de la clave (una o varias columnas).
+
+    Una clave cae siempre en la misma partición en ambos archivos, así cada par de
+    particiones se cruza por separado. Devuelve la ruta de cada partición (None si quedó vacía).
+    """
+    rutas = [os.path.join(directorio, f"{prefijo}_{i:04d}.parquet") for i in range(particiones)]
+    escritores = {}
+    try:
+        for lote in pq.ParquetFile(archivo["ruta"]).iter_batches(batch_size=FILAS_POR_BLOQUE):
+            bloque = lote.to_pandas()
+            for col in columnas_clave:
+                bloque[col] = bloque[col].astype(str).str.strip()
+            destino = pd.util.hash_pandas_object(bloque[columnas_clave], index=False).to_numpy() % particiones
+            for i, parte in bloque.groupby(destino, sort=False):
+                _escribir_bloque(escritores, rutas[i], parte)
+    finally:
+        _cerrar_escritores(escritores)
+    return [ruta if ruta in escritores else None for ruta in rutas]
+
+def codificar_claves_compuestas(df_a, df_b, columnas_clave):
+    """Códigos int64 de la tupla de claves, compartidos entre A y B.
+
+    Cada columna se factoriza sobre la unión de ambos lados y los códigos se combinan columna a
+    columna (re-factorizando para no desbordar), así la misma tupla tiene el mismo código en A y B.
+    Los vacíos son un valor más, como en pd.merge: sin el centinela -1 no chocan con otra tupla.
+    """
+    codigos = np.zeros(len(df_a) + len(df_b), dtype=np.int64)
+    for col in columnas_clave:
+        codigos_col, categorias = pd.factorize(pd.concat([df_a[col], df_b[col]], ignore_index=True), use_na_sentinel=False)
+        codigos = pd.factorize(codigos * len(categorias) + codigos_col)[0].astype(np.int64)
+    return codigos[:len(df_a)], codigos[len(df_a):]
+
+def cruzar_particion(df_a, df_b, columnas_clave, modo="completa", tope=TOPE_EXPANSION):
+    """Cruce de una partición sobre claves enteras: (coincidencias, solo en A, solo en B).
+
+    Fuera de la expansión completa, las coincidencias crecen como máximo linealmente con A:
+    "tope" y "primera" limitan las filas de B por clave y "agregada" deja una fila por clave.
+    """
+    codigos_a, codigos_b = codificar_claves_compuestas(df_a, df_b, columnas_clave)
+    en_b = np.isin(codigos_a, codigos_b)
+    en_a = np.isin(codigos_b, codigos_a)
+    n_codigos = max(codigos_a.max(initial=-1), codigos_b.max(initial=-1)) + 1
+    registros_a = np.bincount(codigos_a, minlength=n_codigos)
+    registros_b = np.bincount(codigos_b, minlength=n_codigos)
+
+    izquierda = df_a[en_b].assign(_clave_cruce=codigos_a[en_b])
+    if modo == "agregada":
+        claves = izquierda.drop_duplicates("_clave_cruce")
+        codigos = claves["_clave_cruce"].to_numpy()
+        coincidencias = claves[columnas_clave].assign(Registros_A=registros_a[codigos], Registros_B=registros_b[codigos])
+        return coincidencias, df_a[~en_b], df_b[~en_a]
+
+    # Inner join sobre el código entero; las columnas clave se toman de A (son iguales en B)
+    derecha = df_b[en_a].drop(columns=columnas_clave).assign(_clave_cruce=codigos_b[en_a])
+    if modo in ("tope", "primera"):
+        limite = 1 if modo == "primera" else tope
+        derecha = derecha[derecha.groupby("_clave_cruce").cumcount().to_numpy() < limite]
+    coincidencias = pd.merge(izquierda, derecha, on="_clave_cruce", how="inner", suffixes=("_A", "_B"))
+    if modo != "completa":
+        coincidencias["Registros_B"] = registros_b[coincidencias["_clave_cruce"].to_numpy()]
+    return coincidencias.drop(columns="_clave_cruce"), df_a[~en_b], df_b[~en_a]
+
+def _filas_parquet(ruta):
+    return pq.ParquetFile(ruta).metadata.num_rows if ruta else 0
+
+def preparar_cruce(archivo_a, archivo_b, columnas_clave, directorio, progreso=None):
+    """Particiona A y B por la clave y pre-cuenta el resultado de cada modo sin cruzar.
+
+    Con la multiplicidad de cada clave en A y en B la expansión completa tiene
+    sum(registros_a * registros_b) filas, así se detecta de antemano que una clave repetida
+    en ambos lados (p. ej. cédula vacía) va a producir un producto cartesiano.
+    """
+    for ruta in glob.glob(os.path.join(directorio, "[AB]_*.parquet")):
+        os.remove(ruta)
+    particiones = max(1, -(-(archivo_a["filas"] + archivo_b["filas"]) // FILAS_POR_PARTICION))
+
+    if progreso:
+        progreso(0.0, "Particionando Archivo A...")
+    partes_a = particionar_por_clave(archivo_a, columnas_clave, directorio, "A", particiones)
+    if progreso:
+        progreso(0.4, "Particionando Archivo B...")
+    partes_b = particionar_por_clave(archivo_b, columnas_clave, directorio, "B", particiones)
+
+    filas = dict.fromkeys(MODOS_CRUCE, 0)
+    solo_a = 0
+    solo_b = 0
+    repetidas = []
+    for i, (parte_a, parte_b) in enumerate(zip(partes_a, partes_b)):
+        if parte_a is None or parte_b is None:
+            solo_a += _filas_parquet(parte_a)
+            solo_b += _filas_parquet(parte_b)
+            continue
+
+        # Solo se leen las columnas clave
+        claves_a = pd.read_parquet(parte_a, columns=columnas_clave)
+        claves_b = pd.read_parquet(parte_b, columns=columnas_clave)
+        codigos_a, codigos_b = codificar_claves_compuestas(claves_a, claves_b, columnas_clave)
+        n_codigos = max(codigos_a.max(), codigos_b.max()) + 1
+        registros_a = np.bincount(codigos_a, minlength=n_codigos)
+        registros_b = np.bincount(codigos_b, minlength=n_codigos)
+        producto = registros_a * registros_b
+        comunes = producto > 0
+
+        filas["completa"] += int(producto.sum())
+        filas["tope"] += int((registros_a * np.minimum(registros_b, TOPE_EXPANSION)).sum())
+        filas["primera"] += int(registros_a[comunes].sum())
+        filas["agregada"] += int(comunes.sum())
+        solo_a += int(registros_a[~comunes].sum())
+        solo_b += int(registros_b[~comunes].sum())
+
+        # Claves que más filas aportan a la expansión
+        top = np.argsort(producto)[::-1][:TOP_CLAVES_REPETIDAS]
+        top = top[producto[top] > 1]
+        if len(top):
+            unicos, primeras = np.unique(codigos_a, return_index=True)
+            ejemplo = claves_a.iloc[primeras[np.searchsorted(unicos, top)]]
+            repetidas.append(ejemplo.assign(Registros_A=registros_a[top], Registros_B=registros_b[top], Filas_Resultado=producto[top]))
+
+        if progreso:
+            progreso(0.8 + 0.2 * (i + 1) / particiones, f"Contando partición {i + 1} de {particiones}")
+
+    claves_repetidas = pd.concat(repetidas, ignore_index=True).nlargest(TOP_CLAVES_REPETIDAS, "Filas_Resultado") if repetidas else pd.DataFrame()
+    return {
+        "columnas_clave": list(columnas_clave),
+        "columnas_a": archivo_a["columnas"],
+        "columnas_b": archivo_b["columnas"],
+        "partes": list(zip(partes_a, partes_b)),
+        "filas": filas,
+        "solo_en_a": solo_a,
+        "solo_en_b": solo_b,
+        "claves_repetidas": claves_repetidas,
+    }
+
+def ejecutar_cruce(plan, directorio, modo="completa", progreso=None):
+    """Cruce de A contra B según un plan de preparar_cruce, con memoria acotada.
+
+    Los pares de particiones se cruzan de a uno; solo uno está en memoria a la vez. Los
+    resultados (REPETIDOS, NO REPETIDOS y solo en B) quedan como Parquet en `directorio`.
+    """
+    columnas_clave = plan["columnas_clave"]
+    vacio_a = pd.DataFrame(columns=plan["columnas_a"], dtype=str)
+    vacio_b = pd.DataFrame(columns=plan["columnas_b"], dtype=str)
+    plantillas = dict(zip(["coincidencias", "no_en_b", "no_en_a"], cruzar_particion(vacio_a, vacio_b, columnas_clave, modo)))
+    rutas = {nombre: os.path.join(directorio, f"{nombre}.parquet") for nombre in plantillas}
+    conteos = dict.fromkeys(plantillas, 0)
+
+    escritores = {}
+    try:
+        for i, (parte_a, parte_b) in enumerate(plan["partes"]):
+            if parte_a is None and parte_b is None:
+                continue
+            df_a = pd.read_parquet(parte_a) if parte_a else vacio_a
+            df_b = pd.read_parquet(parte_b) if parte_b else vacio_b
+
+            resultados = zip(plantillas, cruzar_particion(df_a, df_b, columnas_clave, modo))
+            for nombre, resultado in resultados:
+                if not resultado.empty:
+                    _escribir_bloque(escritores, rutas[nombre], resultado)
+                    conteos[nombre] += len(resultado)
+
+            if progreso:
+                progreso((i + 1) / len(plan["partes"]), f"Partición {i + 1} de {len(plan['partes'])}")
+
+        # Resultados vacíos: igual dejar el archivo con sus columnas
+        for nombre, plantilla in plantillas.items():
+            if rutas[nombre] not in escritores:
+                _escribir_bloque(escritores, rutas[nombre], plantilla)
+    finally:
+        _cerrar_escritores(escritores)
+
+    return {"columnas_clave": list(columnas_clave), "modo": modo, "rutas": rutas, "conteos": conteos}
+
+@st.cache_resource(max_entries=16, show_spinner=False)
+def _indices_vista(ruta, version, orden, ascendente, busqueda):
+    """Posiciones de las filas que cumplen la búsqueda, en el orden pedido (None = todas, sin orden).
+
+    Solo se guardan enteros; la búsqueda recorre el archivo por lotes y el orden lee una sola columna.
+    """
+    archivo = pq.ParquetFile(ruta)
+    indices = None
+    if busqueda:
+        encontrados = []
+        inicio = 0
+        for lote in archivo.iter_batches(batch_size=FILAS_POR_BLOQUE):
+            coincide = pa.array(np.zeros(lote.num_rows, dtype=bool))
+            for columna in lote.columns:
+                texto = pc.cast(columna, pa.string())
+                coincide = pc.or_(coincide, pc.fill_null(pc.match_substring(texto, busqueda, ignore_case=True), False))
+            encontrados.append(np.flatnonzero(coincide.to_numpy(zero_copy_only=False)) + inicio)
+            inicio += lote.num_rows
+        indices = np.concatenate(encontrados) if encontrados else np.array([], dtype=np.int64)
+    if orden:
+        valores = archivo.read(columns=[orden]).column(0)
+        if indices is not None:
+            valores = valores.take(indices)
+        posiciones = pc.array_sort_indices(valores, order="ascending" if ascendente else "descending").to_numpy().astype(np.int64)
+        indices = posiciones if indices is None else indices[posiciones]
+    return indices
+
+def pagina_parquet(ruta, pagina, filas_por_pagina, orden=None, ascendente=True, busqueda=""):
+    """Una página (DataFrame, total de filas) de un Parquet, leyendo solo los grupos que la contienen."""
+    archivo = pq.ParquetFile(ruta)
+    indices = _indices_vista(ruta, os.path.getmtime(ruta), orden, ascendente, busqueda)
+    total = archivo.metadata.num_rows if indices is None else len(indices)
+
+    desde = pagina * filas_por_pagina
+    hasta = min(desde + filas_por_pagina, total)
+    seleccion = np.arange(desde, hasta) if indices is None else indices[desde:hasta]
+    if len(seleccion) == 0:
+        return archivo.schema_arrow.empty_table().to_pandas(), total
+
+    # Grupos de filas donde caen las posiciones pedidas y posición local dentro de ellos
+    limites = np.cumsum([0] + [archivo.metadata.row_group(i).num_rows for i in range(archivo.num_row_groups)])
+    grupo_de = np.searchsorted(limites, seleccion, side="right") - 1
+    grupos = np.unique(grupo_de)
+    inicio_local = np.cumsum([0] + [limites[g + 1] - limites[g] for g in grupos[:-1]])
+    locales = seleccion - limites[grupo_de] + inicio_local[np.searchsorted(grupos, grupo_de)]
+
+    tabla = archivo.read_row_groups(grupos.tolist())
+    return tabla.take(locales).to_pandas(), total
+
+def render_visor_parquet(ruta, clave):
+    """Visor paginado del lado del servidor: al navegador solo viaja la página actual."""
+    columnas = pq.ParquetFile(ruta).schema_arrow.names
+
+    col_v1, col_v2, col_v3, col_v4 = st.columns([3, 3, 1, 1])
+    with col_v1:
+        busqueda = st.text_input("Buscar", key=f"{clave}_buscar", placeholder="Texto en cualquier columna").strip()
+    with col_v2:
+        orden = st.selectbox("Ordenar por", ["(sin orden)"] + columnas, key=f"{clave}_orden")
+    with col_v3:
+        ascendente = st.toggle("Asc.", value=True, key=f"{clave}_asc")
+    with col_v4:
+        filas_por_pagina = st.selectbox("Filas", [50, 100, 500], key=f"{clave}_filas")
+    orden = None if orden == "(sin orden)" else orden
+
+    total = len(_indices_vista(ruta, os.path.getmtime(ruta), orden, ascendente, busqueda)) if (orden or busqueda) else pq.ParquetFile(ruta).metadata.num_rows
+    paginas = max(1, -(-total // filas_por_pagina))
+    pagina = st.number_input(f"Página (de {paginas:,})", min_value=1, max_value=paginas, value=1, key=f"{clave}_pagina") - 1
+
+    df_pagina, total = pagina_parquet(ruta, pagina, filas_por_pagina, orden, ascendente, busqueda)
+    st.dataframe(df_pagina, hide_index=True, use_container_width=True)
+    st.caption(f"Filas {pagina * filas_por_pagina + min(1, len(df_pagina)):,}–{pagina * filas_por_pagina + len(df_pagina):,} de {total:,}")
+
+def _lotes_parquet(ruta):
+    archivo = pq.ParquetFile(ruta)
+    if archivo.metadata.num_rows == 0:
+        yield archivo.schema_arrow.empty_table().to_pandas()
+    for lote in archivo.iter_batches(batch_size=FILAS_POR_BLOQUE):
+        yield lote.to_pandas()
+
+def exportar_cruce_excel(resultado, ruta):
+    """Escribe el XLSX del cruce a disco leyendo los Parquet por lotes (memoria constante)."""
+    hojas = [(hoja, _lotes_parquet(resultado["rutas"][nombre])) for nombre, hoja in [("coincidencias", "REPETIDOS"), ("no_en_b", "NO REPETIDOS")]]
+    exportar_xlsx(ruta, hojas)
+    return ruta
+
+def excel_cruce_bajo_demanda(resultado, directorio):
+    """Contenido del XLSX del cruce; se genera recién cuando alguien pulsa descargar."""
+    ruta = os.path.join(directorio, f"cruce_{resultado['modo']}.xlsx")
+    if not os.path.exists(ruta):
+        tmp_path = os.path.join(directorio, f".cruce_{resultado['modo']}.tmp.xlsx")
+        exportar_cruce_excel(resultado, tmp_path)
+        os.replace(tmp_path, ruta)
+    with open(ruta, "rb") as f:
+        return f.read()
 
 # ===================== UI LOGIN =====================
 # REMOVED GLOBAL SESSION STATE INIT to avoid top-level execution risks
@@ -541,26 +2147,15 @@ def login():
 
 def set_user_offline(username):
     """Marca a un usuario como desconectado inmediatamente"""
-    try:
-        status_data = {}
-        if os.path.exists(STATUS_FILE):
-            try:
-                with open(STATUS_FILE, "r") as f:
-                    status_data = json.load(f)
-            except:
-                pass
-        
-        # Establecer tiempo en 0 para desconexión inmediata
-        status_data[username] = 0
-        
-        with open(STATUS_FILE, "w") as f:
-            json.dump(status_data, f)
-    except:
-        pass
+    # Establecer tiempo en 0 para desconexión inmediata
+    registrar_presencia(username, 0, guardar=True)
 
 def logout():
     if st.session_state.usuario:
         set_user_offline(st.session_state.usuario)
+    liberar_sesion(st.session_state.id_sesion)
+    for clave in CLAVES_CRUCE:
+        st.session_state.pop(clave, None)
     st.session_state.usuario = None
     st.rerun()
 
@@ -568,10 +2163,11 @@ def eliminar_consolidado():
     try:
         if os.path.exists("archivo_consolidado.xlsx"):
             os.remove("archivo_consolidado.xlsx")
-        if os.path.exists("base_guardada.xlsx"):
-            os.remove("base_guardada.xlsx")
-        st.session_state.df = None
-        st.session_state.df_ciudades = None
+        for ruta in [ARCHIVO_BASE, ARCHIVO_BASE_LEGACY, ARCHIVO_RESUMEN, ruta_opciones()]:
+            if os.path.exists(ruta):
+                os.remove(ruta)
+        shutil.rmtree(DIR_INCREMENTOS, ignore_errors=True)
+        cargar_dataset_compartido.clear()
         st.success("✅ Consolidado eliminado y datos reiniciados.")
         time.sleep(1)
         st.rerun()
@@ -582,31 +2178,49 @@ def eliminar_consolidado():
 USERS_LIST = ["admin", "cristian", "marta"]
 STATUS_FILE = "users_status.json"
 
-def update_user_status(username):
-    try:
-        status_data = {}
-        if os.path.exists(STATUS_FILE):
-            try:
-                with open(STATUS_FILE, "r") as f:
-                    status_data = json.load(f)
-            except:
-                pass
-        
-        status_data[username] = time.time()
-        
-        with open(STATUS_FILE, "w") as f:
-            json.dump(status_data, f)
-    except:
-        pass
+SEGUNDOS_EN_LINEA = 300  # Visto en los últimos 5 minutos = en línea
+SEGUNDOS_ENTRE_GUARDADOS = 30  # Los latidos se acumulan en memoria y se guardan como mucho con esta frecuencia
 
-def get_users_status():
-    status_data = {}
+@st.cache_resource
+def presencia():
+    """Último latido de cada usuario, en memoria y compartido por todas las sesiones del proceso.
+
+    Se inicializa desde STATUS_FILE para no perder el estado al reiniciar el servidor.
+    """
+    vistos = {}
     if os.path.exists(STATUS_FILE):
         try:
             with open(STATUS_FILE, "r") as f:
-                status_data = json.load(f)
+                vistos = json.load(f)
         except:
             pass
+    return {"lock": threading.Lock(), "vistos": vistos, "guardado": time.time()}
+
+def registrar_presencia(username, momento, guardar=False):
+    """Anota el latido en memoria (O(1)); el archivo se reescribe solo cada SEGUNDOS_ENTRE_GUARDADOS."""
+    estado = presencia()
+    with estado["lock"]:
+        estado["vistos"][username] = momento
+        if not guardar and time.time() - estado["guardado"] < SEGUNDOS_ENTRE_GUARDADOS:
+            return
+        estado["guardado"] = time.time()
+        copia = dict(estado["vistos"])
+        # Escritura atómica bajo el lock: nunca hay dos escritores ni un archivo a medio escribir
+        try:
+            tmp_path = f"{STATUS_FILE}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(copia, f)
+            os.replace(tmp_path, STATUS_FILE)
+        except:
+            pass
+
+def update_user_status(username):
+    registrar_presencia(username, time.time())
+
+def get_users_status():
+    estado = presencia()
+    with estado["lock"]:
+        status_data = dict(estado["vistos"])
     
     current_time = time.time()
     results = []
@@ -614,7 +2228,7 @@ def get_users_status():
     for user in USERS_LIST:
         last_seen = status_data.get(user, 0)
         # Si se ha visto en los últimos 5 minutos (300 segundos), está online
-        is_online = (current_time - last_seen) < 300 
+        is_online = (current_time - last_seen) < SEGUNDOS_EN_LINEA 
         results.append({"Usuario": user, "Estado": "En Línea" if is_online else "Desconectado", "Online": is_online})
         
     return pd.DataFrame(results)
@@ -644,6 +2258,219 @@ def render_user_status_panel():
             </div>
             """, unsafe_allow_html=True)
 
+def render_panel_tiempos():
+    ultimos = st.number_input("Últimos reruns", min_value=10, max_value=5000, value=RERUNS_PANEL_TIEMPOS, step=50)
+    registros = leer_tiempos(int(ultimos))
+    if not registros:
+        st.info("Todavía no hay tiempos registrados.")
+        return
+    st.caption(f"{len(registros):,} reruns entre {registros[0].get('momento', '?')} y {registros[-1].get('momento', '?')}")
+    st.dataframe(
+        resumen_tiempos(registros),
+        column_config={
+            "p50 ms": st.column_config.NumberColumn("p50 ms", format="%.1f"),
+            "p95 ms": st.column_config.NumberColumn("p95 ms", format="%.1f"),
+            "Máx ms": st.column_config.NumberColumn("Máx ms", format="%.1f"),
+            "Filas p50": st.column_config.NumberColumn("Filas p50", format="%d"),
+        },
+        hide_index=True,
+        use_container_width=True
+    )
+
+# ===================== MEMORIA DE SESIONES =====================
+MAX_MB_DISCO_CRUCES = 4096  # Disco de cruces de todas las sesiones; por encima se liberan los menos recientes
+MINUTOS_SESION_INACTIVA = 60  # Una sesión inactiva por más tiempo pierde su cruce en disco
+CLAVES_CRUCE = ("cruce_archivos", "cruce_plan", "cruce_resultado", "cruce_dir")
+
+def tamano_profundo(obj, vistos=None):
+    """Bytes aproximados de un objeto y de lo que contiene (DataFrames con memory_usage(deep=True))."""
+    vistos = set() if vistos is None else vistos
+    if id(obj) in vistos:
+        return 0
+    vistos.add(id(obj))
+    if isinstance(obj, pd.DataFrame):
+        return int(obj.memory_usage(deep=True).sum())
+    if isinstance(obj, (pd.Series, pd.Index)):
+        return int(obj.memory_usage(deep=True))
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, io.BytesIO):  # Incluye los archivos subidos (UploadedFile)
+        with obj.getbuffer() as buffer:
+            return buffer.nbytes
+    tamano = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        tamano += sum(tamano_profundo(k, vistos) + tamano_profundo(v, vistos) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        tamano += sum(tamano_profundo(v, vistos) for v in obj)
+    return tamano
+
+def tamano_directorio(ruta):
+    total = 0
+    for raiz, _, archivos in os.walk(ruta):
+        for nombre in archivos:
+            try:
+                total += os.path.getsize(os.path.join(raiz, nombre))
+            except OSError:
+                pass
+    return total
+
+def rss_proceso_mb():
+    """Memoria residente actual del proceso en MB (None si el sistema no la expone)."""
+    try:
+        with open("/proc/self/status") as f:
+            for linea in f:
+                if linea.startswith("VmRSS:"):
+                    return int(linea.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+@st.cache_resource
+def registro_sesiones():
+    """Uso de memoria y disco que publica cada sesión en cada rerun, compartido por todo el proceso."""
+    return {"lock": threading.Lock(), "sesiones": {}}
+
+def _directorios_a_liberar(sesiones, id_actual):
+    """Aplica inactividad y tope de disco sobre el registro (con el lock tomado). Devuelve rutas a borrar."""
+    ahora = time.time()
+    liberar = []
+    for id_sesion, sesion in list(sesiones.items()):
+        if id_sesion != id_actual and not sesion["ejecutando"] and ahora - sesion["ultimo"] > MINUTOS_SESION_INACTIVA * 60:
+            if sesion["cruce_dir"]:
+                liberar.append(sesion["cruce_dir"])
+            del sesiones[id_sesion]
+
+    # Tope de disco: se liberan primero los cruces de las sesiones usadas hace más tiempo
+    total = sum(sesion["disco"] for sesion in sesiones.values())
+    for id_sesion, sesion in sorted(sesiones.items(), key=lambda item: item[1]["ultimo"]):
+        if total <= MAX_MB_DISCO_CRUCES * 1024 * 1024:
+            break
+        if id_sesion == id_actual or sesion["ejecutando"] or not sesion["cruce_dir"]:
+            continue
+        liberar.append(sesion["cruce_dir"])
+        total -= sesion["disco"]
+        sesion["cruce_dir"], sesion["disco"] = None, 0
+    return liberar
+
+def contabilizar_sesion(id_sesion, usuario):
+    """Mide el estado de la sesión actual, aplica los topes de inactividad y disco y publica el uso.
+
+    La sesión solo guarda rutas, conteos y widgets: lo que crece (datos, reportes, páginas del visor,
+    agregados de filtros) vive en los caches del proceso, cada uno con su propio tope.
+
+    Devuelve la lista de lo que se liberó de esta sesión (para avisarle al usuario).
+    """
+    liberadas = []
+    # El cruce pudo haberse liberado desde otra sesión (inactividad o tope de disco)
+    cruce_dir = st.session_state.get("cruce_dir")
+    if cruce_dir and not os.path.isdir(cruce_dir):
+        for clave in CLAVES_CRUCE:
+            st.session_state.pop(clave, None)
+        liberadas.append("el último cruce de datos")
+
+    objetos = {clave: tamano_profundo(st.session_state[clave]) for clave in list(st.session_state.keys())}
+
+    cruce_dir = st.session_state.get("cruce_dir")
+    registro = registro_sesiones()
+    with registro["lock"]:
+        registro["sesiones"][id_sesion] = {
+            "usuario": usuario,
+            "ultimo": time.time(),
+            "ejecutando": True,
+            "memoria": objetos,
+            "cruce_dir": cruce_dir,
+            "disco": tamano_directorio(cruce_dir) if cruce_dir else 0,
+        }
+        liberar = _directorios_a_liberar(registro["sesiones"], id_sesion)
+    for ruta in liberar:
+        shutil.rmtree(ruta, ignore_errors=True)
+    return liberadas
+
+def terminar_rerun_sesion(id_sesion):
+    """Marca el fin del rerun: desde ahora la sesión cuenta como inactiva para la política.
+
+    También actualiza su cruce en disco, que pudo crearse o cambiar durante este rerun.
+    """
+    cruce_dir = st.session_state.get("cruce_dir")
+    disco = tamano_directorio(cruce_dir) if cruce_dir else 0
+    registro = registro_sesiones()
+    with registro["lock"]:
+        sesion = registro["sesiones"].get(id_sesion)
+        if sesion is not None:
+            sesion["ejecutando"] = False
+            sesion["ultimo"] = time.time()
+            sesion["cruce_dir"], sesion["disco"] = cruce_dir, disco
+
+def liberar_sesion(id_sesion):
+    """Al cerrar sesión: borra su cruce en disco y la saca del registro."""
+    registro = registro_sesiones()
+    with registro["lock"]:
+        sesion = registro["sesiones"].pop(id_sesion, None)
+    if sesion and sesion["cruce_dir"]:
+        shutil.rmtree(sesion["cruce_dir"], ignore_errors=True)
+
+def render_panel_memoria():
+    registro = registro_sesiones()
+    with registro["lock"]:
+        sesiones = {id_sesion: dict(sesion) for id_sesion, sesion in registro["sesiones"].items()}
+
+    ahora = time.time()
+    filas = []
+    objetos = []
+    for id_sesion, sesion in sesiones.items():
+        memoria = sesion["memoria"]
+        mayor = max(memoria, key=memoria.get) if memoria else ""
+        filas.append({
+            "Usuario": sesion["usuario"],
+            "Sesión": id_sesion,
+            "Inactiva (min)": 0.0 if sesion["ejecutando"] else (ahora - sesion["ultimo"]) / 60,
+            "Memoria MB": sum(memoria.values()) / 1024 / 1024,
+            "Objeto más grande": mayor,
+            "Disco cruce MB": sesion["disco"] / 1024 / 1024,
+        })
+        objetos += [{"Usuario": sesion["usuario"], "Sesión": id_sesion, "Clave": clave, "MB": tamano / 1024 / 1024}
+                    for clave, tamano in memoria.items()]
+
+    # Lo compartido por el proceso: dataset y reportes se cuentan una sola vez
+    dataset = cargar_dataset_compartido(version_dataset())
+    rss = rss_proceso_mb()
+    col_m1, col_m2, col_m3, col_m4 = st.columns(4)
+    with col_m1:
+        st.metric("Memoria del proceso", f"{rss:,.0f} MB" if rss is not None else "n/d")
+    with col_m2:
+        st.metric("Dataset compartido", f"{tamano_profundo(dataset) / 1024 / 1024:,.0f} MB")
+    with col_m3:
+        st.metric("Reportes en cache", f"{cache_reportes()['bytes'] / 1024 / 1024:,.0f} MB")
+    with col_m4:
+        st.metric("Disco de cruces", f"{sum(f['Disco cruce MB'] for f in filas):,.0f} MB")
+
+    if not filas:
+        st.info("No hay sesiones registradas.")
+        return
+    tabla = pd.DataFrame(filas).sort_values(["Memoria MB", "Disco cruce MB"], ascending=False)
+    formato_mb = st.column_config.NumberColumn(format="%.2f")
+    st.markdown("**Por usuario**")
+    st.dataframe(
+        tabla.groupby("Usuario", as_index=False).agg(**{
+            "Sesiones": ("Sesión", "size"),
+            "Memoria MB": ("Memoria MB", "sum"),
+            "Disco cruce MB": ("Disco cruce MB", "sum"),
+        }),
+        column_config={"Memoria MB": formato_mb, "Disco cruce MB": formato_mb},
+        hide_index=True, use_container_width=True
+    )
+    st.markdown("**Por sesión**")
+    st.dataframe(
+        tabla,
+        column_config={"Memoria MB": formato_mb, "Disco cruce MB": formato_mb, "Inactiva (min)": st.column_config.NumberColumn(format="%.1f")},
+        hide_index=True, use_container_width=True
+    )
+    with st.expander("Detalle por objeto de sesión"):
+        st.dataframe(pd.DataFrame(objetos).sort_values("MB", ascending=False), column_config={"MB": formato_mb},
+                     hide_index=True, use_container_width=True)
+    st.caption(f"Topes: {MAX_MB_CACHE_REPORTES:,} MB de reportes en cache, {MAX_MB_DISCO_CRUCES:,} MB de disco de cruces, "
+               f"{MINUTOS_SESION_INACTIVA} min de inactividad.")
+
 # ===================== APP PRINCIPAL =====================
 def main_app():
     load_css()
@@ -655,6 +2482,11 @@ def main_app():
     # Actualizar estado de usuario activo
     if st.session_state.usuario:
         update_user_status(st.session_state.usuario)
+
+    # Memoria de la sesión: se mide en cada rerun y se libera lo que exceda los topes
+    liberadas = contabilizar_sesion(st.session_state.id_sesion, st.session_state.usuario)
+    if liberadas:
+        st.toast(f"🧹 Se liberó {', '.join(liberadas)} para ahorrar espacio.")
     
     # --- MENSAJE BIENVENIDA (JS 10s) ---
     if 'welcome_shown' not in st.session_state:
@@ -704,24 +2536,16 @@ def main_app():
     
     st.markdown("---")
     
-    # --- CARGAR DATOS EN MEMORIA ---
-    if 'df' not in st.session_state or st.session_state.df is None:
-        try:
-            st.session_state.df = cargar_excel()
-            if os.path.exists("archivo_consolidado.xlsx"):
-                 try:
-                     df_c = pd.read_excel("archivo_consolidado.xlsx", engine="openpyxl")
-                     st.session_state.df_ciudades = clean_df_for_st(df_c)
-                 except:
-                     st.session_state.df_ciudades = st.session_state.df
-            else:
-                 st.session_state.df_ciudades = st.session_state.df
-        except Exception as e:
-            st.error(f"Error cargando datos iniciales: {e}")
-            st.session_state.df = None
-            st.session_state.df_ciudades = None
+    # --- CARGAR DATOS (una sola copia compartida por todas las sesiones) ---
+    try:
+        with medir_fase("carga_datos") as fase:
+            dataset = cargar_dataset_compartido(version_dataset())
+            fase["filas"] = len(dataset["df"]) if dataset["df"] is not None else 0
+    except Exception as e:
+        st.error(f"Error cargando datos iniciales: {e}")
+        dataset = {"version": None, "df": None, "claves": {}, "opciones": dict.fromkeys(ROLES_OPCIONES, [])}
 
-    df = st.session_state.df
+    df = dataset["df"]
 
     # --- FILTROS (Mover arriba para tener df_filtrado y botones disponibles) ---
     # Nota: Los filtros se renderizan en Sidebar, pero la lógica de filtrado se ejecuta aquí
@@ -729,12 +2553,10 @@ def main_app():
     
     st.sidebar.header("🔍 Filtros de Análisis")
     
-    profs = get_dropdown_options(df, ["profesional"])
-    procs = get_dropdown_options(df, ["nombre procedimiento"])
-    ciudades_df = st.session_state.get('df_ciudades', df)
-    ciuds = get_dropdown_options(ciudades_df, ["ciudad", "municipio"])
-    if not ciuds:
-         ciuds = get_dropdown_options(ciudades_df, ["sede"])
+    # Listas precalculadas al consolidar: no dependen de la cantidad de filas
+    profs = dataset["opciones"]["profesional"]
+    procs = dataset["opciones"]["procedimiento"]
+    ciuds = dataset["opciones"]["ciudad"]
     
     sel_prof = st.sidebar.selectbox("Profesional", ["Todos"] + profs)
     sel_proc = st.sidebar.selectbox("Procedimiento", ["Todos"] + procs)
@@ -750,11 +2572,18 @@ def main_app():
     proc_arg = sel_proc if sel_proc != "Todos" else None
     ciud_arg = sel_ciud if sel_ciud != "Todos" else None
     
-    df_filtrado, aviso = filtrar_datos(df, prof_arg, f_ini, f_fin, proc_arg, ciud_arg)
+    with medir_fase("filtrar_datos") as fase:
+        df_filtrado, aviso = filtrar_datos(df, prof_arg, f_ini, f_fin, proc_arg, ciud_arg, claves=dataset.get("claves"))
+        fase["filas"] = len(df_filtrado)
     
     if aviso:
         st.sidebar.warning(aviso)
 
+    # Roles de columnas (memoizado: df y df_filtrado comparten columnas)
+    esquema = resolver_esquema(df)
+
+    filtros = (prof_arg, f_ini, f_fin, proc_arg, ciud_arg)
+
     # --- INFO ESTADO Y DESCARGAS (SUPERIOR) ---
     fecha_update = cargar_fecha_actualizacion()
     
@@ -766,10 +2595,17 @@ def main_app():
         if os.path.exists("archivo_consolidado.xlsx"):
             with open("archivo_consolidado.xlsx", "rb") as f:
                 st.download_button("📥 Descargar Consolidado", f, file_name="archivo_consolidado.xlsx", use_container_width=True)
+        elif df is not None and st.button("📦 Preparar Consolidado", use_container_width=True):
+            # Tras una carga incremental el XLSX se regenera recién cuando alguien lo pide
+            with st.spinner("Generando consolidado..."), medir_fase("consolidado_xlsx", len(df)):
+                preparar_consolidado(df)
+            st.rerun()
     with col_btn2:
         if not df_filtrado.empty:
-            excel_data = generar_excel_filtros(df_filtrado, prof_arg, f_ini, f_fin, proc_arg, ciud_arg)
-            st.download_button("📊 Descargar Filtros", excel_data, file_name="reporte_filtrado.xlsx", mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", use_container_width=True)
+            # El reporte se genera recién al pulsar descargar y se reutiliza para los mismos filtros
+            version = dataset["version"]
+            st.download_button("📊 Descargar Filtros", data=lambda: obtener_reporte_filtros(version, filtros, df_filtrado),
+                               file_name="reporte_filtrado.xlsx", mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", use_container_width=True)
 
     # --- VALIDACIÓN DE DATOS ---
     if df is None:
@@ -784,7 +2620,8 @@ def main_app():
         tabs_names.insert(0, "📂 CONSOLIDACIÓN")
         tabs_names.insert(0, "👥 USUARIOS")
     
-    tabs = st.tabs(tabs_names)
+    # Con on_change="rerun" cada pestaña sabe si está abierta y solo esa se calcula
+    tabs = st.tabs(tabs_names, key="pestana_activa", on_change="rerun")
     
     # Asignar variables a tabs
     if st.session_state.usuario == "admin":
@@ -802,16 +2639,28 @@ def main_app():
         tab4 = tabs[3]
         tab_cruces = tabs[4]
     
+    # Agregaciones del filtro actual: solo las partes que usa la pestaña abierta
+    pestana = next((nombre for nombre, tab in zip(tabs_names, tabs) if tab.open), None)
+    partes = PARTES_POR_PESTANA.get(pestana, ())
+    with medir_fase("agregados", len(df_filtrado)):
+        agregados = agregados_filtrados(dataset["version"], filtros, partes, df_filtrado) if partes else {}
+    
     # TAB USUARIOS (Solo Admin)
-    if st.session_state.usuario == "admin":
-        with tab_users:
+    if st.session_state.usuario == "admin" and tab_users.open:
+        with tab_users, medir_fase("pestaña USUARIOS"):
             st.subheader("👥 Gestión de Usuarios y Estado")
             # Panel auto-actualizable cada 5 segundos
             render_user_status_panel()
 
+            st.subheader("⏱️ Tiempos por Fase")
+            render_panel_tiempos()
+
+            st.subheader("🧠 Memoria por Sesión")
+            render_panel_memoria()
+
     # TAB CONSOLIDACIÓN (Solo Admin)
-    if st.session_state.usuario == "admin":
-        with tab_consol:
+    if st.session_state.usuario == "admin" and tab_consol.open:
+        with tab_consol, medir_fase("pestaña CONSOLIDACIÓN"):
             st.subheader("Gestión de Archivos")
             st.markdown("Cargue los archivos para consolidar o actualizar la base de datos.")
             col_f1, col_f2 = st.columns(2)
@@ -819,160 +2668,199 @@ def main_app():
                 archivo1 = st.file_uploader("Archivo 1 (Base Principal)", type=["xlsx"])
             with col_f2:
                 archivo2 = st.file_uploader("Archivo 2 (Información Complementaria)", type=["xlsx"])
+                if not archivo2 and ruta_tarifario_actual():
+                    st.caption(f"📑 Sin Archivo 2 se usa el tarifario guardado ({os.path.basename(ruta_tarifario_actual())}).")
             
+            trabajo = ultimo_trabajo()
+            trabajo_activo = trabajo is not None and trabajo.get("estado") in ESTADOS_ACTIVOS
+
+            # Carga incremental: agregar solo filas nuevas a la base existente
+            incremental = False
+            claves_dedup = []
+            if df is not None:
+                incremental = st.toggle("➕ Carga incremental (agregar solo filas nuevas a la base actual)")
+                if incremental:
+                    columnas_base = [str(c) for c in df.columns]
+                    claves_dedup = st.multiselect(
+                        "Columnas clave para detectar filas repetidas",
+                        columnas_base,
+                        default=[c for c in cargar_claves_dedup(df) if c in columnas_base]
+                    )
+
             col_act1, col_act2 = st.columns(2)
             with col_act1:
                 if archivo1:
-                    if st.button("🔄 Procesar y Consolidar Archivos"):
-                        leer_excel(archivo1, archivo2)
+                    if st.button("🔄 Procesar y Consolidar Archivos", disabled=trabajo_activo or (incremental and not claves_dedup)):
+                        if incremental:
+                            guardar_claves_dedup(claves_dedup)
+                        st.session_state.trabajo_pendiente = iniciar_trabajo_consolidacion(archivo1, archivo2, st.session_state.usuario, incremental, claves_dedup)
                         st.rerun()
             with col_act2:
-                if os.path.exists("archivo_consolidado.xlsx") or os.path.exists("base_guardada.xlsx"):
-                     if st.button("🗑️ Eliminar Consolidado Totalmente"):
+                if os.path.exists("archivo_consolidado.xlsx") or os.path.exists(ARCHIVO_BASE) or os.path.exists(ARCHIVO_BASE_LEGACY):
+                     if st.button("🗑️ Eliminar Consolidado Totalmente", disabled=trabajo_activo):
                          eliminar_consolidado()
+
+            # Estado del trabajo de consolidación (se actualiza solo cada 2 segundos)
+            render_trabajo_consolidacion()
     
     # TAB CRUCES DE DATOS
-    with tab_cruces:
-        st.subheader("🔄 Cruce de Información")
-        st.markdown("Suba dos archivos para comparar registros y encontrar coincidencias o diferencias.")
+    if tab_cruces.open:
+        with tab_cruces, medir_fase("pestaña CRUCES"):
+            st.subheader("🔄 Cruce de Información")
+            st.markdown("Suba dos archivos para comparar registros y encontrar coincidencias o diferencias.")
         
-        col_cruce1, col_cruce2 = st.columns(2)
-        with col_cruce1:
-            file_cruce1 = st.file_uploader("Archivo A (Base)", type=["xlsx"], key="cruce1")
-        with col_cruce2:
-            file_cruce2 = st.file_uploader("Archivo B (Comparar)", type=["xlsx"], key="cruce2")
+            col_cruce1, col_cruce2 = st.columns(2)
+            with col_cruce1:
+                file_cruce1 = st.file_uploader("Archivo A (Base)", type=["xlsx"], key="cruce1")
+            with col_cruce2:
+                file_cruce2 = st.file_uploader("Archivo B (Comparar)", type=["xlsx"], key="cruce2")
             
-        # Gestión de Estado de Archivos Cargados
-        if 'cruce_df1' not in st.session_state:
-            st.session_state.cruce_df1 = None
-        if 'cruce_df2' not in st.session_state:
-            st.session_state.cruce_df2 = None
+            # Gestión de Estado de Archivos Cargados (los datos viven en disco, no en la sesión)
+            if 'cruce_archivos' not in st.session_state:
+                st.session_state.cruce_archivos = None
             
-        if file_cruce1 and file_cruce2:
-            # Botón para Cargar (solo si no están cargados o si cambian archivos)
-            # Nota: Streamlit reinicia file_uploader si se recarga la página, 
-            # pero aquí queremos persistencia durante la sesión de análisis.
+            if file_cruce1 and file_cruce2:
+                # Botón para Cargar (solo si no están cargados o si cambian archivos)
+                # Nota: Streamlit reinicia file_uploader si se recarga la página, 
+                # pero aquí queremos persistencia durante la sesión de análisis.
             
-            if st.button("📥 Cargar Archivos para Análisis"):
-                try:
-                    with st.spinner("Leyendo archivos grandes... esto puede tardar unos momentos..."):
-                        gc.collect()
+                if st.button("📥 Cargar Archivos para Análisis"):
+                    try:
+                        with st.spinner("Leyendo archivos grandes... esto puede tardar unos momentos..."):
+                            gc.collect()
                         
-                        # Leer y guardar en Session State
-                        st.session_state.cruce_df1 = pd.read_excel(file_cruce1, engine="openpyxl", dtype=str)
-                        st.session_state.cruce_df2 = pd.read_excel(file_cruce2, engine="openpyxl", dtype=str)
+                            # Descartar el análisis anterior de esta sesión
+                            if st.session_state.get('cruce_dir'):
+                                shutil.rmtree(st.session_state.cruce_dir, ignore_errors=True)
+                            st.session_state.pop('cruce_resultado', None)
+                            st.session_state.pop('cruce_plan', None)
+                            directorio = crear_directorio_cruce()
+                            st.session_state.cruce_dir = directorio
                         
-                        st.session_state.cruce_df1 = clean_df_for_st(st.session_state.cruce_df1)
-                        st.session_state.cruce_df2 = clean_df_for_st(st.session_state.cruce_df2)
+                            # Volcar cada archivo a Parquet bloque a bloque
+                            archivo_a = volcar_xlsx_a_parquet(file_cruce1, os.path.join(directorio, "A.parquet"), progreso=barra_progreso("Archivo A"))
+                            archivo_b = volcar_xlsx_a_parquet(file_cruce2, os.path.join(directorio, "B.parquet"), progreso=barra_progreso("Archivo B"))
+                            st.session_state.cruce_archivos = (archivo_a, archivo_b)
                         
-                        st.success(f"Archivos cargados en memoria: {st.session_state.cruce_df1.shape[0]} filas en A, {st.session_state.cruce_df2.shape[0]} filas en B")
+                            st.success(f"Archivos preparados para el cruce: {archivo_a['filas']} filas en A, {archivo_b['filas']} filas en B")
                         
-                except Exception as e:
-                    st.error(f"Error cargando archivos: {e}")
+                    except Exception as e:
+                        st.session_state.cruce_archivos = None
+                        st.error(f"Error cargando archivos: {e}")
+            
+            # Si ya hay datos preparados, mostrar opciones de cruce
+            if st.session_state.cruce_archivos is not None:
+                archivo_a, archivo_b = st.session_state.cruce_archivos
+            
+                common_cols = [c for c in archivo_a["columnas"] if c in set(archivo_b["columnas"])]
             
-            # Si ya hay datos en memoria, mostrar opciones de cruce
-            if st.session_state.cruce_df1 is not None and st.session_state.cruce_df2 is not None:
-                df_c1 = st.session_state.cruce_df1
-                df_c2 = st.session_state.cruce_df2
-                
-                common_cols = list(set(df_c1.columns) & set(df_c2.columns))
-                
                 if common_cols:
-                    col_key = st.selectbox("Seleccione columna clave para cruzar (ej: Cédula, Código)", common_cols)
-                    
-                    # Botón para EJECUTAR el cruce (Usuario pidió explícitamente este botón)
-                    if st.button("🚀 Iniciar Cruce de Datos"):
+                    cols_key = st.multiselect(
+                        "Seleccione columna(s) clave para cruzar (ej: Cédula + Fecha + Código CUPS)",
+                        common_cols, default=common_cols[:1]
+                    )
+                
+                    # Paso 1: particionar y pre-contar (detecta claves repetidas antes de cruzar)
+                    if st.button("🔎 Analizar Claves", disabled=not cols_key):
                         try:
-                            # Optimización: Convertir a string vectorizado y strip
-                            df_c1[col_key] = df_c1[col_key].astype(str).str.strip()
-                            df_c2[col_key] = df_c2[col_key].astype(str).str.strip()
-                            
-                            with st.spinner("Realizando cruce de datos..."):
+                            with st.spinner("Analizando claves..."):
                                 progress_bar = st.progress(0)
+                                st.session_state.cruce_plan = preparar_cruce(
+                                    archivo_a, archivo_b, cols_key, st.session_state.cruce_dir,
+                                    progreso=lambda fraccion, texto: progress_bar.progress(fraccion, text=texto)
+                                )
+                                progress_bar.empty()
+                        except Exception as e:
+                            st.session_state.pop('cruce_plan', None)
+                            st.error(f"Error analizando claves: {e}")
+                
+                    plan = st.session_state.get('cruce_plan')
+                    if plan is not None and plan["columnas_clave"] == cols_key:
+                        filas_plan = plan["filas"]
+                        col_pl1, col_pl2, col_pl3 = st.columns(3)
+                        with col_pl1:
+                            st.metric("Filas del cruce completo", f"{filas_plan['completa']:,}")
+                        with col_pl2:
+                            st.metric("Solo en Archivo A", f"{plan['solo_en_a']:,}")
+                        with col_pl3:
+                            st.metric("Solo en Archivo B", f"{plan['solo_en_b']:,}")
+                    
+                        if not plan["claves_repetidas"].empty:
+                            st.warning("Claves repetidas en ambos archivos (cada una multiplica filas en el cruce completo):")
+                            st.dataframe(plan["claves_repetidas"], hide_index=True, use_container_width=True)
+                    
+                        modos = [m for m in MODOS_CRUCE if m != "completa" or filas_plan["completa"] <= MAX_FILAS_EXPANSION]
+                        if "completa" not in modos:
+                            st.error(f"⚠️ El cruce completo generaría {filas_plan['completa']:,} filas (máximo {MAX_FILAS_EXPANSION:,}). Elija un modo acotado.")
+                        modo = st.radio(
+                            "Modo de cruce", modos,
+                            format_func=lambda m: f"{MODOS_CRUCE[m]} — {filas_plan[m]:,} filas"
+                        )
+                
+                        # Paso 2: EJECUTAR el cruce (Usuario pidió explícitamente este botón)
+                        if st.button("🚀 Iniciar Cruce de Datos"):
+                            try:
+                                with st.spinner("Realizando cruce de datos..."):
+                                    progress_bar = st.progress(0)
                                 
-                                # Paso 1: Lectura y Preparación (Simulado 30%)
-                                progress_bar.progress(30, text="Analizando estructuras...")
-                                
-                                # Usar indicator=True para saber origen de manera más eficiente
-                                # ESTRATEGIA OPTIMIZADA DE MEMORIA: NO USAR OUTER MERGE GIGANTE
-                                
-                                # 1. Identificar claves
-                                keys_a = set(df_c1[col_key])
-                                keys_b = set(df_c2[col_key])
-                                
-                                # 2. Filtrar "Solo en A" (No Repetidos) SIN hacer merge masivo
-                                # Esto es mucho más ligero que un outer join
-                                no_en_b = df_c1[~df_c1[col_key].isin(keys_b)].copy()
-                                
-                                # 3. Filtrar "Solo en B" (si se necesita métrica)
-                                no_en_a = df_c2[~df_c2[col_key].isin(keys_a)].copy()
-                                
-                                # 4. Coincidencias (Repetidos) - Inner Merge
-                                # Solo unimos lo que coincide
-                                coincidencias = pd.merge(df_c1, df_c2, on=col_key, how='inner', suffixes=('_A', '_B'))
-                                
-                                progress_bar.progress(80, text="Generando reportes...")
-                                
-                                # Generar Buffer Excel para descarga
-                                buffer_cruce = io.BytesIO()
-                                with pd.ExcelWriter(buffer_cruce, engine='xlsxwriter') as writer:
-                                    coincidencias.to_excel(writer, sheet_name='REPETIDOS', index=False)
-                                    no_en_b.to_excel(writer, sheet_name='NO REPETIDOS', index=False)
-                                buffer_cruce.seek(0)
+                                    # ESTRATEGIA DE MEMORIA ACOTADA: particiones en disco por hash de la clave,
+                                    # cruzadas de a una (REPETIDOS / NO REPETIDOS / solo en B)
+                                    resultado = ejecutar_cruce(
+                                        plan, st.session_state.cruce_dir, modo,
+                                        progreso=lambda fraccion, texto: progress_bar.progress(fraccion, text=texto)
+                                    )
                                 
-                                # Guardar resultados en Session State para que no desaparezcan
-                                st.session_state.cruce_resultado = {
-                                    'coincidencias': coincidencias,
-                                    'no_en_b': no_en_b,
-                                    'no_en_a': no_en_a,
-                                    'buffer': buffer_cruce
-                                }
+                                    # Guardar solo rutas y conteos en Session State (el Excel se genera al descargar)
+                                    for viejo in glob.glob(os.path.join(st.session_state.cruce_dir, "cruce_*.xlsx")):
+                                        os.remove(viejo)
+                                    st.session_state.cruce_resultado = resultado
                                 
-                                progress_bar.progress(100, text="¡Análisis Completado!")
-                                time.sleep(0.5)
-                                progress_bar.empty()
-                                st.rerun()
-
-                        except MemoryError:
-                            st.error("⚠️ Error de Memoria: Los archivos son demasiado grandes.")
-                        except Exception as e:
-                            st.error(f"Error en el cruce: {e}")
+                                    progress_bar.progress(1.0, text="¡Análisis Completado!")
+                                    time.sleep(0.5)
+                                    progress_bar.empty()
+                                    st.rerun()
+
+                            except MemoryError:
+                                st.error("⚠️ Error de Memoria: Los archivos son demasiado grandes.")
+                            except Exception as e:
+                                st.error(f"Error en el cruce: {e}")
+                    else:
+                        st.info("Analice las claves para ver el tamaño del cruce antes de ejecutarlo.")
 
                 else:
                     st.warning("No se encontraron columnas con el mismo nombre para cruzar automáticamente.")
-            
+        
             # Mostrar Resultados si existen en Session State
             if 'cruce_resultado' in st.session_state:
                 res = st.session_state.cruce_resultado
-                
+                conteos = res['conteos']
+            
                 st.divider()
-                st.success("✅ Resultados del último cruce:")
-                
+                st.success(f"✅ Resultados del último cruce ({MODOS_CRUCE[res['modo']]}):")
+            
                 col_res1, col_res2, col_res3 = st.columns(3)
                 with col_res1:
-                    st.metric("Coincidencias", len(res['coincidencias']))
+                    st.metric("Coincidencias", conteos['coincidencias'])
                 with col_res2:
-                    st.metric("Solo en Archivo A", len(res['no_en_b']))
+                    st.metric("Solo en Archivo A", conteos['no_en_b'])
                 with col_res3:
-                    st.metric("Solo en Archivo B", len(res['no_en_a']))
-                    
-                # Botón de Descarga
+                    st.metric("Solo en Archivo B", conteos['no_en_a'])
+                
+                # Botón de Descarga (el Excel se arma recién al pulsarlo)
+                directorio_cruce = st.session_state.cruce_dir
                 st.download_button(
                     label="📥 Descargar Resultado del Cruce (Excel)",
-                    data=res['buffer'],
+                    data=lambda: excel_cruce_bajo_demanda(res, directorio_cruce),
                     file_name=f"cruce_datos_{datetime.now().strftime('%Y%m%d_%H%M')}.xlsx",
                     mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
                     use_container_width=True
                 )
-                
+            
                 tab_res1, tab_res2, tab_res3 = st.tabs(["✅ Coincidencias", "⚠️ Solo en A", "⚠️ Solo en B"])
-                
-                with tab_res1:
-                    st.dataframe(res['coincidencias'])
-                with tab_res2:
-                    st.dataframe(res['no_en_b'])
-                with tab_res3:
-                    st.dataframe(res['no_en_a'])
+            
+                for tab_res, nombre in [(tab_res1, 'coincidencias'), (tab_res2, 'no_en_b'), (tab_res3, 'no_en_a')]:
+                    with tab_res:
+                        render_visor_parquet(res['rutas'][nombre], f"visor_{nombre}")
 
 
     # Si no hay datos y no es admin, no mostrar resto
@@ -980,390 +2868,298 @@ def main_app():
         return
 
     # TAB 1: ANÁLISIS
-    with tab1:
-        st.subheader("Resumen Profesional por Procedimiento")
+    if tab1.open:
+        with tab1, medir_fase("pestaña ANÁLISIS"):
+            st.subheader("Resumen Profesional por Procedimiento")
         
-        if not df_filtrado.empty:
-            col_profesional = next((c for c in df_filtrado.columns if "profesional" in str(c).lower()), None)
-            col_procedimiento = next((c for c in df_filtrado.columns if "nombre procedimiento" in str(c).lower()), None)
-            col_valor = next((c for c in df_filtrado.columns if "valor" in str(c).lower()), None)
-
-            if col_profesional and col_procedimiento and col_valor:
-                try:
-                    temp = df_filtrado.copy()
-                    temp["_valor"] = pd.to_numeric(temp[col_valor], errors='coerce').fillna(0)
-                    
-                    agrupado = temp.groupby([col_profesional, col_procedimiento]).agg(
-                        Total_Servicios=(col_procedimiento, 'count'),
-                        Valor_Total=('_valor', 'sum')
-                    ).reset_index()
-                    
-                    agrupado = agrupado.sort_values([col_profesional, "Total_Servicios"], ascending=[True, False])
+            if not df_filtrado.empty:
+                col_profesional = esquema["profesional"]
+                col_procedimiento = esquema["procedimiento"]
+
+                if agregados["prof_proc"] is not None:
+                    try:
+                        agrupado = agregados["prof_proc"].sort_values([col_profesional, "Total_Servicios"], ascending=[True, False])
                     
-                    st.dataframe(
-                        agrupado, 
-                        column_config={
-                            col_profesional: "Profesional",
-                            col_procedimiento: "Procedimiento",
-                            "Total_Servicios": st.column_config.ProgressColumn(
-                                "Total Servicios",
-                                help="Cantidad de servicios realizados",
-                                format="%d",
-                                min_value=0,
-                                max_value=int(agrupado["Total_Servicios"].max()),
-                            ),
-                            "Valor_Total": st.column_config.NumberColumn(
-                                "Valor Total",
-                                help="Valor monetario total",
-                                format="$ %d"
-                            )
-                        },
-                        hide_index=True,
-                        use_container_width=True
-                    )
-                except Exception as e:
-                    st.error(f"Error generando resumen profesional: {e}")
-            else:
-                st.warning("No se encontraron columnas de profesional, procedimiento o valor para generar el resumen.")
+                        st.dataframe(
+                            agrupado, 
+                            column_config={
+                                col_profesional: "Profesional",
+                                col_procedimiento: "Procedimiento",
+                                "Total_Servicios": st.column_config.ProgressColumn(
+                                    "Total Servicios",
+                                    help="Cantidad de servicios realizados",
+                                    format="%d",
+                                    min_value=0,
+                                    max_value=int(agrupado["Total_Servicios"].max()),
+                                ),
+                                "Valor_Total": st.column_config.NumberColumn(
+                                    "Valor Total",
+                                    help="Valor monetario total",
+                                    format="$ %d"
+                                )
+                            },
+                            hide_index=True,
+                            use_container_width=True
+                        )
+                    except Exception as e:
+                        st.error(f"Error generando resumen profesional: {e}")
+                else:
+                    st.warning("No se encontraron columnas de profesional, procedimiento o valor para generar el resumen.")
 
-        st.markdown("---")
-        st.subheader("Resumen Detallado por Paciente")
+            st.markdown("---")
+            st.subheader("Resumen Detallado por Paciente")
         
-        if not df_filtrado.empty:
-            # Búsqueda ampliada de columnas (Paciente)
-            candidates_paciente = ["paciente", "nombre completo", "nombre", "usuario", "afiliado", "cliente"]
-            col_paciente = None
-            for cand in candidates_paciente:
-                col_paciente = next((c for c in df_filtrado.columns if cand in str(c).lower()), None)
-                if col_paciente:
-                    break
+            if not df_filtrado.empty:
+                col_paciente = esquema["paciente"]
+                col_procedimiento = esquema["procedimiento"]
             
-            # Búsqueda ampliada de columnas (Procedimiento)
-            candidates_proc = ["nombre procedimiento", "procedimiento", "servicio", "actividad"]
-            col_procedimiento = None
-            for cand in candidates_proc:
-                col_procedimiento = next((c for c in df_filtrado.columns if cand in str(c).lower()), None)
-                if col_procedimiento:
-                    break
-
-            col_valor = next((c for c in df_filtrado.columns if "valor" in str(c).lower()), None)
-            
-            if col_paciente and col_procedimiento:
-                try:
-                    temp = df_filtrado.copy()
-                    
-                    # Asegurar valor numérico
-                    if col_valor:
-                        temp["_valor_calc"] = pd.to_numeric(temp[col_valor], errors='coerce').fillna(0)
-                    else:
-                        temp["_valor_calc"] = 0
-                    
-                    # Buscar columna de cantidad si existe
-                    col_cantidad = next((c for c in df_filtrado.columns if "cantidad" in str(c).lower()), None)
-                    
-                    agg_dict = {
-                        "_valor_calc": "sum"
-                    }
-                    
-                    if col_cantidad:
-                         # Si existe columna cantidad, sumar
-                        temp[col_cantidad] = pd.to_numeric(temp[col_cantidad], errors='coerce').fillna(0)
-                        agg_dict[col_cantidad] = "sum"
-                    else:
-                        # Si no existe, contar registros (usamos una columna dummy)
-                        temp["_conteo"] = 1
-                        agg_dict["_conteo"] = "sum"
-                    
-                    # Agrupar
-                    resumen_paciente = temp.groupby([col_paciente, col_procedimiento]).agg(agg_dict).reset_index()
-                    
-                    # Renombrar columnas para visualización final
-                    rename_map = {
-                        "_valor_calc": "Valor Total"
-                    }
-                    
-                    if col_cantidad:
-                        rename_map[col_cantidad] = "Cantidad"
-                    else:
-                        rename_map["_conteo"] = "Cantidad"
-                        
-                    resumen_paciente.rename(columns=rename_map, inplace=True)
+                if agregados["paciente_proc"] is not None:
+                    try:
+                        # Cantidad: suma de la columna cantidad si existe, si no conteo de registros
+                        resumen_paciente = agregados["paciente_proc"].rename(columns={"Valor_Total": "Valor Total"})
                     
-                    # Ordenar
-                    resumen_paciente = resumen_paciente.sort_values([col_paciente, "Valor Total"], ascending=[True, False])
+                        # Ordenar
+                        resumen_paciente = resumen_paciente.sort_values([col_paciente, "Valor Total"], ascending=[True, False])
                     
-                    # Formateo visual
-                    st.dataframe(
-                        resumen_paciente,
-                        column_config={
-                            col_paciente: "Nombre del Paciente",
-                            col_procedimiento: "Nombre Procedimiento",
-                            "Cantidad": st.column_config.NumberColumn(
-                                "Cantidad de Servicios",
-                                help="Cantidad total de servicios",
-                                format="%d"
-                            ),
-                            "Valor Total": st.column_config.NumberColumn(
-                                "Valor Total",
-                                help="Suma del valor facturado",
-                                format="$ %d"
-                            )
-                        },
-                        hide_index=True,
-                        use_container_width=True,
-                        height=500
-                    )
+                        # Formateo visual
+                        st.dataframe(
+                            resumen_paciente,
+                            column_config={
+                                col_paciente: "Nombre del Paciente",
+                                col_procedimiento: "Nombre Procedimiento",
+                                "Cantidad": st.column_config.NumberColumn(
+                                    "Cantidad de Servicios",
+                                    help="Cantidad total de servicios",
+                                    format="%d"
+                                ),
+                                "Valor Total": st.column_config.NumberColumn(
+                                    "Valor Total",
+                                    help="Suma del valor facturado",
+                                    format="$ %d"
+                                )
+                            },
+                            hide_index=True,
+                            use_container_width=True,
+                            height=500
+                        )
                     
-                except Exception as e:
-                    st.error(f"Error agrupando: {e}")
-                    st.warning("Se muestran los datos sin agrupar debido a un error.")
+                    except Exception as e:
+                        st.error(f"Error agrupando: {e}")
+                        st.warning("Se muestran los datos sin agrupar debido a un error.")
+                        st.dataframe(df_filtrado)
+                else:
+                    st.warning(f"No se encontraron las columnas necesarias para el resumen detallado. (Buscando: Paciente/Nombre, Procedimiento). Columnas disponibles: {', '.join(df_filtrado.columns)}")
                     st.dataframe(df_filtrado)
             else:
-                st.warning(f"No se encontraron las columnas necesarias para el resumen detallado. (Buscando: Paciente/Nombre, Procedimiento). Columnas disponibles: {', '.join(df_filtrado.columns)}")
-                st.dataframe(df_filtrado)
-        else:
-            st.info("Sin resultados para mostrar")
+                st.info("Sin resultados para mostrar")
 
     # TAB 2: TOTAL
-    with tab2:
-        total_val = calcular_totales(df_filtrado)
-        st.markdown(f"<div style='text-align:center; background:#e0fbfc; padding:20px; border-radius:15px; border: 1px solid #94d2bd;'><h1 style='color:#005f73;'>💰 Total: {formato_pesos(total_val)}</h1></div>", unsafe_allow_html=True)
-        st.markdown("<br>", unsafe_allow_html=True)
+    if tab2.open:
+        with tab2, medir_fase("pestaña TOTAL"):
+            total_val = agregados["total"]
+            st.markdown(f"<div style='text-align:center; background:#e0fbfc; padding:20px; border-radius:15px; border: 1px solid #94d2bd;'><h1 style='color:#005f73;'>💰 Total: {formato_pesos(total_val)}</h1></div>", unsafe_allow_html=True)
+            st.markdown("<br>", unsafe_allow_html=True)
         
-        col_proc = next((c for c in df_filtrado.columns if "nombre procedimiento" in str(c).lower()), None)
-        col_val = next((c for c in df_filtrado.columns if "valor" in str(c).lower()), None)
+            col_proc = esquema["procedimiento"]
         
-        if col_proc and col_val and not df_filtrado.empty:
-            temp = df_filtrado.copy()
-            temp["_val"] = pd.to_numeric(temp[col_val], errors='coerce').fillna(0)
-            
-            # Agrupación más detallada
-            agrupado = temp.groupby(col_proc).agg(
-                Cantidad=(col_proc, 'count'),
-                Valor_Num=('_val', 'sum')
-            ).reset_index()
-            
-            agrupado = agrupado.sort_values("Valor_Num", ascending=False)
+            if agregados["procedimiento"] is not None and not df_filtrado.empty:
+                # Agrupación más detallada
+                agrupado = agregados["procedimiento"].rename(columns={"Valor_Total": "Valor_Num"})
             
-            # Calcular participación
-            total_global = agrupado["Valor_Num"].sum()
-            agrupado["Participacion"] = (agrupado["Valor_Num"] / total_global * 100) if total_global > 0 else 0
+                agrupado = agrupado.sort_values("Valor_Num", ascending=False)
             
-            # Formatear Valor (String con puntos)
-            agrupado["Valor Total"] = agrupado["Valor_Num"].apply(formato_pesos)
+                # Calcular participación
+                total_global = agrupado["Valor_Num"].sum()
+                agrupado["Participacion"] = (agrupado["Valor_Num"] / total_global * 100) if total_global > 0 else 0
             
-            agrupado = clean_df_for_st(agrupado)
+                agrupado = clean_df_for_st(agrupado)
             
-            st.subheader("Detalle por Procedimiento")
+                st.subheader("Detalle por Procedimiento")
             
-            # Visualización en Tarjetas (Grid Layout)
-            # Iterar sobre el dataframe y crear tarjetas
-            cols_grid = st.columns(3) # 3 Columnas por fila
-            
-            for index, row in agrupado.iterrows():
-                col_actual = cols_grid[index % 3]
-                
-                proc_name = row[col_proc]
-                cantidad = row["Cantidad"]
-                valor_fmt = row["Valor Total"]
-                pct = row["Participacion"]
-                
-                with col_actual:
-                    card_html = f"""
-<div style="background-color: white; padding: 20px; border-radius: 12px; box-shadow: 0 4px 10px rgba(0,0,0,0.05); border: 1px solid #e0e0e0; border-left: 5px solid #005f73; margin-bottom: 20px; height: 100%;">
-<h5 style="color: #005f73; margin-top: 0; font-weight: 700; height: 50px; overflow: hidden; display: -webkit-box; -webkit-line-clamp: 2; -webkit-box-orient: vertical;">{proc_name}</h5>
-<div style="display: flex; justify-content: space-between; align-items: center; margin-top: 15px; border-top: 1px solid #f0f0f0; padding-top: 10px;">
-<div>
-<span style="display: block; color: #888; font-size: 0.8em; text-transform: uppercase; letter-spacing: 0.5px;">Frecuencia</span>
-<span style="font-size: 1.2em; font-weight: 600; color: #333;">{cantidad}</span>
-</div>
-<div style="text-align: right;">
-<span style="display: block; color: #888; font-size: 0.8em; text-transform: uppercase; letter-spacing: 0.5px;">Facturado</span>
-<span style="font-size: 1.2em; font-weight: 600; color: #2ec4b6;">{valor_fmt}</span>
-</div>
-</div>
-<div style="margin-top: 15px;">
-<div style="display: flex; justify-content: space-between; margin-bottom: 5px;">
-<span style="font-size: 0.8em; color: #555;">Participación</span>
-<span style="font-size: 0.8em; font-weight: bold; color: #005f73;">{pct:.1f}%</span>
-</div>
-<div style="background-color: #e0fbfc; height: 6px; border-radius: 3px; width: 100%;">
-<div style="background-color: #005f73; height: 6px; border-radius: 3px; width: {min(pct, 100)}%;"></div>
-</div>
-</div>
-</div>
-"""
-                    st.markdown(card_html, unsafe_allow_html=True)
+                # Tarjetas paginadas: al navegador solo viaja la página actual
+                render_tarjetas_procedimientos(agrupado, col_proc, "total_tarjetas")
             
-            # Gráfica Circular (Donut Chart)
-            st.markdown("### 📊 Participación por Procedimiento (Top 10)")
-            if not agrupado.empty:
-                # Tomar Top 10 para no saturar la gráfica circular
-                top_agrupado = agrupado.head(10).copy()
+                # Gráfica Circular (Donut Chart)
+                st.markdown("### 📊 Participación por Procedimiento (Top 10)")
+                if not agrupado.empty:
+                    # Tomar Top 10 para no saturar la gráfica circular
+                    top_agrupado = agrupado.head(10).copy()
                 
-                fig_pie = px.pie(
-                    top_agrupado,
-                    names=col_proc,
-                    values="Valor_Num",
-                    hole=0.4, # Donut chart para estilo moderno
-                    color_discrete_sequence=px.colors.sequential.Tealgrn_r # Colores profesionales
-                )
+                    fig_pie = px.pie(
+                        top_agrupado,
+                        names=col_proc,
+                        values="Valor_Num",
+                        hole=0.4, # Donut chart para estilo moderno
+                        color_discrete_sequence=px.colors.sequential.Tealgrn_r # Colores profesionales
+                    )
                 
-                fig_pie.update_traces(
-                    textposition='inside', 
-                    textinfo='percent+label',
-                    hovertemplate='<b>%{label}</b><br>Facturado: $%{value:,.0f}<br>Participación: %{percent}'
-                )
+                    fig_pie.update_traces(
+                        textposition='inside', 
+                        textinfo='percent+label',
+                        hovertemplate='<b>%{label}</b><br>Facturado: $%{value:,.0f}<br>Participación: %{percent}'
+                    )
                 
-                fig_pie.update_layout(
-                    showlegend=False, # Ocultar leyenda para dar más espacio al gráfico y usar etiquetas internas
-                    height=600,
-                    margin=dict(t=30, b=30, l=30, r=30),
-                    font=dict(size=14)
-                )
+                    fig_pie.update_layout(
+                        showlegend=False, # Ocultar leyenda para dar más espacio al gráfico y usar etiquetas internas
+                        height=600,
+                        margin=dict(t=30, b=30, l=30, r=30),
+                        font=dict(size=14)
+                    )
                 
-                st.plotly_chart(fig_pie, use_container_width=True)
-
-            # TAB 3: DASHBOARD
-    with tab3:
-        st.subheader("Dashboard Profesional")
-        meta_dash = st.number_input("Meta General", value=cargar_meta("meta_dashboard.txt"))
-        if st.button("Guardar Meta Dashboard"):
-            guardar_meta("meta_dashboard.txt", meta_dash)
+                    st.plotly_chart(fig_pie, use_container_width=True)
+
+                # TAB 3: DASHBOARD
+    if tab3.open:
+        with tab3, medir_fase("pestaña DASHBOARD"):
+            st.subheader("Dashboard Profesional")
+            meta_dash = st.number_input("Meta General", value=cargar_meta("meta_dashboard.txt"))
+            if st.button("Guardar Meta Dashboard"):
+                guardar_meta("meta_dashboard.txt", meta_dash)
             
-        col_prof = next((c for c in df_filtrado.columns if "profesional" in str(c).lower()), None)
-        if col_prof and not df_filtrado.empty:
-            counts = df_filtrado[col_prof].value_counts().reset_index()
-            counts.columns = ["Profesional", "Servicios"]
+            if agregados["profesionales"] is not None and not df_filtrado.empty:
+                counts = agregados["profesionales"].copy()
             
-            if meta_dash > 0:
-                counts["Porcentaje"] = (counts["Servicios"] / meta_dash * 100)
-            else:
-                counts["Porcentaje"] = 0
+                if meta_dash > 0:
+                    counts["Porcentaje"] = (counts["Servicios"] / meta_dash * 100)
+                else:
+                    counts["Porcentaje"] = 0
             
-            col_dash_left, col_dash_right = st.columns(2)
+                col_dash_left, col_dash_right = st.columns(2)
             
-            with col_dash_left:
-                st.markdown("### 📋 Rendimiento General")
-                st.dataframe(
-                    counts,
-                    column_config={
-                        "Profesional": "Profesional",
-                        "Servicios": st.column_config.NumberColumn(
-                            "Servicios",
-                            help="Total de servicios realizados",
-                            format="%d"
-                        ),
-                        "Porcentaje": st.column_config.ProgressColumn(
-                            "Cumplimiento Meta",
-                            help="Porcentaje respecto a la meta",
-                            format="%.1f%%",
-                            min_value=0,
-                            max_value=max(100, int(counts["Porcentaje"].max()) if not counts.empty else 100),
-                        )
-                    },
-                    hide_index=True,
-                    use_container_width=True,
-                    height=600
-                )
+                with col_dash_left:
+                    st.markdown("### 📋 Rendimiento General")
+                    st.dataframe(
+                        counts,
+                        column_config={
+                            "Profesional": "Profesional",
+                            "Servicios": st.column_config.NumberColumn(
+                                "Servicios",
+                                help="Total de servicios realizados",
+                                format="%d"
+                            ),
+                            "Porcentaje": st.column_config.ProgressColumn(
+                                "Cumplimiento Meta",
+                                help="Porcentaje respecto a la meta",
+                                format="%.1f%%",
+                                min_value=0,
+                                max_value=max(100, int(counts["Porcentaje"].max()) if not counts.empty else 100),
+                            )
+                        },
+                        hide_index=True,
+                        use_container_width=True,
+                        height=600
+                    )
                 
-            with col_dash_right:
-                st.markdown("### 🏆 Top 10 Profesionales (Cumplimiento)")
-                top_10 = counts.head(10).sort_values("Porcentaje", ascending=True) # Ordenar para barra horizontal o vertical
+                with col_dash_right:
+                    st.markdown("### 🏆 Top 10 Profesionales (Cumplimiento)")
+                    top_10 = counts.head(10).sort_values("Porcentaje", ascending=True) # Ordenar para barra horizontal o vertical
                 
-                fig_bar = px.bar(
-                    top_10,
-                    x="Profesional",
-                    y="Porcentaje",
-                    text="Porcentaje",
-                    color="Porcentaje",
-                    color_continuous_scale="Teal"
-                )
+                    fig_bar = px.bar(
+                        top_10,
+                        x="Profesional",
+                        y="Porcentaje",
+                        text="Porcentaje",
+                        color="Porcentaje",
+                        color_continuous_scale="Teal"
+                    )
                 
-                fig_bar.update_traces(texttemplate='%{text:.1f}%', textposition='outside')
-                fig_bar.update_layout(
-                    xaxis_title="Profesional",
-                    yaxis_title="% Cumplimiento Meta",
-                    yaxis_range=[0, max(110, top_10["Porcentaje"].max())],
-                    showlegend=False,
-                    height=500
-                )
-                st.plotly_chart(fig_bar, use_container_width=True)
+                    fig_bar.update_traces(texttemplate='%{text:.1f}%', textposition='outside')
+                    fig_bar.update_layout(
+                        xaxis_title="Profesional",
+                        yaxis_title="% Cumplimiento Meta",
+                        yaxis_range=[0, max(110, top_10["Porcentaje"].max())],
+                        showlegend=False,
+                        height=500
+                    )
+                    st.plotly_chart(fig_bar, use_container_width=True)
     
     # TAB 4: CUMPLIMIENTO
-    with tab4:
-        st.subheader("Cumplimiento de Meta")
-        col_m1, col_m2 = st.columns([1, 2])
-        with col_m1:
-            meta_cump = st.number_input("Establecer Meta Mensual ($)", value=cargar_meta("meta_cumplimiento.txt"))
-            if st.button("💾 Guardar Meta"):
-                guardar_meta("meta_cumplimiento.txt", meta_cump)
+    if tab4.open:
+        with tab4, medir_fase("pestaña CUMPLIMIENTO"):
+            st.subheader("Cumplimiento de Meta")
+            col_m1, col_m2 = st.columns([1, 2])
+            with col_m1:
+                meta_cump = st.number_input("Establecer Meta Mensual ($)", value=cargar_meta("meta_cumplimiento.txt"))
+                if st.button("💾 Guardar Meta"):
+                    guardar_meta("meta_cumplimiento.txt", meta_cump)
         
-        total_actual = calcular_totales(df_filtrado)
-        pct = (total_actual / meta_cump * 100) if meta_cump > 0 else 0
-        faltante = max(meta_cump - total_actual, 0)
+            total_actual = agregados["total"]
+            pct = (total_actual / meta_cump * 100) if meta_cump > 0 else 0
+            faltante = max(meta_cump - total_actual, 0)
         
-        st.divider()
+            st.divider()
         
-        # Métricas Principales
-        col_kpi1, col_kpi2, col_kpi3 = st.columns(3)
-        with col_kpi1:
-            st.markdown(f"<div style='padding:15px; background:#e0fbfc; border-radius:10px; border:1px solid #94d2bd; text-align:center;'><h3>💰 Recaudo Actual</h3><h2>{formato_pesos(total_actual)}</h2></div>", unsafe_allow_html=True)
-        with col_kpi2:
-            st.markdown(f"<div style='padding:15px; background:#ffddd2; border-radius:10px; border:1px solid #e29578; text-align:center;'><h3>📉 Faltante Meta</h3><h2>{formato_pesos(faltante)}</h2></div>", unsafe_allow_html=True)
-        with col_kpi3:
-             color_pct = "green" if pct >= 100 else "orange" if pct >= 80 else "red"
-             st.markdown(f"<div style='padding:15px; background:#edf6f9; border-radius:10px; border:1px solid #83c5be; text-align:center;'><h3>🎯 Porcentaje</h3><h2 style='color:{color_pct};'>{pct:.1f}%</h2></div>", unsafe_allow_html=True)
-
-        st.divider()
-
-        # Gráficos Avanzados
-        col_g1, col_g2 = st.columns(2)
+            # Métricas Principales
+            col_kpi1, col_kpi2, col_kpi3 = st.columns(3)
+            with col_kpi1:
+                st.markdown(f"<div style='padding:15px; background:#e0fbfc; border-radius:10px; border:1px solid #94d2bd; text-align:center;'><h3>💰 Recaudo Actual</h3><h2>{formato_pesos(total_actual)}</h2></div>", unsafe_allow_html=True)
+            with col_kpi2:
+                st.markdown(f"<div style='padding:15px; background:#ffddd2; border-radius:10px; border:1px solid #e29578; text-align:center;'><h3>📉 Faltante Meta</h3><h2>{formato_pesos(faltante)}</h2></div>", unsafe_allow_html=True)
+            with col_kpi3:
+                 color_pct = "green" if pct >= 100 else "orange" if pct >= 80 else "red"
+                 st.markdown(f"<div style='padding:15px; background:#edf6f9; border-radius:10px; border:1px solid #83c5be; text-align:center;'><h3>🎯 Porcentaje</h3><h2 style='color:{color_pct};'>{pct:.1f}%</h2></div>", unsafe_allow_html=True)
+
+            st.divider()
+
+            # Gráficos Avanzados
+            col_g1, col_g2 = st.columns(2)
         
-        with col_g1:
-            st.markdown("### 📊 Medidor de Progreso")
-            fig_gauge = go.Figure(go.Indicator(
-                mode = "gauge+number+delta",
-                value = total_actual,
-                domain = {'x': [0, 1], 'y': [0, 1]},
-                delta = {'reference': meta_cump, 'position': "top", 'valueformat': "$,.0f"},
-                gauge = {
-                    'axis': {'range': [0, meta_cump*1.2 if meta_cump > 0 else total_actual*1.2]},
-                    'bar': {'color': "#005f73"},
-                    'steps': [
-                        {'range': [0, meta_cump*0.5], 'color': "#e0fbfc"},
-                        {'range': [meta_cump*0.5, meta_cump*0.9], 'color': "#83c5be"}
-                    ],
-                    'threshold': {
-                        'line': {'color': "red", 'width': 4},
-                        'thickness': 0.75,
-                        'value': meta_cump
+            with col_g1:
+                st.markdown("### 📊 Medidor de Progreso")
+                fig_gauge = go.Figure(go.Indicator(
+                    mode = "gauge+number+delta",
+                    value = total_actual,
+                    domain = {'x': [0, 1], 'y': [0, 1]},
+                    delta = {'reference': meta_cump, 'position': "top", 'valueformat': "$,.0f"},
+                    gauge = {
+                        'axis': {'range': [0, meta_cump*1.2 if meta_cump > 0 else total_actual*1.2]},
+                        'bar': {'color': "#005f73"},
+                        'steps': [
+                            {'range': [0, meta_cump*0.5], 'color': "#e0fbfc"},
+                            {'range': [meta_cump*0.5, meta_cump*0.9], 'color': "#83c5be"}
+                        ],
+                        'threshold': {
+                            'line': {'color': "red", 'width': 4},
+                            'thickness': 0.75,
+                            'value': meta_cump
+                        }
                     }
-                }
-            ))
-            fig_gauge.update_layout(height=400, margin=dict(l=20, r=20, t=50, b=20))
-            st.plotly_chart(fig_gauge, use_container_width=True)
-
-        with col_g2:
-            st.markdown("### 🥧 Distribución del Cumplimiento")
-            fig_pie = px.pie(
-                names=["Recaudado", "Faltante"], 
-                values=[total_actual, faltante], 
-                hole=0.6,
-                color_discrete_sequence=["#005f73", "#ffddd2"]
-            )
-            fig_pie.update_traces(textinfo='percent+label')
-            st.plotly_chart(fig_pie, use_container_width=True)
+                ))
+                fig_gauge.update_layout(height=400, margin=dict(l=20, r=20, t=50, b=20))
+                st.plotly_chart(fig_gauge, use_container_width=True)
+
+            with col_g2:
+                st.markdown("### 🥧 Distribución del Cumplimiento")
+                fig_pie = px.pie(
+                    names=["Recaudado", "Faltante"], 
+                    values=[total_actual, faltante], 
+                    hole=0.6,
+                    color_discrete_sequence=["#005f73", "#ffddd2"]
+                )
+                fig_pie.update_traces(textinfo='percent+label')
+                st.plotly_chart(fig_pie, use_container_width=True)
 
 # ===================== MAIN EXECUTION =====================
-if __name__ == "__main__":
+if __name__ == "__main__" and sys.argv[1:2] == ["--trabajo-consolidacion"]:
+    # Proceso de consolidación en segundo plano (lanzado por iniciar_trabajo_consolidacion)
+    ejecutar_trabajo_consolidacion(sys.argv[2])
+elif __name__ == "__main__":
     # Asegurar inicialización de estado
     if 'usuario' not in st.session_state:
         st.session_state.usuario = None
 
+    if 'id_sesion' not in st.session_state:
+        st.session_state.id_sesion = uuid.uuid4().hex[:12]
+
     try:
         if st.session_state.usuario:
-            main_app()
+            # Tiempos por fase de este rerun (ver MEDICIÓN DE TIEMPOS)
+            iniciar_medicion(st.session_state.id_sesion, st.session_state.usuario)
+            try:
+                main_app()
+            finally:
+                cerrar_medicion()
+                terminar_rerun_sesion(st.session_state.id_sesion)
         else:
             login()
     except Exception as e:
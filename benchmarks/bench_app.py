@@ -0,0 +1,248 @@
+"""Suite de benchmarks del app sobre datos sintéticos: tiempo, filas/s y pico de memoria por etapa.
+
+Mide sin Streamlit la consolidación (procesar_consolidacion, lo que corre el trabajo en segundo
+plano), la carga de la base, clean_df_for_st, filtrar_datos, calcular_totales, calcular_agregados,
+generar_excel_filtros y el cruce de datos. Todo se ejecuta en un directorio temporal.
+
+Uso (desde la raíz del repo):
+    python benchmarks/bench_app.py --filas 200000
+    python benchmarks/bench_app.py --filas 1000000 --salida base.json
+    python benchmarks/bench_app.py --filas 1000000 --comparar base.json --tolerancia 0.25
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import appy  # noqa: E402
+from datos_sinteticos import (catalogo_procedimientos, escribir_libros, generar_facturacion,  # noqa: E402
+                              generar_tarifario, valorizar)
+
+CLAVES_CRUCE = ["Cedula", "Fecha Atencion", "Codigo Procedimiento"]
+
+
+def reiniciar_pico_rss():
+    """En Linux reinicia el pico de RSS del proceso (VmHWM); en otros sistemas el pico es acumulado."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def pico_rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for linea in f:
+                if linea.startswith("VmHWM:"):
+                    return int(linea.split()[1]) / 1024
+    except OSError:
+        pass
+    if resource is None:
+        return float("nan")
+    pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return pico / (1024 * 1024) if sys.platform == "darwin" else pico / 1024
+
+
+def medir(resultados, fase, filas, funcion, repeticiones=1):
+    """Ejecuta funcion() `repeticiones` veces y registra la mediana del tiempo y el pico de RSS."""
+    gc.collect()
+    reiniciar_pico_rss()
+    tiempos = []
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        valor = funcion()
+        tiempos.append(time.perf_counter() - inicio)
+    segundos = statistics.median(tiempos)
+    resultados.append({
+        "fase": fase,
+        "filas": int(filas),
+        "segundos": segundos,
+        "filas_por_segundo": filas / segundos if segundos > 0 else 0.0,
+        "pico_rss_mb": pico_rss_mb(),
+    })
+    print(f"  {fase:<40} {segundos:9.3f} s", flush=True)
+    return valor
+
+
+def escenarios_filtros(df):
+    """Combinaciones de filtros típicas, con los valores más frecuentes del dataset."""
+    esquema = appy.resolver_esquema(df)
+    mas_frecuente = {rol: df[esquema[rol]].astype(str).str.strip().value_counts().index[0] for rol in ("profesional", "procedimiento", "ciudad")}
+    fechas = df[esquema["fecha"]].dropna()
+    medio = fechas.iloc[len(fechas) // 2]
+    desde, hasta = (medio - pd.Timedelta(days=45)).date(), (medio + pd.Timedelta(days=45)).date()
+    return {
+        "sin filtros": (None, None, None, None, None),
+        "rango de fechas": (None, desde, hasta, None, None),
+        "profesional": (mas_frecuente["profesional"], None, None, None, None),
+        "procedimiento + ciudad": (None, None, None, mas_frecuente["procedimiento"], mas_frecuente["ciudad"]),
+        "todos": (mas_frecuente["profesional"], desde, hasta, mas_frecuente["procedimiento"], mas_frecuente["ciudad"]),
+    }
+
+
+def archivo_b_cruce(facturacion, filas, seed=0):
+    """Archivo B del cruce: parte de las filas del A (con duplicados) más filas que solo están en B."""
+    rng = np.random.default_rng(seed + 2)
+    comunes = facturacion.iloc[:filas].sample(frac=0.6, random_state=seed)
+    nuevas = generar_facturacion(max(filas // 10, 1), seed=seed + 3)
+    repetidas = comunes.iloc[rng.integers(0, len(comunes), max(len(comunes) // 100, 1))]
+    return pd.concat([comunes, repetidas, nuevas], ignore_index=True)
+
+
+def ejecutar(args):
+    resultados = []
+    notas = []
+
+    print(f"Generando {args.filas:,} filas sintéticas...", flush=True)
+    catalogo = catalogo_procedimientos(args.procedimientos, args.seed)
+    facturacion = generar_facturacion(args.filas, args.profesionales, args.procedimientos, args.ciudades,
+                                      catalogo=catalogo, seed=args.seed)
+    tarifario = generar_tarifario(catalogo, args.seed)
+    ruta_fact, ruta_tar, filas_xlsx = escribir_libros(os.path.join(args.directorio, "entrada"), facturacion, tarifario)
+    if filas_xlsx < args.filas:
+        notas.append(f"El XLSX de entrada se limita a {filas_xlsx:,} filas (una hoja de Excel); "
+                     f"las etapas en memoria usan las {args.filas:,} filas.")
+
+    avisos = []
+    print("Etapas:", flush=True)
+    medir(resultados, "consolidacion", filas_xlsx,
+          lambda: appy.procesar_consolidacion(ruta_fact, ruta_tar, avisar=lambda nivel, mensaje: avisos.append((nivel, mensaje))))
+    errores = [mensaje for nivel, mensaje in avisos if nivel == "error"]
+    if errores:
+        raise RuntimeError(f"La consolidación falló: {errores}")
+
+    if filas_xlsx < args.filas:
+        appy.guardar_excel(valorizar(facturacion, appy.cargar_tarifario()))
+
+    def cargar():
+        df = appy.ordenar_por_fecha(appy.cargar_excel())
+        return df, appy.preparar_dataset(df)
+    df, claves = medir(resultados, "carga de la base", args.filas, cargar)
+
+    medir(resultados, "clean_df_for_st", len(df), lambda: appy.clean_df_for_st(df))
+
+    filtrados = {}
+    for nombre, filtros in escenarios_filtros(df).items():
+        filtrados[nombre] = medir(resultados, f"filtrar_datos [{nombre}]", len(df),
+                                  lambda: appy.filtrar_datos(df, *filtros, claves=claves)[0], repeticiones=args.repeticiones)
+
+    medir(resultados, "calcular_totales", len(df), lambda: appy.calcular_totales(df), repeticiones=args.repeticiones)
+    medir(resultados, "calcular_agregados", len(df), lambda: appy.calcular_agregados(df))
+
+    df_reporte = filtrados["rango de fechas"]
+    medir(resultados, "generar_excel_filtros [rango de fechas]", len(df_reporte),
+          lambda: appy.generar_excel_filtros(df_reporte))
+
+    if not args.sin_cruce:
+        ruta_b = os.path.join(args.directorio, "entrada", "cruce_b.xlsx")
+        archivo_b_xlsx = archivo_b_cruce(facturacion, filas_xlsx, args.seed)
+        filas_cruce = filas_xlsx + len(archivo_b_xlsx)
+        appy.exportar_xlsx(ruta_b, [("B", archivo_b_xlsx)])
+        del archivo_b_xlsx
+        directorio = appy.crear_directorio_cruce()
+
+        def volcar():
+            return (appy.volcar_xlsx_a_parquet(ruta_fact, os.path.join(directorio, "A.parquet")),
+                    appy.volcar_xlsx_a_parquet(ruta_b, os.path.join(directorio, "B.parquet")))
+        archivo_a, archivo_b = medir(resultados, "cruce: volcado a Parquet", filas_cruce, volcar)
+        plan = medir(resultados, "cruce: análisis de claves", filas_cruce,
+                     lambda: appy.preparar_cruce(archivo_a, archivo_b, CLAVES_CRUCE, directorio))
+        modo = "completa" if plan["filas"]["completa"] <= appy.MAX_FILAS_EXPANSION else "tope"
+        resultado = medir(resultados, f"cruce: ejecución [{modo}]", filas_cruce, lambda: appy.ejecutar_cruce(plan, directorio, modo))
+        medir(resultados, "cruce: exportación XLSX", sum(resultado["conteos"].values()),
+              lambda: appy.exportar_cruce_excel(resultado, os.path.join(directorio, "cruce.xlsx")))
+
+    return resultados, notas
+
+
+def imprimir(resultados):
+    print()
+    print(f"{'Fase':<40} {'Filas':>11} {'Segundos':>10} {'Filas/s':>12} {'Pico RSS MB':>12}")
+    print("-" * 89)
+    for r in resultados:
+        print(f"{r['fase']:<40} {r['filas']:>11,} {r['segundos']:>10.3f} {r['filas_por_segundo']:>12,.0f} {r['pico_rss_mb']:>12,.0f}")
+
+
+def comparar(resultados, anterior, tolerancia):
+    """Fases que empeoraron más que `tolerancia` (fracción) en tiempo o pico de memoria."""
+    previas = {r["fase"]: r for r in anterior["resultados"]}
+    regresiones = []
+    for r in resultados:
+        previa = previas.get(r["fase"])
+        if previa is None:
+            continue
+        for metrica in ("segundos", "pico_rss_mb"):
+            if previa[metrica] > 0 and r[metrica] > previa[metrica] * (1 + tolerancia):
+                regresiones.append(f"{r['fase']}: {metrica} {previa[metrica]:,.3f} -> {r[metrica]:,.3f} "
+                                   f"(+{(r[metrica] / previa[metrica] - 1) * 100:.0f}%)")
+    return regresiones
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--filas", type=int, default=100000, help="Filas de facturación (10k a 5M)")
+    parser.add_argument("--profesionales", type=int, default=60)
+    parser.add_argument("--procedimientos", type=int, default=1500)
+    parser.add_argument("--ciudades", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeticiones", type=int, default=5, help="Repeticiones de las etapas rápidas (se informa la mediana)")
+    parser.add_argument("--sin-cruce", action="store_true", help="No medir el cruce de datos")
+    parser.add_argument("--salida", help="Guardar los resultados en este JSON")
+    parser.add_argument("--comparar", help="JSON de una corrida anterior para detectar regresiones")
+    parser.add_argument("--tolerancia", type=float, default=0.2, help="Empeoramiento aceptado al comparar (0.2 = 20%%)")
+    parser.add_argument("--conservar", help="Directorio de trabajo a conservar (por defecto uno temporal que se borra)")
+    args = parser.parse_args()
+
+    origen = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="bench_app_") as temporal:
+        args.directorio = os.path.abspath(args.conservar) if args.conservar else temporal
+        os.makedirs(args.directorio, exist_ok=True)
+        os.chdir(args.directorio)
+        try:
+            resultados, notas = ejecutar(args)
+        finally:
+            os.chdir(origen)
+
+    imprimir(resultados)
+    for nota in notas:
+        print(f"Nota: {nota}")
+
+    if args.salida:
+        with open(args.salida, "w", encoding="utf-8") as f:
+            json.dump({
+                "fecha": datetime.now().isoformat(timespec="seconds"),
+                "filas": args.filas,
+                "python": platform.python_version(),
+                "pandas": pd.__version__,
+                "resultados": resultados,
+            }, f, ensure_ascii=False, indent=2)
+
+    if args.comparar:
+        with open(args.comparar, encoding="utf-8") as f:
+            regresiones = comparar(resultados, json.load(f), args.tolerancia)
+        if regresiones:
+            print("\nRegresiones:")
+            for linea in regresiones:
+                print(f"  {linea}")
+            sys.exit(1)
+        print("\nSin regresiones respecto de la corrida anterior.")
+
+
+if __name__ == "__main__":
+    main()
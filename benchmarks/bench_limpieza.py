@@ -0,0 +1,79 @@
+"""Benchmark de limpieza de texto: clean_df_for_st / sanear_texto_excel contra la versión por celda.
+
+Uso (desde la raíz del repo):
+    python benchmarks/bench_limpieza.py --filas 500000
+"""
+import argparse
+import os
+import re
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import appy  # noqa: E402
+
+
+def limpiar_por_celda(df):
+    """Implementación anterior (apply + re.sub por celda), como referencia."""
+    df = df.copy()
+    for col in df.columns:
+        if appy.es_columna_texto(df[col]):
+            df[col] = df[col].astype(str).replace('nan', '')
+            df[col] = df[col].apply(lambda x: re.sub(r'[\x00-\x08\x0B-\x0C\x0E-\x1F]', '', x) if isinstance(x, str) else x)
+            df[col] = df[col].apply(lambda x: "'" + x if str(x).startswith("=") else x)
+            df[col] = df[col].str.slice(0, appy.LARGO_MAX_CELDA)
+    return df
+
+
+def limpiar_vectorizado(df):
+    df = appy.clean_df_for_st(df)
+    for col in df.columns:
+        if appy.es_columna_texto(df[col]):
+            df[col] = appy.sanear_texto_excel(df[col])
+    return df
+
+
+def generar_frame(filas, seed=0):
+    rng = np.random.default_rng(seed)
+    nombres = np.array([f"Paciente {i}" for i in range(5000)], dtype=object)
+    sucios = np.array([f"Obs\x07 {i}\x00" for i in range(50)], dtype=object)
+    observacion = nombres[rng.integers(0, len(nombres), filas)].copy()
+    idx_sucios = rng.choice(filas, size=max(filas // 1000, 1), replace=False)
+    observacion[idx_sucios] = sucios[rng.integers(0, len(sucios), len(idx_sucios))]
+    return pd.DataFrame({
+        "Nombre Paciente": nombres[rng.integers(0, len(nombres), filas)],
+        "Nombre Procedimiento": np.array([f"Procedimiento {i}" for i in range(800)], dtype=object)[rng.integers(0, 800, filas)],
+        "Observacion": observacion,
+        "Formula": np.where(rng.random(filas) < 0.001, "=SUMA(A1)", "ok").astype(object),
+        "Valor": rng.integers(10000, 500000, filas),
+    })
+
+
+def medir(funcion, df):
+    inicio = time.perf_counter()
+    resultado = funcion(df)
+    return time.perf_counter() - inicio, resultado
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--filas", type=int, default=500000)
+    args = parser.parse_args()
+
+    df = generar_frame(args.filas)
+    t_celda, ref = medir(limpiar_por_celda, df)
+    t_vector, nuevo = medir(limpiar_vectorizado, df)
+    for col in ref.columns:
+        assert ref[col].astype(str).equals(nuevo[col].astype(str)), col
+
+    print(f"Filas: {args.filas:,}")
+    print(f"Por celda:   {t_celda:8.2f} s")
+    print(f"Vectorizado: {t_vector:8.2f} s")
+    print(f"Aceleración: {t_celda / t_vector:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+"""Generador de libros sintéticos de facturación y tarifario para los benchmarks.
+
+Los datos imitan las exportaciones reales: profesionales con prefijo de código, códigos CUPS,
+ciudades con mayúsculas y espacios inconsistentes, caracteres de control, textos que empiezan
+con "=", y fechas en varios formatos (algunas inválidas).
+
+Uso (desde la raíz del repo):
+    python benchmarks/datos_sinteticos.py --filas 100000 --destino /tmp/datos_bench
+"""
+import argparse
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import appy  # noqa: E402
+
+NOMBRES = ["María", "José", "Luis", "Ana", "Carlos", "Laura", "Andrés", "Paula", "Jorge", "Diana", "Camilo", "Sandra"]
+APELLIDOS = ["Gómez", "Rodríguez", "Martínez", "López", "García", "Pérez", "Sánchez", "Ramírez", "Torres", "Díaz", "Vargas", "Rojas"]
+CIUDADES = ["Bogotá", "Medellín", "Cali", "Barranquilla", "Cartagena", "Bucaramanga", "Pereira", "Manizales", "Cúcuta", "Ibagué",
+            "Santa Marta", "Villavicencio", "Pasto", "Montería", "Neiva", "Armenia", "Popayán", "Sincelejo", "Tunja", "Valledupar"]
+TIPOS_PROCEDIMIENTO = ["Consulta de primera vez por", "Consulta de control por", "Terapia", "Sesión de", "Valoración por",
+                       "Procedimiento de", "Evaluación por", "Interconsulta por"]
+ESPECIALIDADES = ["medicina general", "psicología", "fisioterapia", "fonoaudiología", "terapia ocupacional", "nutrición",
+                  "enfermería", "pediatría", "medicina interna", "trabajo social", "odontología", "optometría"]
+FORMATOS_FECHA = ["%d/%m/%Y", "%Y-%m-%d", "%d-%m-%Y", "%d/%m/%Y %H:%M"]
+
+
+def _elegir(rng, valores, filas):
+    valores = np.asarray(valores, dtype=object)
+    return valores[rng.integers(0, len(valores), filas)]
+
+
+def catalogo_procedimientos(procedimientos, seed=0):
+    """DataFrame (codigo, nombre, valor) con `procedimientos` códigos CUPS distintos."""
+    rng = np.random.default_rng(seed)
+    codigos = rng.choice(np.arange(100000, 999999), size=procedimientos, replace=False)
+    nombres = [f"{TIPOS_PROCEDIMIENTO[i % len(TIPOS_PROCEDIMIENTO)]} {ESPECIALIDADES[(i // len(TIPOS_PROCEDIMIENTO)) % len(ESPECIALIDADES)]} {i + 1}"
+               for i in range(procedimientos)]
+    return pd.DataFrame({
+        "codigo": codigos.astype(str),
+        "nombre": nombres,
+        "valor": rng.integers(15, 400, procedimientos) * 1000,
+    })
+
+
+def _ensuciar(rng, serie, fraccion, funcion):
+    """Aplica `funcion` (vectorizada sobre una Serie) a una fracción aleatoria de las filas."""
+    posiciones = np.flatnonzero(rng.random(len(serie)) < fraccion)
+    if len(posiciones):
+        serie.iloc[posiciones] = funcion(serie.iloc[posiciones]).to_numpy()
+    return serie
+
+
+def generar_facturacion(filas, profesionales=60, procedimientos=1500, ciudades=20, pacientes=None, catalogo=None,
+                        fecha_inicio="2024-01-01", dias=540, seed=0):
+    """Archivo 1 sintético: una fila por servicio prestado, sin valores (los pone la consolidación)."""
+    rng = np.random.default_rng(seed)
+    catalogo = catalogo if catalogo is not None else catalogo_procedimientos(procedimientos, seed)
+    pacientes = pacientes or max(filas // 8, 1)
+
+    nombres_prof = [f"{rng.integers(1000, 99999)} - {NOMBRES[i % len(NOMBRES)]} {APELLIDOS[(i * 7) % len(APELLIDOS)]} {i + 1}"
+                    for i in range(profesionales)]
+    lista_ciudades = [CIUDADES[i % len(CIUDADES)] + (f" {i // len(CIUDADES) + 1}" if i >= len(CIUDADES) else "") for i in range(ciudades)]
+
+    # Popularidad desigual de procedimientos: pocos concentran la mayoría de la facturación
+    pesos = 1.0 / np.arange(1, len(catalogo) + 1) ** 0.8
+    idx_proc = rng.choice(len(catalogo), size=filas, p=pesos / pesos.sum())
+
+    fechas = pd.Timestamp(fecha_inicio) + pd.to_timedelta(rng.integers(0, dias * 24 * 60, filas), unit="min")
+    formato = rng.integers(0, len(FORMATOS_FECHA), filas)
+    textos_fecha = np.empty(filas, dtype=object)
+    for i, fmt in enumerate(FORMATOS_FECHA):
+        en_formato = formato == i
+        textos_fecha[en_formato] = fechas[en_formato].strftime(fmt)
+    textos_fecha[rng.random(filas) < 0.001] = "sin fecha"
+
+    ids_paciente = rng.integers(0, pacientes, filas)
+    nombres_paciente = np.array([f"{NOMBRES[i % 12]} {APELLIDOS[(i // 12) % 12]} {i}" for i in range(pacientes)], dtype=object)
+    df = pd.DataFrame({
+        "Fecha Atencion": textos_fecha,
+        "Nombre Profesional": _elegir(rng, nombres_prof, filas),
+        "Codigo Procedimiento": catalogo["codigo"].to_numpy(dtype=object)[idx_proc],
+        "Nombre Procedimiento": catalogo["nombre"].to_numpy(dtype=object)[idx_proc],
+        "Cantidad": rng.choice([1, 1, 1, 1, 2, 3], size=filas),
+        "Ciudad": _elegir(rng, lista_ciudades, filas),
+        "Nombre Paciente": nombres_paciente[ids_paciente],
+        "Cedula": (ids_paciente + 10_000_000).astype(str).astype(object),
+        "Observacion": np.where(rng.random(filas) < 0.02, "Paciente reprogramado", "").astype(object),
+    })
+
+    # Suciedad típica de las exportaciones
+    df["Ciudad"] = _ensuciar(rng, df["Ciudad"], 0.05, lambda s: " " + s.str.upper() + " ")
+    df["Ciudad"] = _ensuciar(rng, df["Ciudad"], 0.05, lambda s: s.str.lower())
+    df["Nombre Procedimiento"] = _ensuciar(rng, df["Nombre Procedimiento"], 0.01, lambda s: s.str.upper())
+    df["Codigo Procedimiento"] = _ensuciar(rng, df["Codigo Procedimiento"], 0.01, lambda s: " " + s)
+    df["Codigo Procedimiento"] = _ensuciar(rng, df["Codigo Procedimiento"], 0.005, lambda s: pd.Series("", index=s.index))
+    df["Nombre Paciente"] = _ensuciar(rng, df["Nombre Paciente"], 0.001, lambda s: s + "\x07")
+    df["Observacion"] = _ensuciar(rng, df["Observacion"], 0.001, lambda s: "=" + s + "\x00")
+    return df
+
+
+def generar_tarifario(catalogo, seed=0):
+    """Archivo 2 sintético: el catálogo con algunos nombres alterados y códigos faltantes.
+
+    Así la consolidación ejercita las tres búsquedas: por código, por nombre y por nombre aproximado.
+    """
+    rng = np.random.default_rng(seed + 1)
+    tarifario = pd.DataFrame({
+        "Codigo": catalogo["codigo"].to_numpy(dtype=object),
+        "Nombre Procedimiento": catalogo["nombre"].to_numpy(dtype=object),
+        "Valor Unitario": catalogo["valor"].to_numpy(),
+    })
+    sin_codigo = rng.random(len(tarifario)) < 0.1
+    tarifario.loc[sin_codigo, "Codigo"] = ""
+    tildes = str.maketrans("áéíóú", "aeiou")
+    alterados = sin_codigo & (rng.random(len(tarifario)) < 0.5)
+    tarifario.loc[alterados, "Nombre Procedimiento"] = tarifario.loc[alterados, "Nombre Procedimiento"].str.translate(tildes) + "."
+    return tarifario
+
+
+def valorizar(facturacion, indice_tarifario):
+    """Base de trabajo como la deja la consolidación (valor unitario y total), sin pasar por XLSX.
+
+    Usa la misma búsqueda de precios del app (appy.buscar_precios) sobre un índice de tarifario ya
+    guardado. Sirve para medir las etapas en memoria con más filas de las que caben en una hoja.
+    """
+    precios, _ = appy.buscar_precios(indice_tarifario, facturacion["Codigo Procedimiento"], facturacion["Nombre Procedimiento"])
+    df = facturacion.copy()
+    df["Nombre Profesional"] = df["Nombre Profesional"].str.replace(r'^\d+\s*[-]?\s*', '', regex=True).str.strip()
+    df["Valor Unitario"] = np.nan_to_num(precios)
+    df["Valor"] = df["Valor Unitario"] * df["Cantidad"]
+    return df
+
+
+def escribir_libros(directorio, facturacion, tarifario):
+    """Escribe facturacion.xlsx y tarifario.xlsx con el exportador del app.
+
+    Si la facturación no cabe en una hoja, el XLSX lleva solo las primeras filas (la consolidación
+    lee la primera hoja). Devuelve (ruta facturación, ruta tarifario, filas escritas).
+    """
+    os.makedirs(directorio, exist_ok=True)
+    filas = min(len(facturacion), appy.FILAS_MAX_HOJA - 1)
+    ruta_fact = os.path.join(directorio, "facturacion.xlsx")
+    ruta_tar = os.path.join(directorio, "tarifario.xlsx")
+    appy.exportar_xlsx(ruta_fact, [("Facturacion", facturacion.iloc[:filas])])
+    appy.exportar_xlsx(ruta_tar, [("Tarifario", tarifario)])
+    return ruta_fact, ruta_tar, filas
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--filas", type=int, default=100000)
+    parser.add_argument("--profesionales", type=int, default=60)
+    parser.add_argument("--procedimientos", type=int, default=1500)
+    parser.add_argument("--ciudades", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--destino", default="datos_bench")
+    args = parser.parse_args()
+
+    catalogo = catalogo_procedimientos(args.procedimientos, args.seed)
+    facturacion = generar_facturacion(args.filas, args.profesionales, args.procedimientos, args.ciudades,
+                                      catalogo=catalogo, seed=args.seed)
+    ruta_fact, ruta_tar, filas = escribir_libros(args.destino, facturacion, generar_tarifario(catalogo, args.seed))
+    print(f"{ruta_fact}: {filas:,} filas")
+    print(f"{ruta_tar}: {len(catalogo):,} procedimientos")
+
+
+if __name__ == "__main__":
+    main()
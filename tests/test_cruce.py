@@ -0,0 +1,29 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import appy  # noqa: E402
+
+CLAVES = ["k1", "k2"]
+
+
+def test_claves_compuestas_con_vacios_no_chocan():
+    # (p, NaN) y (q, m) en A; (p, m) y (q, NaN) en B: cuatro tuplas distintas
+    a = pd.DataFrame({"k1": ["p", "q"], "k2": [np.nan, "m"]})
+    b = pd.DataFrame({"k1": ["p", "q"], "k2": ["m", np.nan]})
+    codigos_a, codigos_b = appy.codificar_claves_compuestas(a, b, CLAVES)
+    assert len(set(codigos_a) | set(codigos_b)) == 4
+
+
+def test_cruce_con_vacio_en_una_columna_clave_como_merge():
+    a = pd.DataFrame({"k1": ["p", "q", "r"], "k2": [np.nan, "m", np.nan], "a": [1, 2, 3]})
+    b = pd.DataFrame({"k1": ["p", "q", "r"], "k2": ["m", np.nan, np.nan], "b": [4, 5, 6]})
+    coincidencias, solo_a, solo_b = appy.cruzar_particion(a, b, CLAVES)
+
+    esperado = pd.merge(a, b, on=CLAVES, how="inner")
+    assert coincidencias[["k1", "a", "b"]].values.tolist() == esperado[["k1", "a", "b"]].values.tolist() == [["r", 3, 6]]
+    assert solo_a["a"].tolist() == [1, 2]
+    assert solo_b["b"].tolist() == [4, 5]
@@ -0,0 +1,22 @@
+import os
+import sys
+
+import numpy as np
+import openpyxl
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import appy  # noqa: E402
+
+
+def test_formatos_por_columna_iguales_en_todos_los_bloques(tmp_path):
+    # El segundo bloque trae floats (por el vacío): el formato no debe cambiar con el tipo
+    b1 = pd.DataFrame({"id": [1020304050, 2], "Valor Total": [1000, 2]})
+    b2 = pd.DataFrame({"id": [3.0, np.nan], "Valor Total": [1.5, np.nan]})
+    ruta = tmp_path / "salida.xlsx"
+    appy.exportar_xlsx(str(ruta), [("H", [b1, b2])], formatos_columnas={"Valor Total": appy.FORMATO_ENTERO_XLSX})
+
+    hoja = openpyxl.load_workbook(ruta)["H"]
+    filas = list(hoja.iter_rows(min_row=2, max_row=4))
+    assert [fila[0].number_format for fila in filas] == ["General"] * 3
+    assert [fila[1].number_format for fila in filas] == [appy.FORMATO_ENTERO_XLSX] * 3